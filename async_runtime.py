@@ -0,0 +1,63 @@
+"""
+The asyncio runtime: a single event loop per process instead of a receive thread, a tick thread and a thread per
+chat client. Datagrams are handled by a DatagramProtocol with the same handle_datagram the receive threads call, the
+tick is a task of the loop and the chat uses asyncio streams. Selected by settings.RUNTIME.
+"""
+import asyncio
+import logging
+import socket
+from typing import Callable, Optional
+
+from tick_scheduler import TickScheduler
+
+THREADS, ASYNCIO = 'threads', 'asyncio'
+RUNTIMES = [THREADS, ASYNCIO]
+
+
+def use_asyncio(runtime: str) -> bool:
+    if runtime not in RUNTIMES:
+        raise ValueError(f'unknown runtime: {runtime=}, expected one of {RUNTIMES}')
+    return runtime == ASYNCIO
+
+
+class DatagramHandler(asyncio.DatagramProtocol):
+    def __init__(self, handle_datagram: Callable[[bytes, tuple], None]):
+        self.handle_datagram = handle_datagram
+
+    def datagram_received(self, data: bytes, addr):
+        try:
+            self.handle_datagram(data, addr)
+        except Exception:
+            logging.exception('exception while handling request')
+
+    def error_received(self, exc: Exception):
+        # an ICMP error of an earlier send, the threads runtime ignores them too (ConnectionResetError)
+        logging.debug(f'datagram error: {exc=}')
+
+
+async def serve(sock: socket.socket, handle_datagram: Callable[[bytes, tuple], None],
+                scheduler: Optional[TickScheduler] = None, chat=None, ticks: Optional[int] = None):
+    """
+    Handle the datagrams of a bound socket, and run the ticks and the chat server if given, until cancelled
+    :param chat: an AsyncChatServer
+    :param ticks: stop after that many ticks, for benchmarks
+    """
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(lambda: DatagramHandler(handle_datagram), sock=sock)
+    tasks = []
+    if scheduler is not None:
+        tasks.append(scheduler.run_async(ticks))
+    if chat is not None:
+        tasks.append(chat.start())
+    try:
+        if tasks:
+            await asyncio.gather(*tasks)
+        else:
+            await asyncio.Event().wait()
+    finally:
+        transport.close()
+
+
+def run(sock: socket.socket, handle_datagram: Callable[[bytes, tuple], None],
+        scheduler: Optional[TickScheduler] = None, chat=None):
+    asyncio.run(serve(sock, handle_datagram, scheduler, chat))
@@ -0,0 +1,148 @@
+"""
+The logins of the load balancer, off the loop routing the servers' messages. The loop only admits a login datagram
+into a bounded queue, worker threads run the key exchange and the queries, on connections of the database's pool, and
+a process pool hashes the passwords (PBKDF2 holds the GIL). A burst of logins waits in the queue, or is turned down by
+the workers, instead of stalling the game traffic.
+Every ip address has its own queue and the workers take the logins of the addresses in turn, so a single host flooding
+the load balancer with logins delays its own logins only.
+"""
+import logging
+import multiprocessing
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Deque, Dict, Optional, Tuple
+
+from database import hash_password
+from settings import AUTH_HASH_PROCESSES, AUTH_MAX_PENDING, AUTH_MAX_PER_HOST, AUTH_MAX_WAIT, AUTH_WORKERS
+from utils import Address
+
+# (when it was admitted or None if it's to be turned down, datagram, address)
+Login = Tuple[Optional[float], bytes, Address]
+
+
+class AuthPipeline:
+    def __init__(self, handle_login: Callable[[bytes, Address], None], turn_down: Callable[[bytes, Address], None],
+                 workers: int = AUTH_WORKERS, hash_processes: int = AUTH_HASH_PROCESSES,
+                 max_pending: int = AUTH_MAX_PENDING, max_per_host: int = AUTH_MAX_PER_HOST,
+                 max_wait: float = AUTH_MAX_WAIT):
+        """
+        :param handle_login: runs a login datagram on a worker, the database hashes with hash_password
+        :param turn_down: tells the client of a login datagram the load balancer is too busy, on a worker
+        """
+        self.handle_login = handle_login
+        self.turn_down = turn_down
+        self.max_pending = max_pending
+        self.max_per_host = max_per_host
+        self.max_wait = max_wait
+
+        self.condition = threading.Condition()
+        self.queues: Dict[str, Deque[Login]] = {}  # ip address to its logins waiting, oldest first
+        self.hosts: Deque[str] = deque()  # the addresses with logins waiting, in turn
+        self.pending = 0
+        # answered when no login is waiting, it costs a key exchange, when the workers can't keep up the oldest go
+        # unanswered
+        self.turn_downs: Deque[Login] = deque(maxlen=max_pending)
+        self.closed = False
+
+        self.admitted = 0
+        self.rejected = 0  # turned down right away, the queues were full
+        self.expired = 0  # turned down after waiting max_wait
+        self.completed = 0
+        self.max_queue_time = 0.0
+
+        # forked from a worker thread, a child could inherit a lock another thread holds (logging's, the load
+        # balancer's), spawned children start clean
+        self.hash_pool = ProcessPoolExecutor(max_workers=hash_processes,
+                                             mp_context=multiprocessing.get_context('spawn'))
+        self.workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self.run_worker, name=f'auth-{i}', daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, msg: bytes, address: Address) -> bool:
+        """
+        Admit a login datagram, in O(1) on the receiving thread
+        :return: whether it was admitted, the client is turned down by a worker otherwise
+        """
+        host = address[0]
+        with self.condition:
+            queue = self.queues.get(host)
+            admitted = self.pending < self.max_pending and (queue is None or len(queue) < self.max_per_host)
+            if admitted:
+                if queue is None:
+                    queue = self.queues[host] = deque()
+                    self.hosts.append(host)
+                queue.append((time.monotonic(), msg, address))
+                self.pending += 1
+                self.admitted += 1
+            else:
+                self.turn_downs.append((None, msg, address))
+                self.rejected += 1
+            self.condition.notify()
+        if not admitted:
+            logging.debug(f'login turned down, too many waiting: {address=}, {self.pending=}')
+        return admitted
+
+    def next_login(self) -> Optional[Login]:
+        """
+        :return: the oldest login of the next address in turn, or else a login to turn down, None once closed
+        """
+        with self.condition:
+            while not self.hosts and not self.turn_downs and not self.closed:
+                self.condition.wait()
+            if self.closed:
+                return None
+            if not self.hosts:
+                return self.turn_downs.popleft()
+            host = self.hosts.popleft()
+            queue = self.queues[host]
+            login = queue.popleft()
+            if queue:
+                self.hosts.append(host)
+            else:
+                del self.queues[host]
+            self.pending -= 1
+            return login
+
+    def hash_password(self, password: str, salt: bytes) -> bytes:
+        return self.hash_pool.submit(hash_password, password, salt).result()
+
+    def run_worker(self):
+        while True:
+            login = self.next_login()
+            if login is None:
+                break
+            admitted_at, msg, address = login
+            try:
+                if admitted_at is None:
+                    self.turn_down(msg, address)
+                    continue
+                queue_time = time.monotonic() - admitted_at
+                expired = queue_time > self.max_wait
+                with self.condition:
+                    self.max_queue_time = max(self.max_queue_time, queue_time)
+                    self.expired += expired
+                if expired:
+                    self.turn_down(msg, address)
+                    continue
+                self.handle_login(msg, address)
+                with self.condition:
+                    self.completed += 1
+            except Exception:
+                logging.exception(f'exception while handling login: {address=}')
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {'admitted': self.admitted, 'rejected': self.rejected, 'expired': self.expired,
+                    'completed': self.completed, 'pending': self.pending, 'max_queue_time': self.max_queue_time}
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for worker in self.workers:
+            worker.join(timeout=1)
+        self.hash_pool.shutdown(cancel_futures=True)
@@ -0,0 +1,309 @@
+"""
+Batched datagram I/O.
+On Linux datagrams are received with recvmmsg into preallocated buffers, many per wakeup. Elsewhere the same interface
+falls back to recvfrom_into, draining the socket without blocking after the first datagram.
+Datagrams are sent one sendto each: batching them with sendmmsg took more Python work per datagram, for the queue, the
+addresses and the iovecs, than the system calls it saved (python -m benchmarks.io_benchmark).
+"""
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import socket
+import struct
+import sys
+import threading
+from typing import Callable, Hashable, List, Optional, Tuple
+
+from settings import IO_ADDRESS_CACHE, IO_BATCH_SIZE, MTU, SOCKET_RECV_BUFFER, SOCKET_SEND_BUFFER
+
+Address = Tuple[str, int]
+
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
+MSG_WAITFORONE = 0x10000  # recvmmsg: block for the first datagram only
+SO_RXQ_OVFL = 40  # linux: the count of datagrams the kernel dropped is attached to every received datagram
+DROPS = struct.Struct('I')
+SOCKADDR_IN = struct.Struct('=H2s4s8x')  # family (host order), port, address (both network order)
+IPV4_ADDRESS_SIZE = SOCKADDR_IN.size
+
+# errors after which the socket is still usable, the datagram is lost
+TRANSIENT_ERRORS = {errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS, errno.ECONNREFUSED, errno.EHOSTUNREACH,
+                    errno.ENETUNREACH, errno.EPERM}
+
+
+class IOVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class MsgHdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(IOVec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t), ('msg_flags', ctypes.c_int)]
+
+
+class MMsgHdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', MsgHdr), ('msg_len', ctypes.c_uint)]
+
+
+def address_of(buffer: bytearray) -> int:
+    return ctypes.addressof(ctypes.c_char.from_buffer(buffer))
+
+
+class MessageBuffers:
+    """
+    The headers of recvmmsg calls, every header points to its slot in data, names and controls.
+    The lengths which change with every datagram are read and written through memoryviews over the headers, which
+    is much cheaper than through ctypes objects.
+    """
+
+    def __init__(self, n: int, control_size: int, data: Optional[bytearray] = None):
+        self.n = n
+        self.data = data if data is not None else bytearray(MTU * n)
+        self.names = bytearray(IPV4_ADDRESS_SIZE * n)
+        self.control_size = control_size
+        self.controls = bytearray(max(1, control_size * n))
+        self.raw_iovecs = raw_iovecs = bytearray(ctypes.sizeof(IOVec) * n)
+        raw_headers = bytearray(ctypes.sizeof(MMsgHdr) * n)
+        self.iovecs = (IOVec * n).from_buffer(raw_iovecs)
+        self.headers = (MMsgHdr * n).from_buffer(raw_headers)
+        data_address, names_address, controls_address = map(address_of, [self.data, self.names, self.controls])
+        self.data_address = data_address
+        for i in range(n):
+            self.iovecs[i].iov_base = data_address + i * MTU
+            self.iovecs[i].iov_len = MTU
+            header = self.headers[i].msg_hdr
+            header.msg_iov = ctypes.pointer(self.iovecs[i])
+            header.msg_iovlen = 1
+            header.msg_name = names_address + i * IPV4_ADDRESS_SIZE
+            header.msg_namelen = IPV4_ADDRESS_SIZE
+            if control_size:
+                header.msg_control = controls_address + i * control_size
+                header.msg_controllen = control_size
+
+        # every field is a strided slice of a memoryview of the right item size
+        self.header_words = memoryview(raw_headers).cast('I')
+        self.header_sizes = memoryview(raw_headers).cast('N')
+        self.msg_len = field_slice(self.header_words, MMsgHdr.msg_len.offset, ctypes.sizeof(MMsgHdr))
+        self.namelen = field_slice(self.header_words, MsgHdr.msg_namelen.offset, ctypes.sizeof(MMsgHdr))
+        self.controllen = field_slice(self.header_sizes, MsgHdr.msg_controllen.offset, ctypes.sizeof(MMsgHdr))
+        self.namelen_fill = memoryview(struct.pack(f'{n}I', *[IPV4_ADDRESS_SIZE] * n)).cast('I')
+        self.controllen_fill = memoryview(struct.pack(f'{n}N', *[control_size] * n)).cast('N')
+
+    def reset(self):
+        """
+        Reset the lengths recvmmsg overwrote
+        """
+        self.header_words[self.namelen] = self.namelen_fill
+        self.header_sizes[self.controllen] = self.controllen_fill
+
+
+def field_slice(view: memoryview, offset: int, stride: int) -> slice:
+    """
+    The slice of a memoryview over an array of structures which selects one field of every structure
+    """
+    start, step = offset // view.itemsize, stride // view.itemsize
+    return slice(start, start + step * (len(view) // step), step)
+
+
+def load_mmsg():
+    """
+    :return: libc if it has recvmmsg, None otherwise
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        return None
+    if not hasattr(libc, 'recvmmsg'):
+        return None
+    libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    return libc
+
+
+libc = load_mmsg()
+
+
+def unpack_address(data: bytes) -> Address:
+    _, port, host = SOCKADDR_IN.unpack(data)
+    return socket.inet_ntoa(host), struct.unpack('>H', port)[0]
+
+
+class AddressCache:
+    """
+    The conversions of the addresses used recently, the same clients send every tick. An approximate
+    LRU of two generations: the conversions are found in the current one, or moved up from the previous one, and once
+    the current one holds size the previous one is dropped. So more clients than size cost a conversion each, not the
+    whole cache, and the hits are plain dict lookups, done for a whole batch at once by get_many.
+    """
+
+    def __init__(self, convert: Callable, size: int = IO_ADDRESS_CACHE):
+        self.convert = convert
+        self.size = size
+        self.current = {}
+        self.previous = {}
+
+    def __len__(self):
+        return len(self.current) + len(self.previous)
+
+    def get(self, key: Hashable):
+        value = self.current.get(key)
+        if value is None:
+            value = self.previous.get(key)
+            if value is None:
+                value = self.convert(key)
+            if len(self.current) >= self.size:
+                self.previous, self.current = self.current, {}
+            self.current[key] = value
+        return value
+
+    def get_many(self, keys) -> list:
+        values = list(map(self.current.get, keys))
+        if None in values:
+            for i, value in enumerate(values):
+                if value is None:
+                    values[i] = self.get(keys[i])
+        return values
+
+
+class BatchSocket:
+    """
+    A UDP socket which receives datagrams in batches.
+    receive is called by a single thread, sendto may be called by any thread. Drops are counted: the datagrams which couldn't be sent, and the ones
+    the kernel dropped because the receive buffer was full (linux only).
+    """
+
+    def __init__(self, sock: socket.socket, batch_size: int = IO_BATCH_SIZE, recv_buffer: int = SOCKET_RECV_BUFFER,
+                 send_buffer: int = SOCKET_SEND_BUFFER):
+        self.socket = sock
+        self.batch_size = batch_size
+        self.set_buffer_sizes(recv_buffer, send_buffer)
+
+        self.drops_lock = threading.Lock()  # sendto may be called by several threads
+        self.received = 0
+        self.receive_batches = 0
+        self.send_drops = 0
+        self.receive_drops = 0  # by the kernel, since the socket was created
+
+        self.buffer = bytearray(MTU * batch_size)  # received datagrams, MTU bytes for each
+        self.views = [memoryview(self.buffer)[i * MTU:(i + 1) * MTU] for i in range(batch_size)]
+        self.mmsg = libc is not None and sock.family == socket.AF_INET
+        if self.mmsg:
+            self.init_mmsg()
+
+    def set_buffer_sizes(self, recv_buffer: int, send_buffer: int):
+        for option, size in [(socket.SO_RCVBUF, recv_buffer), (socket.SO_SNDBUF, send_buffer)]:
+            try:
+                self.socket.setsockopt(socket.SOL_SOCKET, option, size)
+            except OSError:
+                logging.exception(f"can't set socket buffer size: {option=}, {size=}")
+        # the kernel may cap (or on linux, double) the sizes
+        logging.debug(f'socket buffers: receive={self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)}, '
+                      f'send={self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)}')
+
+    def init_mmsg(self):
+        """
+        Preallocate the buffers and message headers of recvmmsg, they are reused by every call
+        """
+        self.fd = self.socket.fileno()
+        try:
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+            self.drop_counting = True
+        except OSError:
+            self.drop_counting = False
+        self.recv = MessageBuffers(self.batch_size, socket.CMSG_SPACE(DROPS.size) if self.drop_counting else 0,
+                                   data=self.buffer)
+        self.addresses = AddressCache(unpack_address)  # sockaddr_in to its address
+
+    def receive(self) -> List[Tuple[bytes, Address]]:
+        """
+        Block until at least one datagram arrives
+        :return: the (datagram, address) pairs received, at most batch_size of them
+        """
+        datagrams = self.receive_mmsg() if self.mmsg else self.receive_fallback()
+        self.received += len(datagrams)
+        self.receive_batches += 1
+        return datagrams
+
+    def receive_fallback(self) -> List[Tuple[bytes, Address]]:
+        datagrams = []
+        flags = 0
+        for view in self.views:
+            try:
+                n, address = self.socket.recvfrom_into(view, MTU, flags)
+            except BlockingIOError:
+                break
+            datagrams.append((bytes(view[:n]), address))
+            if not MSG_DONTWAIT:
+                break
+            flags = MSG_DONTWAIT
+        return datagrams
+
+    def receive_mmsg(self) -> List[Tuple[bytes, Address]]:
+        recv = self.recv
+        while True:
+            count = libc.recvmmsg(self.fd, recv.headers, self.batch_size, MSG_WAITFORONE, None)
+            if count >= 0:
+                break
+            error = ctypes.get_errno()
+            if error == errno.EINTR:
+                continue
+            if error == errno.ECONNREFUSED:
+                # an ICMP error of an earlier send, like ConnectionResetError on windows
+                raise ConnectionResetError(error, os.strerror(error))
+            raise OSError(error, os.strerror(error))
+
+        if count and self.drop_counting:
+            self.read_drops(count - 1)
+        sizes = recv.header_words[recv.msg_len].tolist()[:count]
+        names = bytes(recv.names[:count * IPV4_ADDRESS_SIZE])
+        names = [names[i:i + IPV4_ADDRESS_SIZE] for i in range(0, len(names), IPV4_ADDRESS_SIZE)]
+        datagrams = [(bytes(view[:size]), address)
+                     for view, size, address in zip(self.views, sizes, self.addresses.get_many(names))]
+        recv.reset()
+        return datagrams
+
+    def read_drops(self, i: int):
+        """
+        Read the kernel's drop counter attached to the i-th received datagram
+        """
+        recv = self.recv
+        if recv.header_sizes[recv.controllen][i] < socket.CMSG_LEN(DROPS.size):
+            return
+        offset = i * recv.control_size
+        _, level, kind = struct.unpack_from('Nii', recv.controls, offset)
+        if level != socket.SOL_SOCKET or kind != SO_RXQ_OVFL:
+            return
+        drops, = DROPS.unpack_from(recv.controls, offset + socket.CMSG_LEN(0))
+        if drops > self.receive_drops:
+            logging.warning(f'the kernel dropped received datagrams, the socket buffer is too small: '
+                            f'{drops - self.receive_drops} new, {drops} total')
+            self.receive_drops = drops
+
+    def sendto(self, datagram: bytes, address: Address):
+        """
+        Send a datagram now. Named like socket.sendto so send_all takes either
+        """
+        if len(datagram) > MTU:
+            raise ValueError(f'datagram bigger than the MTU: {len(datagram)=}, {address=}')
+        try:
+            self.socket.sendto(datagram, address)
+        except OSError as e:
+            self.send_dropped(e.errno, address)
+
+    def send_dropped(self, error: Optional[int], address: Address):
+        with self.drops_lock:
+            self.send_drops += 1
+        if error in TRANSIENT_ERRORS:
+            logging.debug(f'datagram dropped: {address=}, {os.strerror(error)}')
+        else:
+            logging.warning(f"can't send datagram: {address=}, {error=}")
+
+    def stats(self) -> dict:
+        return {
+            'received': self.received,
+            'receive_batches': self.receive_batches,
+            'receive_drops': self.receive_drops,
+            'send_drops': self.send_drops,
+        }
@@ -0,0 +1,62 @@
+"""
+Compare Fernet with the ChaCha20-Poly1305 session cipher on the broadcast of one tick's updates to every client.
+Run from the repository root: python -m benchmarks.cipher_benchmark [client count] [mob count]
+"""
+import sys
+import time
+
+from cryptography.hazmat.primitives.asymmetric import ec
+
+from benchmarks.codec_benchmark import make_batches
+from my_server import wire_encode
+from protocol import BINARY, JSON
+from utils import CURVE, get_fernet, get_session_cipher
+
+PACKET_SIZE = 1024  # send_all's slices
+
+
+def make_sessions(client_count: int):
+    """
+    :return: for every cipher, a list of (server side, client side) pairs
+    """
+    server_key = ec.generate_private_key(CURVE)
+    sessions = {'fernet': [], 'chacha20poly1305': []}
+    for _ in range(client_count):
+        client_key = ec.generate_private_key(CURVE)
+        fernet = get_fernet(client_key.public_key(), server_key)
+        sessions['fernet'].append((fernet, fernet))
+        sessions['chacha20poly1305'].append((get_session_cipher(client_key.public_key(), server_key, server=True),
+                                             get_session_cipher(server_key.public_key(), client_key, server=False)))
+    return sessions
+
+
+def measure(name: str, payload: bytes, sessions: dict, ticks: int = 5):
+    print(f'{name}: {len(payload)} byte payload, {len(next(iter(sessions.values())))} clients')
+    for cipher, pairs in sessions.items():
+        start = time.perf_counter()
+        for _ in range(ticks):
+            tokens = [server.encrypt(payload) for server, _ in pairs]
+        encrypt_time = (time.perf_counter() - start) / ticks
+        start = time.perf_counter()
+        for (_, client), token in zip(pairs, tokens):
+            assert client.decrypt(token) == payload
+        decrypt_time = time.perf_counter() - start
+        wire = sum(len(token) for token in tokens)
+        packets = sum(-(-len(token) // PACKET_SIZE) for token in tokens)
+        print(f'  {cipher:>16}: encrypt {encrypt_time * 1000:7.2f} ms/tick, '
+              f'decrypt {decrypt_time / len(pairs) * 1e6:6.1f} us/packet, '
+              f'{wire / 1024:8.1f} KiB/tick in {packets} datagrams')
+
+
+def main():
+    client_count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    mob_count = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    updates, _ = make_batches(mob_count, 20)
+    message = max(updates, key=lambda m: len(m['updates']))
+    sessions = make_sessions(client_count)
+    for protocol in [JSON, BINARY]:
+        measure(f'{protocol} update batch', wire_encode(message, protocol), sessions)
+
+
+if __name__ == '__main__':
+    main()
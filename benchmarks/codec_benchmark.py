@@ -0,0 +1,64 @@
+"""
+Compare the JSON and binary wire encodings on update batches from a simulated server.
+Run from the repository root: python -m benchmarks.codec_benchmark [mob count] [ticks]
+"""
+import socket
+import sys
+import timeit
+
+import settings
+from my_server import Server, default_player, json_encode, wire_encode
+from protocol import BINARY, JSON, decode
+
+
+def make_batches(mob_count: int, ticks: int):
+    """
+    Run a server without clients and collect what it would send them
+    :return: a list of update messages and a list of full snapshot messages
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server = Server(sock=sock)
+    server.generate_mobs(mob_count)
+    player = default_player('benchmark')
+    server.add_entity(player)
+
+    snapshots_enabled = settings.ENABLE_SNAPSHOTS
+    settings.ENABLE_SNAPSHOTS = False  # keep the move and collision updates
+    updates, snapshots = [], []
+    for _ in range(ticks):
+        server.update_mobs()
+        server.collisions_handler()
+        updates.append({'cmd': 'update', 'updates': server.updates})
+        server.updates = []
+        snapshots.append(server.replicator.make_delta(None, server.get_snapshot(None, None)))
+    settings.ENABLE_SNAPSHOTS = snapshots_enabled
+    sock.close()
+    return updates, snapshots
+
+
+def measure(name: str, messages: list, repeat: int = 5):
+    json_data = [json_encode(message) for message in messages]
+    binary_data = [wire_encode(message, BINARY) for message in messages]
+    assert all(decode(binary) == decode(text) for binary, text in zip(binary_data, json_data))
+
+    print(f'{name}: {len(messages)} messages')
+    for protocol, data in [(JSON, json_data), (BINARY, binary_data)]:
+        encode_time = min(timeit.repeat(lambda: [wire_encode(message, protocol) for message in messages],
+                                        number=1, repeat=repeat))
+        decode_time = min(timeit.repeat(lambda: [decode(d) for d in data], number=1, repeat=repeat))
+        size = sum(len(d) for d in data)
+        print(f'  {protocol:>6}: {size / len(messages):10.0f} bytes/message, '
+              f'encode {encode_time / len(messages) * 1e6:8.1f} us/message, '
+              f'decode {decode_time / len(messages) * 1e6:8.1f} us/message')
+
+
+def main():
+    mob_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    ticks = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    updates, snapshots = make_batches(mob_count, ticks)
+    measure('update batches', [message for message in updates if message['updates']])
+    measure('full snapshots', snapshots[:5])
+
+
+if __name__ == '__main__':
+    main()
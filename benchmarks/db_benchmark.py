@@ -0,0 +1,88 @@
+"""
+Measure the queries of a login (the account and the player, by username) and of a logout (the player's upsert) against
+a database of many accounts. The password hashing is left out, it costs the same at any size, see AuthPipeline.
+The backend is settings.DB_BACKEND, GAME_DB_BACKEND=sqlite runs it without a MySQL server. The accounts go to a
+database of their own, created once and filled up to the account count on later runs.
+Run from the repository root: python -m benchmarks.db_benchmark [account count] [sample count]
+"""
+import hashlib
+import random
+import statistics
+import sys
+import time
+
+from database import DBAPI, player_row
+from my_server import default_player
+from settings import DB_BACKEND
+from storage import SQLITE, open_storage
+
+DATABASE = 'dragonraja_benchmark'
+BATCH = 10000
+PASSWORD = 'Benchmark1!'
+SALT = bytes(32)
+
+
+def fast_hash(password: str, salt: bytes) -> bytes:
+    return hashlib.sha256(salt + password.encode()).digest()
+
+
+def username(i: int) -> str:
+    return f'benchmark{i:08}'
+
+
+def fill(dbapi: DBAPI, count: int):
+    """
+    Add accounts and their players up to count
+    """
+    existing = 0  # the batches are added whole, up to the first batch missing its last account
+    while existing < count and dbapi.check_account_exists(username(min(existing + BATCH, count) - 1)):
+        existing += BATCH
+    existing = min(existing, count)
+    hash_ = fast_hash(PASSWORD, SALT).hex()
+    start = time.perf_counter()
+    for first in range(existing, count, BATCH):
+        accounts = [(username(i), hash_, SALT.hex()) for i in range(first, min(first + BATCH, count))]
+        players = [player_row(default_player(name)) for name, _, _ in accounts]
+        for i, row in enumerate(players):
+            row['id'] = first + i  # default_player's ids aren't unique across runs
+        dbapi.storage.add_accounts(accounts)
+        dbapi.storage.write_players(players)
+    if existing < count:
+        print(f'added accounts {existing} to {count} in {time.perf_counter() - start:.1f} s')
+
+
+def percentiles(samples) -> str:
+    samples = sorted(samples)
+    quantiles = statistics.quantiles(samples, n=100)
+    return f'p50 {quantiles[49]:6.2f} ms, p99 {quantiles[98]:6.2f} ms, max {samples[-1]:6.2f} ms'
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    samples = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    location = {'path': f'{DATABASE}.db'} if DB_BACKEND == SQLITE else {'database': DATABASE}
+    storage = open_storage(DB_BACKEND, **location)
+    dbapi = DBAPI(storage, password_hasher=fast_hash)
+    try:
+        fill(dbapi, count)
+        names = [username(random.randrange(count)) for _ in range(samples)]
+        logins, logouts = [], []
+        for name in names:
+            start = time.perf_counter()
+            assert dbapi.verify_account(name, PASSWORD)
+            player = dbapi.retrieve_player(name)
+            logins.append((time.perf_counter() - start) * 1000)
+
+            player.health -= 1
+            start = time.perf_counter()
+            assert dbapi.write_players([player])
+            logouts.append((time.perf_counter() - start) * 1000)
+        print(f'{DB_BACKEND}: {count} accounts, {samples} samples')
+        print(f'  login:  {percentiles(logins)}')
+        print(f'  logout: {percentiles(logouts)}')
+    finally:
+        dbapi.close()
+
+
+if __name__ == '__main__':
+    main()
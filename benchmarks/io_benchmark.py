@@ -0,0 +1,83 @@
+"""
+Compare socket.sendto with BatchSocket.sendto on the broadcast of one tick to every client, and recvfrom with
+BatchSocket.receive on the server's receive side.
+Run from the repository root: python -m benchmarks.io_benchmark [client count] [datagrams per client]
+"""
+import socket
+import sys
+import time
+
+from batch_io import BatchSocket, libc
+from settings import MTU
+
+
+def make_clients(count: int):
+    clients = []
+    for _ in range(count):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        sock.setblocking(False)
+        clients.append(sock)
+    return clients
+
+
+def drain(clients):
+    for sock in clients:
+        try:
+            while True:
+                sock.recv(MTU)
+        except BlockingIOError:
+            pass
+
+
+def measure_send(clients, per_client: int, ticks: int = 20):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    batch = BatchSocket(socket.socket(socket.AF_INET, socket.SOCK_DGRAM))
+    addresses = [client.getsockname() for client in clients]
+    datagram = b'x' * MTU
+    for name, send in [('sendto', sock.sendto), ('wrapped', batch.sendto)]:
+        elapsed = 0
+        for _ in range(ticks):
+            start = time.perf_counter()
+            for address in addresses:
+                for _ in range(per_client):
+                    send(datagram, address)
+            elapsed += time.perf_counter() - start
+            drain(clients)
+        print(f'  send {name:>8}: {elapsed / ticks * 1000:7.2f} ms/tick')
+    print(f'  wrapped: {ticks * len(addresses) * per_client} datagrams, {batch.send_drops} dropped')
+
+
+def measure_receive(count: int, batches: int = 50):
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+    batch = BatchSocket(receiver)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    address = receiver.getsockname()
+    datagram = b'x' * 200  # client inputs are small
+    for name, receive in [('recvfrom', lambda: [receiver.recvfrom(MTU)]), ('batched', batch.receive)]:
+        elapsed = 0
+        for _ in range(batches):
+            for _ in range(count):
+                sender.sendto(datagram, address)
+            start = time.perf_counter()
+            received = 0
+            while received < count:
+                received += len(receive())
+            elapsed += time.perf_counter() - start
+        print(f'  receive {name:>8}: {elapsed / batches / count * 1e6:6.2f} us/datagram')
+
+
+def main():
+    client_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    per_client = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    print(f'{client_count} clients, {per_client} datagrams each per tick, '
+          f'{"recvmmsg" if libc is not None else "fallback"} batching')
+    clients = make_clients(client_count)
+    measure_send(clients, per_client)
+    measure_receive(client_count)
+
+
+if __name__ == '__main__':
+    main()
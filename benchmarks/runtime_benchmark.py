@@ -0,0 +1,104 @@
+"""
+Compare the threads runtime with the asyncio runtime of NewServer: tick timing while clients flood the server with
+moves from another process, and how many of the moves made it into the game.
+Run from the repository root: python -m benchmarks.runtime_benchmark [client count] [moves per client per second]
+"""
+import asyncio
+import multiprocessing
+import socket
+import sys
+import threading
+import time
+
+from cryptography.hazmat.primitives.asymmetric import ec
+
+import async_runtime
+import settings
+from new_server import NewServer
+from my_server import default_player
+from protocol import encode
+from tick_scheduler import TickScheduler
+from utils import CURVE, ID_HEADER, generate_chunk_mapping, get_cipher, load_public_ecdh_key, serialize_public_key
+
+TICKS = 50
+MOB_COUNT = 500
+
+
+def flood(server_address, clients, rate: int, duration: float):
+    """
+    Send every client's moves at the given rate, runs in a forked process which inherits the clients' sockets
+    """
+    end = time.monotonic() + duration
+    interval = 1 / rate
+    while time.monotonic() < end:
+        start = time.monotonic()
+        for player_id, pos, cipher, sock in clients:
+            data = encode({'cmd': 'move', 'id': player_id, 'pos': pos})
+            sock.sendto(ID_HEADER.pack(player_id) + cipher.encrypt(data), server_address)
+        time.sleep(max(0.0, interval - (time.monotonic() - start)))
+
+
+def make_server(client_count: int):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    chunk_mapping = generate_chunk_mapping()
+    server_chunks = [(i, j) for i in range(settings.CHUNKS_X) for j in range(settings.CHUNKS_Y)
+                     if chunk_mapping[i][j] == 0]
+    server = NewServer(sock, ('127.0.0.1', 1), server_chunks, [])
+    server.generate_mobs(MOB_COUNT)
+    server.begin_tick()
+    clients = []
+    for i in range(client_count):
+        client_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client_sock.bind(('127.0.0.1', 0))
+        key = ec.generate_private_key(CURVE)
+        player = default_player(f'player{i}')
+        player.start_pos = player.end_pos = list(server.mobs.values())[i % MOB_COUNT].get_pos()
+        server.add_entity(player)
+        server.add_client(player, client_sock.getsockname(), serialize_public_key(key.public_key()).decode(),
+                          init=True)
+        cipher = get_cipher(load_public_ecdh_key(), key, server=False)
+        clients.append((player.id, list(player.start_pos), cipher, client_sock))
+    return server, sock, clients
+
+
+def measure(runtime: str, client_count: int, rate: int):
+    server, sock, clients = make_server(client_count)
+    applied = [0]
+
+    def tick():
+        applied[0] += len(server.commands)
+        server.begin_tick()
+        server.apply_commands()
+        server.collisions_handler()
+        server.send_updates()
+        server.update_mobs()
+
+    scheduler = TickScheduler(period=settings.UPDATE_TICK, tick=tick)
+    process = multiprocessing.get_context('fork').Process(
+        target=flood, args=(sock.getsockname(), clients, rate, TICKS * settings.UPDATE_TICK))
+    process.start()
+    if runtime == async_runtime.ASYNCIO:
+        asyncio.run(async_runtime.serve(sock, server.handle_datagram, scheduler, ticks=TICKS))
+    else:
+        threading.Thread(target=server.receive_packets, daemon=True).start()
+        scheduler.run(TICKS)
+    process.join()
+    summary = scheduler.stats.summary()
+    print(f'  {runtime:>8}: tick mean {summary["mean_duration"] * 1000:6.2f} ms, '
+          f'p99 {summary["p99_duration"] * 1000:6.2f} ms, max lateness {summary["max_lateness"] * 1000:6.2f} ms, '
+          f'{applied[0]} moves applied, {server.commands.dropped} dropped')
+    for client in clients:
+        client[-1].close()
+
+
+def main():
+    client_count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    rate = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+    print(f'{client_count} clients sending {rate} moves/s, {MOB_COUNT} mobs, {TICKS} ticks')
+    for runtime in async_runtime.RUNTIMES:
+        measure(runtime, client_count, rate)
+
+
+if __name__ == '__main__':
+    main()
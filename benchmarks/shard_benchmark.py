@@ -0,0 +1,70 @@
+"""
+Compare finding the collisions of a mob-heavy section in the server's process with finding them in collision shards,
+and how the work splits between the shards: the slowest shard bounds a tick when every shard has a core.
+Run from the repository root: python -m benchmarks.shard_benchmark [mob count] [max shard count]
+"""
+import os
+import socket
+import sys
+import time
+
+import settings
+from new_server import NewServer
+from my_server import default_player
+from shard import ShardPool, find_collisions, split_bands
+from utils import generate_chunk_mapping
+
+PLAYERS = 20
+REPEAT = 5
+
+
+def best_of(function) -> float:
+    """
+    :return: the fastest of REPEAT runs in ms
+    """
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        function()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    mob_count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    max_shards = int(sys.argv[2]) if len(sys.argv) > 2 else max(os.cpu_count(), 4)
+    chunk_mapping = generate_chunk_mapping()
+    server_chunks = [(i, j) for i in range(settings.CHUNKS_X) for j in range(settings.CHUNKS_Y)
+                     if chunk_mapping[i][j] == 0]
+    server = NewServer(socket.socket(socket.AF_INET, socket.SOCK_DGRAM), settings.LB_ADDRESS, server_chunks, [])
+    server.generate_mobs(mob_count)
+    mobs = list(server.mobs.values())
+    for i in range(PLAYERS):
+        player = default_player(f'player{i}')
+        player.start_pos = player.end_pos = mobs[i].get_pos()
+        server.add_entity(player)
+    t = time.time_ns()
+    server.evaluate_positions(t)
+    print(f'{len(server.mobs)} mobs, {PLAYERS} players, {os.cpu_count()} cores')
+
+    found = len(list(server.entity_collisions(t)))
+    print(f'  in process: {best_of(lambda: list(server.entity_collisions(t))):7.2f} ms, {found} collisions')
+
+    shards = 1
+    while shards <= max_shards:
+        server.shards = ShardPool(server_chunks, server.walls, shards)
+        found = len(list(server.entity_collisions(t)))
+        elapsed = best_of(lambda: list(server.entity_collisions(t)))
+        table = server.shards.table[:len(server.players) + len(server.mobs)].copy()
+        server.shards.close()
+        work = [best_of(lambda: find_collisions(table, band, settings.COLLISION_RADIUS, server.wall_index))
+                for band in split_bands(server_chunks, shards)]
+        print(f'  {shards:2} shards: {elapsed:7.2f} ms, {found} collisions, slowest shard {max(work):7.2f} ms, '
+              f'all shards {sum(work):7.2f} ms')
+        shards *= 2
+    server.shards = None
+
+
+if __name__ == '__main__':
+    main()
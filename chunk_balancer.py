@@ -0,0 +1,63 @@
+"""
+Load driven changes of the chunk mapping. The section servers report how busy their ticks are and how loaded their
+chunks are (see NewServer.send_load), and when the busiest server is too far above the others the load balancer moves
+some of its chunks to its least busy neighbour.
+"""
+from collections import deque
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+from settings import CHUNKS_X, CHUNKS_Y, REBALANCE_MAX_CHUNKS, REBALANCE_MIN_LOAD, REBALANCE_THRESHOLD
+
+Chunk = Tuple[int, int]
+
+
+def side_neighbours(chunk: Chunk) -> Iterator[Chunk]:
+    i, j = chunk
+    for di, dj in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
+        if 0 <= i + di < CHUNKS_X and 0 <= j + dj < CHUNKS_Y:
+            yield i + di, j + dj
+
+
+def plan_rebalance(chunk_mapping: List[List[int]], server_loads: Sequence[float], chunk_loads: Dict[Chunk, float],
+                   threshold: float = REBALANCE_THRESHOLD, min_load: float = REBALANCE_MIN_LOAD,
+                   max_chunks: int = REBALANCE_MAX_CHUNKS) -> List[Tuple[Chunk, int]]:
+    """
+    Plan moving chunks from the busiest server to its least busy neighbour, so that both carry about the same load.
+    The neighbour's region grows into the busy one from their border, so the regions stay in one piece, over the empty
+    chunks up to the loaded ones, at most max_chunks loaded chunks at a time.
+    :param server_loads: the part of the tick period every server is busy
+    :param chunk_loads: the load of the chunks, in any unit, missing chunks are empty
+    :return: (chunk, new server idx) of the chunks to move, nothing if the load isn't skewed
+    """
+    mean = sum(server_loads) / len(server_loads)
+    busiest = max(range(len(server_loads)), key=server_loads.__getitem__)
+    if server_loads[busiest] < min_load or server_loads[busiest] <= threshold * mean:
+        return []
+    chunks = [(i, j) for i, column in enumerate(chunk_mapping) for j, server_idx in enumerate(column)
+              if server_idx == busiest]
+    neighbours = {chunk_mapping[i][j] for chunk in chunks for i, j in side_neighbours(chunk)} - {busiest}
+    if not neighbours:
+        return []
+    target = min(neighbours, key=server_loads.__getitem__)
+    total = sum(chunk_loads.get(chunk, 0) for chunk in chunks)
+    if server_loads[target] >= server_loads[busiest] or total <= 0:
+        return []
+    # the chunk load which evens the two servers out
+    excess = total * (server_loads[busiest] - server_loads[target]) / (2 * server_loads[busiest])
+
+    border = deque(chunk for chunk in chunks if any(chunk_mapping[i][j] == target for i, j in side_neighbours(chunk)))
+    seen = set(border)
+    moves, moved, loaded = [], 0, 0
+    while border and moved < excess and loaded < max_chunks and len(moves) < len(chunks) - 1:
+        chunk = border.popleft()
+        load = chunk_loads.get(chunk, 0)
+        if load >= 2 * (excess - moved):
+            continue  # moving it would leave the servers further apart than they are
+        moves.append((chunk, target))
+        moved += load
+        loaded += load > 0  # empty chunks have nothing to migrate, they don't count
+        for neighbour in side_neighbours(chunk):
+            if neighbour not in seen and chunk_mapping[neighbour[0]][neighbour[1]] == busiest:
+                seen.add(neighbour)
+                border.append(neighbour)
+    return moves
@@ -1,6 +1,8 @@
 import pygame
 
 import entities
+from protocol import JSON, PROTOCOLS, encode
+from replication import SnapshotReceiver
 from utils import *
 
 
@@ -26,6 +28,8 @@ class Client:
         self.mob_walk_speed = mob_walk_speed
 
         self.main_player = None
+        self.snapshots = SnapshotReceiver()
+        self.protocol = JSON  # until the server picks one
 
         self.entity_sprite_groups = [self.sprite_groups['all'], self.sprite_groups['entity']]
         self.projectile_sprite_groups = [self.sprite_groups['all'], self.sprite_groups['projectiles']]
@@ -35,15 +39,15 @@ class Client:
     def fernet_init(self):
         server_public_key = load_public_ecdh_key()
         client_private_key = ec.generate_private_key(CURVE)
-        self.fernet = get_fernet(server_public_key, client_private_key)
+        self.fernet = get_cipher(server_public_key, client_private_key, server=False)
         self.serialized_public_key = serialize_public_key(client_private_key.public_key())
 
     def send_data(self, data: bytes, dst):
-        data = str(self.main_player.id).zfill(6).encode() + self.fernet.encrypt(data)
+        data = ID_HEADER.pack(self.main_player.id) + self.fernet.encrypt(data)
         self.sock.sendto(data, dst)
 
     def send_update(self, cmd: str, params: dict):
-        self.send_data(json.dumps({'cmd': cmd, **params}).encode(), self.server)
+        self.send_data(encode({'cmd': cmd, **params}, self.protocol), self.server)
 
     def create_entity(self, cls, data, sprite_groups, walk_speed, animations, anim_speed, **kwargs):
         entity = cls(
@@ -88,7 +92,7 @@ class Client:
                          item_id=data['item_id'])
 
     def connect(self, username='ariel'):
-        self.send_update('connect', {'username': username})
+        self.send_update('connect', {'username': username, 'protocols': PROTOCOLS})
         data, address = self.sock_wrapper.recv_from()
         assert address == self.server
         self.init(data)
@@ -97,6 +101,7 @@ class Client:
         logging.debug(f'init data received: {data=}')
         try:
             assert data['cmd'] == 'init'
+            self.protocol = data.get('protocol', JSON)
             self.main_player = self.create_main_player(data['main_player'])
             for player_data in data['players']:
                 self.create_player(player_data)
@@ -153,6 +158,33 @@ class Client:
         elif o2 is not None and isinstance(o2, entities.Projectile):
             o2.kill()
 
+    def handle_snapshot(self, data: dict):
+        """
+        Bring the sprites up to date with a snapshot delta and acknowledge it
+        """
+        received = self.snapshots.receive(data)
+        if received is None:
+            return
+        previous, snapshot = received
+        sprites = {sprite.id: sprite for sprite in self.sprite_groups['entity'].sprites()}
+        for entity_id in previous.keys() - snapshot.keys():
+            entity = sprites.get(entity_id)
+            if entity is not None and entity is not self.main_player:
+                entity.kill()
+        for entity_id, record in snapshot.items():
+            old = previous.get(entity_id)
+            if old == record:
+                continue
+            entity = sprites.get(entity_id)
+            if entity is None:
+                create = self.create_player if record['kind'] == 'player' else self.create_mob
+                create({**record, 'id': entity_id})
+                continue
+            entity.health = record['health']
+            if entity is not self.main_player and (old is None or old['end_pos'] != record['end_pos']):
+                entity.move(*record['end_pos'], send_update=False)
+        self.send_update('ack', {'id': self.main_player.id, 'seq': data['seq']})
+
     def handle_update(self, update: dict):
         cmd = update['cmd']
         player_ids = [player.id for player in self.sprite_groups['players'].sprites()]
@@ -164,6 +196,11 @@ class Client:
         elif cmd == 'collisions':
             for collision_data in update['collisions_data']:
                 self.handle_collision(collision_data)
+        elif cmd == 'projectiles_expired':
+            for projectile_id in update['ids']:
+                projectile = self.get_projectile_by_id(projectile_id)
+                if projectile is not None:
+                    projectile.kill()
         elif cmd == 'item_dropped':
             self.create_dropped(update)
         elif cmd == 'item_picked':
@@ -209,5 +246,7 @@ class Client:
                         logging.debug(f'received updates: {updates=}')
                     for update in updates:
                         self.handle_update(update)
+                elif cmd == 'snapshot':
+                    self.handle_snapshot(data)
             except Exception:
                 logging.exception(f'exception while handling update: {data=}')
@@ -0,0 +1,47 @@
+import logging
+from collections import deque
+from typing import Any, List
+
+from settings import MAX_QUEUED_COMMANDS
+
+
+class CommandQueue:
+    """
+    Hands the commands decoded by the receive thread over to the tick.
+    The receive thread pushes, the tick drains everything pushed so far at its start, so the game state is only
+    touched by the tick's thread. deque's append and popleft are atomic, no lock is needed with one producer and one
+    consumer, and a command pushed while the tick drains is left for the next tick instead of being lost.
+    """
+
+    def __init__(self, max_size: int = MAX_QUEUED_COMMANDS):
+        self.queue = deque()
+        self.max_size = max_size
+        self.pushed = 0
+        self.dropped = 0  # pushed while the queue was full
+        self.drained = 0
+        self.max_batch = 0  # most commands applied by a single tick
+
+    def push(self, command: Any):
+        if len(self.queue) >= self.max_size:
+            self.dropped += 1
+            logging.warning(f'command queue full, command dropped: {command=}')
+            return
+        self.queue.append(command)
+        self.pushed += 1
+
+    def drain(self) -> List[Any]:
+        """
+        :return: the commands pushed until now, oldest first
+        """
+        queue = self.queue
+        commands = [queue.popleft() for _ in range(len(queue))]
+        self.drained += len(commands)
+        self.max_batch = max(self.max_batch, len(commands))
+        return commands
+
+    def __len__(self):
+        return len(self.queue)
+
+    def stats(self) -> dict:
+        return {'pushed': self.pushed, 'dropped': self.dropped, 'drained': self.drained, 'max_batch': self.max_batch,
+                'queued': len(self.queue)}
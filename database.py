@@ -1,9 +1,9 @@
 import hashlib
 import os
 
-from mysql.connector import connect
-
 from my_server import *
+from storage import Storage
+from write_behind import WriteBehindQueue
 
 
 def hash_password(password: str, salt):
@@ -16,120 +16,98 @@ def hash_password(password: str, salt):
     return key
 
 
+def player_row(player) -> dict:
+    """
+    :param player: a Player or a dict of one
+    :return: the columns of the player in the players table
+    """
+    data = player if isinstance(player, dict) else json_encode(player, items=True, todict=True)
+    pos_x, pos_y = data['start_pos']
+    return {'username': data['username'], 'id': data['id'], 'pos_x': int(pos_x), 'pos_y': int(pos_y),
+            'health': data['health'], 'items': json.dumps(data.get('items', {})),
+            'effects': json.dumps(data.get('effects', []))}
+
+
 class DBAPI:
-    def __init__(self, user, password, port):
-        self.connection = connect(
-            host='localhost',
-            user=user,
-            password=password,
-            port=port,
-        )
-        self.cursor = self.connection.cursor()
-        self.create_db()
+    """
+    The accounts and the players, on a Storage. Safe to use from several threads.
+    The players' backups are written behind, see WriteBehindQueue, and read back from the queue until they're written.
+    """
+
+    def __init__(self, storage: Storage, password_hasher: Callable[[str, bytes], bytes] = hash_password):
+        """
+        :param storage: see storage.open_storage
+        :param password_hasher: hash_password, or a function running it somewhere else, see AuthPipeline
+        """
+        self.storage = storage
+        self.password_hasher = password_hasher
+        self.writes = WriteBehindQueue(self.write_players)
         logging.debug('database is running')
 
-    def create_db(self):
-        try:
-            self.cursor.execute('CREATE DATABASE IF NOT EXISTS %s' % DATABASE_NAME)
-            self.cursor.execute('USE %s' % DATABASE_NAME)
-            self.cursor.execute(
-                'CREATE TABLE IF NOT EXISTS users(username VARCHAR(256), hash VARCHAR(256), salt VARCHAR(256))')
-            self.cursor.execute(
-                'CREATE TABLE IF NOT EXISTS players(username VARCHAR(256), player VARCHAR(1024))',
-                {'database': DATABASE_NAME}
-            )
-        except Exception:
-            logging.exception('db exception')
-            self.close()
-
     def store_player(self, player):
-        try:
-            username = player.username if isinstance(player, Player) else player['username']
-            player_data = json_encode(player, items=True)
-            self.cursor.execute("INSERT INTO players VALUES (%(username)s, %(player)s)",
-                                {'username': username, 'player': player_data})
-            self.connection.commit()
-        except Exception:
-            logging.exception('db exception')
-            self.close()
+        self.storage.write_players([player_row(player)])
 
     def update_players(self, players):
-        try:
-            self.cursor.executemany(
-                'UPDATE players SET player = %(player)s WHERE username = %(username)s',
-                [{
-                    'username': player.username if isinstance(player, Player) else player['username'],
-                    'player': json_encode(player)
-                } for player in players]
-            )
-            self.connection.commit()
-        except Exception:
-            logging.exception('db exception')
-            self.close()
+        """
+        Queue the backups of players to be written, the older backups of a player still waiting are dropped
+        """
+        self.writes.put((player.username if isinstance(player, Player) else player['username'], player)
+                        for player in players)
+
+    def write_players(self, players) -> bool:
+        """
+        Write a batch of backups in a transaction, for the write-behind queue
+        """
+        return self.storage.write_players([player_row(player) for player in players])
 
     def retrieve_player(self, username) -> Optional[Player]:
-        try:
-            self.cursor.execute('SELECT player FROM players WHERE username = %(username)s', {'username': username})
-            result = self.cursor.fetchone()
-            if result is None:
+        player_data = self.writes.get(username)
+        if player_data is None:
+            row = self.storage.get_player(username)
+            if row is None:
                 return None
-            player = player_from_dict(json.loads(result[0]))
-            player.health = 100
-            player.end_pos = player.start_pos
-            return player
-        except Exception:
-            logging.exception('db exception')
-            self.close()
+            player_data = {'id': row['id'], 'username': username, 'start_pos': (row['pos_x'], row['pos_y']),
+                           'end_pos': None, 'health': row['health'], 'items': json.loads(row['items']),
+                           'effects': json.loads(row['effects'])}
+        elif isinstance(player_data, Player):
+            player_data = json.loads(json_encode(player_data, items=True))
+        else:
+            player_data = dict(player_data)  # player_from_dict takes it apart
+        player = player_from_dict(player_data)
+        player.health = 100
+        player.end_pos = player.start_pos
+        return player
 
     def delete_player(self, username):
-        try:
-            self.cursor.execute('DELETE FROM players WHERE username = %(username)s', {'username': username})
-            self.connection.commit()
-        except Exception:
-            logging.exception('db exception')
-            self.close()
+        self.storage.delete_player(username)
 
     def verify_account(self, username, password):
-        try:
-            query = "SELECT hash, salt FROM users WHERE username = %(username)s"
-            self.cursor.execute(query, {'username': username})
-            result = self.cursor.fetchone()
-            if result is None:
-                return False
-            hash_, salt = result
-            return hash_password(password, bytes.fromhex(salt)) == bytes.fromhex(hash_)
-        except Exception:
-            logging.exception('db exception')
-            self.close()
-
-    def add_account(self, username, password):
-        try:
-            salt = os.urandom(32)
-            hash_ = hash_password(password, salt)
-            query = "INSERT INTO users (username, hash, salt) VALUES (%s, %s, %s)"
-            self.cursor.execute(query, (username, hash_.hex(), salt.hex()))
-            self.connection.commit()
-        except Exception:
-            logging.exception('db exception')
-            self.close()
+        account = self.storage.get_account(username)
+        if account is None:
+            return False
+        hash_, salt = account
+        return self.password_hasher(password, bytes.fromhex(salt)) == bytes.fromhex(hash_)
+
+    def add_account(self, username, password) -> bool:
+        """
+        :return: whether the account was added, a concurrent sign up may have taken the username
+        """
+        salt = os.urandom(32)
+        hash_ = self.password_hasher(password, salt)
+        return self.storage.add_accounts([(username, hash_.hex(), salt.hex())]) == 1
 
     def remove_account(self, username):
-        try:
-            self.cursor.execute("DELETE FROM users WHERE username = %(username)s", {'username': username})
-            self.connection.commit()
-        except Exception:
-            logging.exception('db exception')
-            self.close()
+        self.storage.remove_account(username)
 
     def check_account_exists(self, username):
-        try:
-            self.cursor.execute('SELECT * FROM USERS WHERE username = %(username)s', {'username': username})
-            result = self.cursor.fetchone()
-            return result is not None
-        except Exception:
-            logging.exception('db exception')
-            self.close()
+        return self.storage.get_account(username) is not None
+
+    def stats(self) -> dict:
+        return self.writes.stats()
 
     def close(self):
-        self.cursor.close()
-        self.connection.close()
+        """
+        Write the backups still waiting and close the storage
+        """
+        self.writes.close()
+        self.storage.close()
@@ -0,0 +1,89 @@
+"""
+64-bit entity ids, unique across the processes of the game without them coordinating: the high bits of an id are the
+prefix of the process which allocated it and the low bits a sequence number of that process. The load balancer
+allocates the ids of new players and their items with PLAYER_ID_PREFIX, every section server the ids of its mobs,
+projectiles and drops with its own prefix, see server_id_prefix.
+"""
+import time
+from collections import deque
+from typing import Optional
+
+from settings import ID_PREFIX_BITS, ID_RECYCLE_DELAY, ID_SEQUENCE_BITS, PLAYER_ID_PREFIX
+
+
+class IdSpaceExhausted(Exception):
+    pass
+
+
+class IdAllocator:
+    """
+    Allocates the ids of one prefix in O(1).
+    Released ids are reused oldest first, once they've been released for recycle_delay seconds, so updates and
+    snapshots still in flight can't be applied to the id's next owner. Otherwise the sequence goes on.
+    The sequence starts at the time in milliseconds, so the ids allocated before a restart of the process (players
+    and their items are stored in the database) are below it as long as it didn't allocate more than an id per
+    millisecond on average.
+    """
+
+    def __init__(self, prefix: int, recycle_delay: float = ID_RECYCLE_DELAY, start: Optional[int] = None):
+        if not 0 <= prefix < 1 << ID_PREFIX_BITS:
+            raise ValueError(f'id prefix out of range: {prefix=}, {ID_PREFIX_BITS=}')
+        self.prefix = prefix
+        self.base = prefix << ID_SEQUENCE_BITS
+        self.next_sequence = start if start is not None else time.time_ns() // 10 ** 6
+        self.recycle_delay = recycle_delay
+        self.released = deque()  # (release time, id), oldest first
+        self.released_ids = set()  # the ids in released, releasing an id twice would hand it out twice
+        self.allocated = 0
+        self.recycled = 0
+
+    def allocate(self) -> int:
+        released = self.released
+        if released and time.monotonic() - released[0][0] >= self.recycle_delay:
+            _, id_ = released.popleft()
+            self.released_ids.remove(id_)
+            self.recycled += 1
+            return id_
+        if self.next_sequence >= 1 << ID_SEQUENCE_BITS:
+            raise IdSpaceExhausted(f'no ids left: {self.prefix=}')
+        id_ = self.base | self.next_sequence
+        self.next_sequence += 1
+        self.allocated += 1
+        return id_
+
+    def release(self, id_: int):
+        """
+        Give back an id nothing refers to anymore, ids of other prefixes and ids already released are ignored
+        """
+        if not self.owns(id_) or id_ in self.released_ids:
+            return
+        self.released.append((time.monotonic(), id_))
+        self.released_ids.add(id_)
+
+    def owns(self, id_: int) -> bool:
+        return id_ >> ID_SEQUENCE_BITS == self.prefix
+
+    def stats(self) -> dict:
+        return {'prefix': self.prefix, 'allocated': self.allocated, 'recycled': self.recycled,
+                'released': len(self.released), 'left': (1 << ID_SEQUENCE_BITS) - self.next_sequence}
+
+
+def server_id_prefix(server_idx: int) -> int:
+    return PLAYER_ID_PREFIX + 1 + server_idx
+
+
+# the allocator of this process, the load balancer's unless the process is a section server, see use_prefix
+allocator = IdAllocator(PLAYER_ID_PREFIX)
+
+
+def use_prefix(prefix: int):
+    global allocator
+    allocator = IdAllocator(prefix)
+
+
+def generate_id() -> int:
+    return allocator.allocate()
+
+
+def release_id(id_: int):
+    allocator.release(id_)
@@ -0,0 +1,82 @@
+from typing import Dict, Hashable, Iterable, List, Optional, Sequence, Set, Tuple
+
+from settings import AOI_RADIUS
+from utils import get_chunk
+
+Chunk = Tuple[int, int]
+
+
+class InterestManager:
+    """
+    Keeps track of the chunks every viewer (client) is interested in.
+    A viewer subscribes to every chunk within `radius` chunks of the chunk it stands in, and only gets the updates
+    that happen in one of those chunks.
+    """
+
+    def __init__(self, radius: int = AOI_RADIUS):
+        self.radius = radius
+        self.subscribers: Dict[Chunk, Set[Hashable]] = {}
+        self.viewer_chunks: Dict[Hashable, Chunk] = {}
+
+    def get_area(self, chunk: Chunk) -> Set[Chunk]:
+        i, j = chunk
+        return {(i + di, j + dj) for di in range(-self.radius, self.radius + 1)
+                for dj in range(-self.radius, self.radius + 1)}
+
+    def get_viewer_area(self, key: Hashable) -> Set[Chunk]:
+        return self.get_area(self.viewer_chunks[key]) if key in self.viewer_chunks else set()
+
+    def update_viewer(self, key: Hashable, pos: Tuple[int, int]) -> Tuple[Set[Chunk], Set[Chunk]]:
+        """
+        Move a viewer's subscriptions to the area around its position
+        :return: the chunks the viewer started and stopped watching
+        """
+        chunk = get_chunk(pos)
+        if self.viewer_chunks.get(key) == chunk:
+            return set(), set()
+        old_area = self.get_viewer_area(key)
+        new_area = self.get_area(chunk)
+        for c in old_area - new_area:
+            self.subscribers[c].discard(key)
+            if not self.subscribers[c]:
+                del self.subscribers[c]
+        for c in new_area - old_area:
+            self.subscribers.setdefault(c, set()).add(key)
+        self.viewer_chunks[key] = chunk
+        return new_area - old_area, old_area - new_area
+
+    def remove_viewer(self, key: Hashable):
+        for c in self.get_viewer_area(key):
+            self.subscribers[c].discard(key)
+            if not self.subscribers[c]:
+                del self.subscribers[c]
+        self.viewer_chunks.pop(key, None)
+
+    def route(self, updates: Sequence[dict], positions: Sequence[Optional[Iterable[Tuple[int, int]]]],
+              viewers: Iterable[Hashable]) -> List[Tuple[List[Hashable], List[dict]]]:
+        """
+        Decide which viewers get which updates
+        :param updates: the updates of this tick
+        :param positions: for every update, where it happens, or None if every viewer should get it
+        :param viewers: all the viewers, those without a position get every update
+        :return: a list of (viewers, updates) groups, the viewers of a group get the same updates so the payload
+                 can be encoded once per group
+        """
+        viewers = list(viewers)
+        indices: Dict[Hashable, List[int]] = {key: [] for key in viewers}
+        unplaced = {key for key in viewers if key not in self.viewer_chunks}
+        for i, update_positions in enumerate(positions):
+            if update_positions is None:
+                recipients = viewers
+            else:
+                recipients = set(unplaced)
+                for pos in update_positions:
+                    recipients |= self.subscribers.get(get_chunk(pos), set())
+            for key in recipients:
+                if key in indices:
+                    indices[key].append(i)
+
+        groups: Dict[Tuple[int, ...], List[Hashable]] = {}
+        for key, update_indices in indices.items():
+            groups.setdefault(tuple(sorted(update_indices)), []).append(key)
+        return [(keys, [updates[i] for i in update_indices]) for update_indices, keys in groups.items()]
@@ -1,10 +1,17 @@
-import os
 import threading
+import time
 
+import async_runtime
+from async_runtime import use_asyncio
+from auth_pipeline import AuthPipeline
+from chunk_balancer import plan_rebalance
 from my_server import json_encode, default_player
+from protocol import JSON, negotiate
+from session_cipher import NonceCache
 from server_chat import *
 from utils import *
 from database import DBAPI
+from storage import Storage, open_storage
 import string
 
 
@@ -29,7 +36,7 @@ def check_valid_username(username: str):
 
 
 class LoadBalancer:
-    def __init__(self, sock: socket.socket, servers, db_username, db_password, db_port):
+    def __init__(self, sock: socket.socket, servers, storage: Storage):
         self.socket = sock
 
         self.servers = servers
@@ -38,14 +45,24 @@ class LoadBalancer:
         self.id_to_pk = {}
         self.id_to_fernet = {}
         self.id_to_address = {}
+        self.id_to_protocol = {}  # the wire protocol negotiated with every client
+        self.id_to_record: Dict[int, dict] = {}  # the stored data of every player, the servers back up their changes
 
         self.lb_private_key = load_private_ecdh_key()
 
         self.chunk_mapping = generate_chunk_mapping()
+        self.mapping_version = 0  # the servers apply newer mappings only
+        self.loads: Dict[int, dict] = {}  # server idx to its latest load report, since the last mapping change
+        self.last_rebalance = time.monotonic()
+        self.reassembler = Reassembler()  # for the servers' fragmented messages
+        self.login_nonces = NonceCache()
         with open("super_secret_do_not_touch.txt", 'rb') as secret_key:
             self.lb_fernet = Fernet(secret_key.read())
+        # the logins run on the auth pipeline's workers, they add the players they admit under the lock
+        self.lock = threading.Lock()
 
-        self.dbapi = DBAPI(user=db_username, password=db_password, port=db_port)
+        self.auth = AuthPipeline(handle_login=self.handle_login, turn_down=self.turn_down)
+        self.dbapi = DBAPI(storage, password_hasher=self.auth.hash_password)
 
     def get_server(self, chunk_idx: Tuple[int, int]):
         return self.servers[self.chunk_mapping[chunk_idx[0]][chunk_idx[1]]]
@@ -57,7 +74,41 @@ class LoadBalancer:
                 fernet = self.id_to_fernet[player_id]
             else:
                 fernet = self.lb_fernet
-        self.socket.sendto(fernet.encrypt(data), address)
+        send_all(self.socket, data, address, fernet)
+
+    def decode_login(self, msg: bytes):
+        """
+        :return: the login message, the client's public key and the cipher of the client, None if the message is stale
+        or a replay
+        """
+        public_key, data = get_pk_and_data(msg)
+        loaded_key = serialization.load_pem_public_key(public_key)
+        fernet = get_cipher(loaded_key, self.lb_private_key, server=True)
+        data = json.loads(fernet.decrypt(data, ttl=FERNET_TTL))
+        # a new cipher has no replay window, the login carries its own freshness
+        if not self.login_nonces.check((serialize_public_key(loaded_key), data.get('nonce')), data.get('time')):
+            return None
+        return data, public_key, fernet
+
+    def handle_login(self, msg: bytes, address):
+        """
+        Called by the workers of the auth pipeline
+        """
+        login = self.decode_login(msg)
+        if login is None:
+            logging.info(f'stale or replayed login dropped: {address=}')
+            return
+        data, public_key, fernet = login
+        logging.debug(f'received data from client: {address=}, {data=}')
+        if data["cmd"] == "connect":
+            self.connect(data=data, address=address, public_key=public_key, fernet=fernet)
+
+    def turn_down(self, msg: bytes, address):
+        login = self.decode_login(msg)
+        if login is None:
+            return
+        _, public_key, fernet = login
+        self.send_cmd('error', {'message': 'server busy, try again later'}, address, fernet=fernet)
 
     def connect(self, data, address, public_key, fernet):
         message = None
@@ -71,22 +122,29 @@ class LoadBalancer:
                 message = 'password too weak'
             elif not check_valid_username(username=data['username']):
                 message = 'invalid username'
+            elif not self.dbapi.add_account(username=data['username'], password=data['password']):
+                message = 'account already exists'
             else:
-                self.dbapi.add_account(username=data['username'], password=data['password'])
                 player = default_player(username=data['username'])
                 self.dbapi.store_player(player)
 
         player = None
         if message is None:
             player = self.dbapi.retrieve_player(data['username'])
-            if player.id in self.id_to_address:
-                message = 'client already connected'
+            with self.lock:
+                if player.id in self.id_to_address:
+                    message = 'client already connected'
+                else:
+                    self.admit(player, data, address, public_key, fernet)
 
         if message is not None:
-            logging.info(f'client connection failed: {data=}, {message=}')
+            logging.info(f'client connection failed: {address=}, {message=}')
             self.send_cmd('error', {'message': message}, address, fernet=fernet)
-            return
 
+    def admit(self, player, data, address, public_key, fernet):
+        """
+        Send a player who logged in to the server of its chunk
+        """
         chunk = get_chunk(player.start_pos)
         server_address = self.get_server(chunk)
 
@@ -94,9 +152,12 @@ class LoadBalancer:
         self.id_to_address[player.id] = address
         self.id_to_fernet[player.id] = fernet
         self.id_to_pk[player.id] = public_key
+        self.id_to_protocol[player.id] = negotiate(data.get('protocols', [JSON]))
+        self.id_to_record[player.id] = dict(json_encode(player, items=True, todict=True))
 
         self.send_cmd(cmd='connect',
-                      params={'player': player, 'client': address, 'client_key': public_key.decode()},
+                      params={'player': player, 'client': address, 'client_key': public_key.decode(),
+                              'protocol': self.id_to_protocol[player.id]},
                       address=server_address, items=True)
 
         self.send_cmd('redirect', {'server': server_address}, address, fernet=fernet)
@@ -104,120 +165,152 @@ class LoadBalancer:
 
     def player_leaves(self, player):
         logging.debug(f'client died or disconnected: {player=}')
-        self.dbapi.delete_player(username=player['username'])
-        self.dbapi.store_player(player)
+        self.dbapi.update_players([player])
 
         del self.id_to_address[player['id']]
         del self.id_to_pk[player['id']]
         del self.id_to_fernet[player['id']]
         del self.id_to_chunk[player['id']]
-
-    def forward_updates(self, data, server_address):
-        updates_by_server_idx = [[] for _ in self.servers]
-
-        for update_idx, chunk_idx in enumerate(data['chunks']):
-            update = data['updates'][update_idx]
-            # redirect clients
-            if update['cmd'] == 'move':
-                new_server = self.get_server(get_chunk(update['pos']))
-                if new_server != server_address:
-                    player_id = update['id']
-                    client_address = self.id_to_address[player_id]
-                    logging.debug(f'client changed server: {client_address=}, {server_address=}, {new_server=}')
-                    self.send_cmd('redirect', {'server': new_server}, client_address, player_id=player_id)
-                    self.send_cmd('add_client', {'client': client_address, 'id': player_id,
-                                                 'client_key': self.id_to_pk[player_id].decode()}, new_server)
-                    self.send_cmd('remove_client', {'client': client_address, 'id': player_id}, server_address)
-                for adj_server_idx in range(len(self.servers)):
-                    if adj_server_idx in get_adj_server_idx(self.chunk_mapping, chunk_idx) or \
-                            adj_server_idx in get_adj_server_idx(self.chunk_mapping, get_chunk(update['pos'])):
-                        updates_by_server_idx[adj_server_idx].append(update_idx)
-            # remove client internally
-            else:
-                if update['cmd'] == 'disconnect':
-                    update['cmd'] = 'player_leaves'
-                    player = update.pop('player')
-                    self.player_leaves(player)
-                if update['cmd'] == 'entity_died' and update['id'] in self.id_to_address:  # if player died
-                    player = update.pop('player')
-                    self.player_leaves(player)
-
-                for adj_server_idx in get_adj_server_idx(chunk_mapping=self.chunk_mapping, chunk_idx=chunk_idx):
-                    updates_by_server_idx[adj_server_idx].append(update_idx)
-
-        for move_data in data['moving_players']:
-            start_chunk, end_chunk, player = move_data['start_chunk'], move_data['end_chunk'], move_data['player']
-            adj_start = get_adj_server_idx(self.chunk_mapping, start_chunk)
-            adj_end = get_adj_server_idx(self.chunk_mapping, end_chunk)
-            data['updates'].append({
-                'cmd': 'player_enters', 'player': player
-            })
-            data['updates'].append({
-                'cmd': 'player_leaves', 'id': player['id']
-            })
-            for server_idx in adj_end:
-                if server_idx not in adj_start:
-                    # player enters server
-                    updates_by_server_idx[server_idx].insert(0, len(data['updates']) - 2)
-            for server_idx in adj_start:
-                if server_idx not in adj_end:
-                    # player leaves server
-                    updates_by_server_idx[server_idx].append(len(data['updates']) - 1)
-
-        logging.debug(f'sent updates: {updates_by_server_idx=}')
-        for i, updates_idx in enumerate(updates_by_server_idx):
-            server_address = self.servers[i]
-            if updates_idx:
-                self.send_cmd('update', {'updates': [data['updates'][update] for update in updates_idx]}, server_address)
+        self.id_to_protocol.pop(player['id'], None)
+        self.id_to_record.pop(player['id'], None)
+
+    def change_server(self, data, server_address):
+        """
+        Redirect the client of a player who moved into the section of another server, the servers replicate the
+        player's moves between themselves
+        """
+        player_id = data['id']
+        if player_id not in self.id_to_address:
+            return
+        new_server = self.servers[data['to']]
+        client_address = self.id_to_address[player_id]
+        logging.debug(f'client changed server: {client_address=}, {server_address=}, {new_server=}')
+        self.send_cmd('redirect', {'server': new_server}, client_address, player_id=player_id)
+        self.send_cmd('add_client', {'client': client_address, 'id': player_id,
+                                     'client_key': self.id_to_pk[player_id].decode(),
+                                     'protocol': self.id_to_protocol[player_id]}, new_server)
+        self.send_cmd('remove_client', {'client': client_address, 'id': player_id}, server_address)
+
+    def load_report(self, data, address):
+        server_idx = self.servers.index(address)
+        if data['version'] != self.mapping_version:
+            # the mapping message was lost, the report is of the old mapping
+            self.send_cmd('chunk_mapping', {'mapping': self.chunk_mapping, 'version': self.mapping_version}, address)
+            return
+        self.loads[server_idx] = data
+        self.rebalance()
+
+    def rebalance(self):
+        """
+        Move chunks from the busiest server to a less busy neighbour when the servers' loads are skewed, at most
+        every REBALANCE_INTERVAL seconds and once every server reported its load under the current mapping
+        """
+        if len(self.loads) < len(self.servers) or time.monotonic() - self.last_rebalance < REBALANCE_INTERVAL:
+            return
+        server_loads = [self.loads[i]['tick_time'] / UPDATE_TICK for i in range(len(self.servers))]
+        chunk_loads = {(i, j): load for report in self.loads.values() for i, j, load in report['chunks']}
+        moves = plan_rebalance(self.chunk_mapping, server_loads, chunk_loads)
+        if not moves:
+            return
+        logging.info(f'rebalancing: {server_loads=}, {moves=}')
+        for (i, j), server_idx in moves:
+            self.chunk_mapping[i][j] = server_idx
+        self.mapping_version += 1
+        self.last_rebalance = time.monotonic()
+        self.loads.clear()
+        for server_address in self.servers:
+            self.send_cmd('chunk_mapping', {'mapping': self.chunk_mapping, 'version': self.mapping_version},
+                          server_address)
+
+    def migrate(self, data, address):
+        """
+        Hand the entities of chunks a server lost to their new server, and redirect the clients of the players among
+        them, like clients crossing the border of a section
+        """
+        new_server = self.servers[data['to']]
+        clients = []
+        for player in data['players']:
+            player_id = player['id']
+            if player_id in self.id_to_address:
+                clients.append({'client': self.id_to_address[player_id], 'id': player_id,
+                                'client_key': self.id_to_pk[player_id].decode(),
+                                'protocol': self.id_to_protocol[player_id]})
+        self.send_cmd('adopt', {'mobs': data['mobs'], 'dropped': data['dropped'], 'players': data['players'],
+                                'clients': clients}, new_server)
+        for client in clients:
+            logging.debug(f'client migrated: {client=}, {address=}, {new_server=}')
+            self.send_cmd('redirect', {'server': new_server}, client['client'], player_id=client['id'])
+            self.send_cmd('remove_client', {'client': client['client'], 'id': client['id']}, address)
 
     def backup(self, data, address):
+        """
+        Apply the changed fields of the players of a server to their records, and store the records that changed
+        """
         logging.debug(f'backing up data: {address=}, {data=}')
-        self.dbapi.update_players(data['players'].values())
+        records = []
+        for fields in data['players']:
+            record = self.id_to_record.get(fields['id'])
+            if record is not None:  # unless the player left meanwhile, it was stored when it did
+                record.update(fields)
+                records.append(dict(record))  # the write-behind queue writes it on another thread
+        self.dbapi.update_players(records)
+        self.send_cmd('backup_ack', {'seq': data['seq']}, address)
 
     def receive_packets(self):
         while True:
             try:
-                msg, address = self.socket.recvfrom(1024)
-
-                if address in self.servers:
-                    data = json.loads(self.lb_fernet.decrypt(msg, ttl=FERNET_TTL))
-                    logging.debug(f'received data from server: {data=}, {address=}')
-                    if data['cmd'] == 'forward_updates':
-                        self.forward_updates(data, address)
-                    if data['cmd'] == 'backups':
-                        self.backup(data, address)
-                else:
-                    if msg.startswith(b'-----BEGIN PUBLIC KEY-----'):
-
-                        public_key, data = get_pk_and_data(msg)
-
-                        loaded_key = serialization.load_pem_public_key(public_key)
-                        fernet = get_fernet(loaded_key, self.lb_private_key)
-
-                        data = fernet.decrypt(data, ttl=FERNET_TTL)
-                        data = json.loads(data)
-                        logging.debug(f'received data from client: {address=}, {data=}')
-
-                        if data["cmd"] == "connect":
-                            self.connect(data=data, address=address, public_key=public_key, fernet=fernet)
-
+                msg, address = self.socket.recvfrom(MTU)
+            except ConnectionResetError:
+                continue
+            try:
+                self.handle_datagram(msg, address)
             except Exception:
                 logging.exception('exception while handling request')
 
+    def handle_datagram(self, msg: bytes, address):
+        if address in self.servers:
+            msg = self.reassembler.add(msg, address)
+            if msg is None:
+                return
+            data = json.loads(self.lb_fernet.decrypt(msg, ttl=FERNET_TTL))
+            logging.debug(f'received data from server: {data=}, {address=}')
+            with self.lock:
+                if data['cmd'] == 'change_server':
+                    self.change_server(data, address)
+                if data['cmd'] == 'player_leaves':
+                    self.player_leaves(data['player'])
+                if data['cmd'] == 'backups':
+                    self.backup(data, address)
+                if data['cmd'] == 'load':
+                    self.load_report(data, address)
+                if data['cmd'] == 'migrate':
+                    self.migrate(data, address)
+        else:
+            if msg.startswith(b'-----BEGIN PUBLIC KEY-----'):
+                # the key exchange, the password hash and the queries of a login take long, the workers run them
+                self.auth.submit(msg, address)
+
 
 def main():
     logging.basicConfig(level=LOGLEVEL)
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock.bind(LB_ADDRESS)
 
-    lb = LoadBalancer(servers=SERVER_ADDRESSES, sock=sock, db_username=os.environ['MYSQL_USER'],
-                      db_password=os.environ['MYSQL_PASSWORD'], db_port=os.environ['MYSQL_PORT'])
+    lb = LoadBalancer(servers=SERVER_ADDRESSES, sock=sock, storage=open_storage(DB_BACKEND))
+
+    try:
+        if use_asyncio(RUNTIME):
+            async_runtime.run(sock, lb.handle_datagram, chat=AsyncChatServer())
+            return
 
-    # setting up chat
-    server_chat = ChatServer()
-    threading.Thread(target=server_chat.start).start()
+        # setting up chat
+        server_chat = ChatServer()
+        threading.Thread(target=server_chat.start).start()
 
-    lb.receive_packets()
+        lb.receive_packets()
+    finally:
+        lb.auth.close()
+        lb.dbapi.close()
 
 
 if __name__ == '__main__':
@@ -2,18 +2,32 @@ import math
 import random
 import time
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
+from dataclasses import dataclass, field, fields
+from functools import partial
 from os import path
-from typing import List, Optional
+from typing import Callable, Hashable, Iterable, Iterator, List, Optional, Set
 
 import pygame as pg
-from scipy.spatial import KDTree
 
+import async_runtime
 import settings
 from Tilemap import TiledMap
 from server_chat import *
+from async_runtime import use_asyncio
+from batch_io import BatchSocket
+from command_queue import CommandQueue
+from id_allocator import generate_id, release_id
+from interest import InterestManager
+from protocol import JSON, decode as protocol_decode, encode as protocol_encode, negotiate
+from replication import Snapshot, SnapshotReplicator
+from spatial import SpatialHash, StaticIndex, time_of_impact
+from tick_scheduler import TickScheduler
+from timing_wheel import TimingWheel
+from world_store import PROJECTILE, WorldStore
 from utils import *
 
+MOB_MOVE, MOB_ATTACK = 'move', 'attack'  # the timers of every mob
+
 
 def default_player(username):
     items = {str(generate_id()): "speed_pot", str(generate_id()): "heal_pot", str(generate_id()): "strength_pot"}
@@ -72,6 +86,26 @@ def collision_align(pos_before1: tuple, pos_after1: tuple, size1: tuple, pos_bef
     return after1.topleft, after2.topleft
 
 
+def collision_outcome(pos1: tuple, after1: tuple, size1: tuple, pos2: tuple, after2: tuple, size2: tuple,
+                      damage1: int = 0, damage2: int = 0) -> Optional[tuple]:
+    """
+    What happens to two hitboxes close to each other, they're aligned so they don't overlap after moving, and
+    damaged if they touch
+    :param after1: the position of the first hitbox 10 game ticks later
+    :param damage1: the damage the first hitbox takes if they touch
+    :return: (aligned1, aligned2, damage1, damage2), aligned positions are None if unchanged, None if nothing happens
+    """
+    aligned1, aligned2 = collision_align(pos_before1=pos1, pos_before2=pos2, pos_after1=after1, pos_after2=after2,
+                                         size1=size1, size2=size2)
+    aligned1 = aligned1 if tuple(aligned1) != tuple(after1) else None
+    aligned2 = aligned2 if tuple(aligned2) != tuple(after2) else None
+    if dist(pos1, pos2) >= 50:
+        damage1 = damage2 = 0
+    if aligned1 is None and aligned2 is None and damage1 <= 0 and damage2 <= 0:
+        return None
+    return aligned1, aligned2, damage1, damage2
+
+
 def player_from_dict(data: dict):
     if 'effects' in data:
         effects = [Effect(duration=e['duration'], t0=time.time_ns(), type=e['type']) for e in data.pop('effects')]
@@ -88,34 +122,123 @@ def player_from_dict(data: dict):
     return p
 
 
-def json_encode(player, items=False, cooldowns=False, effects=False, todict=False):
-    class MyJSONEncoder(json.JSONEncoder):
-        def default(self, o):
-            if isinstance(o, MovingObject):
-                t = time.time_ns()
+def mob_from_dict(data: dict):
+    return Mob(**data, t0=time.time_ns())
+
+
+class Serializer:
+    """
+    Converts the server's objects to JSON compatible dicts.
+    The converter of every type is picked once and reused. Objects converted at the current tick's time (see
+    Server.begin_tick) are cached until the next tick, so the init, get_data, update and backup messages of a tick
+    convert every object once.
+    """
+    PRIVATE_FIELDS = ['t0', 'spatial_hash', 'world_store', 'dirty']
+
+    def __init__(self):
+        self.converters: Dict[type, Callable] = {}
+        self.tick_t: Optional[int] = None
+        # id of an object to the object and its conversions by (items, cooldowns, effects)
+        self.cache: Dict[int, Tuple[Any, Dict[Tuple[bool, bool, bool], dict]]] = {}
+
+    def begin_tick(self, t: int):
+        self.tick_t = t
+        self.cache = {}
+
+    def forget(self, o):
+        """
+        Drop the conversions of an object changed since they were made this tick
+        """
+        self.cache.pop(id(o), None)
+
+    def get_converter(self, cls: type) -> Callable:
+        converter = self.converters.get(cls)
+        if converter is None:
+            converter = self.converters[cls] = self.build_converter(cls)
+        return converter
+
+    def build_converter(self, cls: type) -> Callable:
+        if issubclass(cls, MovingObject):
+            is_player = issubclass(cls, Player)
+            hidden = [f.name for f in fields(cls) if f.name in self.PRIVATE_FIELDS]
+
+            def convert(o, t, items, cooldowns, effects):
                 data = o.__dict__.copy()
-                del data['t0']
+                for name in hidden:
+                    data.pop(name, None)  # the defaults of the fields the object never set are the class's
                 data['start_pos'] = o.get_pos(t)
-                if isinstance(o, Player):
-                    if not items:
-                        del data['items']
-                    if not effects:
-                        del data['effects']
-                    if not cooldowns:
-                        del data['cooldowns']
+                if is_player:
+                    del data['items'], data['effects'], data['cooldowns']
+                    if items:
+                        data['items'] = dict(o.items)
+                    if effects:
+                        data['effects'] = [self.to_dict(effect, t) for effect in o.effects]
+                    if cooldowns:
+                        data['cooldowns'] = {action: self.to_dict(c, t) for action, c in o.cooldowns.items()}
                 return data
-            if isinstance(o, Dropped):
-                return o.__dict__.copy()
-            if isinstance(o, Cooldown):
+        elif issubclass(cls, Cooldown):
+            def convert(o, t, items, cooldowns, effects):
                 data = o.__dict__.copy()
-                data['duration'] -= time.time_ns() - data.pop('t0')
+                data['duration'] -= t - data.pop('t0')  # what's left of it
                 return data
-            return super(MyJSONEncoder, self).default(o)
-
-    data = json.dumps(player, cls=MyJSONEncoder).encode()
+        elif issubclass(cls, Dropped):
+            def convert(o, t, items, cooldowns, effects):
+                return o.__dict__.copy()
+        else:
+            raise TypeError(f'Object of type {cls.__name__} is not JSON serializable')
+        return convert
+
+    def to_dict(self, o, t: int = None, items=False, cooldowns=False, effects=False) -> dict:
+        """
+        :param o: a moving object, dropped item or cooldown
+        :param t: time in ns to convert the object at, now if not given
+        :return: a dict which must not be changed, it may be shared with other callers
+        """
+        converter = self.converters.get(type(o)) or self.get_converter(type(o))
+        if t is None or t != self.tick_t:
+            return converter(o, t if t is not None else time.time_ns(), items, cooldowns, effects)
+        cached = self.cache.get(id(o))
+        if cached is None:
+            # the object is kept in the entry so its id can't be reused while cached
+            cached = self.cache[id(o)] = o, {}
+        key = items, cooldowns, effects
+        data = cached[1].get(key)
+        if data is None:
+            data = cached[1][key] = converter(o, t, items, cooldowns, effects)
+        return data
+
+
+serializer = Serializer()
+
+
+def serialize_object(o, items=False, cooldowns=False, effects=False, t: int = None) -> dict:
+    """
+    Convert one of the server's objects to a JSON compatible dict, the default of the message encoders
+    """
+    return serializer.to_dict(o, t, items=items, cooldowns=cooldowns, effects=effects)
+
+
+def json_encode(player, items=False, cooldowns=False, effects=False, todict=False, t: int = None):
+    """
+    :param player: an object or a JSON compatible structure containing objects
+    :param t: time in ns to convert the objects at, pass the tick's time to share the conversions of the tick
+    :param todict: return a dict instead of bytes, only for a single object
+    """
     if todict:
-        return json.loads(data)
-    return data
+        return serializer.to_dict(player, t, items=items, cooldowns=cooldowns, effects=effects)
+    if t is None:
+        t = time.time_ns()  # all the objects of the message are converted at the same time
+    return json.dumps(player, default=partial(serializer.to_dict, t=t, items=items, cooldowns=cooldowns,
+                                              effects=effects)).encode()
+
+
+def wire_encode(message: dict, protocol: str = JSON, t: int = None) -> bytes:
+    """
+    Encode a message for a client with the protocol negotiated with it
+    """
+    if protocol == JSON:
+        return json_encode(message, t=t)
+    return protocol_encode(message, protocol, default=partial(serialize_object, t=t))
 
 
 @dataclass
@@ -124,6 +247,12 @@ class Dropped:
     item_type: str
     pos: Tuple[int, int]
 
+    def get_pos(self, t=None):
+        return self.pos
+
+    def get_bounds(self):
+        return self.pos[0], self.pos[1], self.pos[0], self.pos[1]
+
 
 class Hitbox(ABC):
     @abstractmethod
@@ -156,6 +285,8 @@ class MovingObject(Hitbox):
     id: Optional[int]
     start_pos: Tuple[int, int]
     t0: int
+    # the server's array-backed store, set while the object has a row in it
+    world_store: Optional[WorldStore] = field(default=None, init=False, repr=False, compare=False)
 
     def __post_init__(self):
         if self.id is None:
@@ -170,6 +301,8 @@ class MovingObject(Hitbox):
 class Entity(MovingObject, ABC):
     end_pos: Optional[Tuple[int, int]]
     health: int
+    # the server's spatial hash, set while the entity is tracked by it
+    spatial_hash: Optional[SpatialHash] = field(default=None, init=False, repr=False, compare=False)
 
     def __post_init__(self):
         super(Entity, self).__post_init__()
@@ -181,8 +314,33 @@ class Entity(MovingObject, ABC):
         curr_pos = self.get_pos(t)
         self.start_pos, self.end_pos = curr_pos, pos
         self.t0 = t
+        if self.spatial_hash is not None:
+            self.spatial_hash.update(self)
+        if self.world_store is not None:
+            self.world_store.sync(self)
+
+    def get_bounds(self):
+        """
+        The box containing every position of the entity until its next move
+        """
+        size = self.get_size()
+        return (min(self.start_pos[0], self.end_pos[0]), min(self.start_pos[1], self.end_pos[1]),
+                max(self.start_pos[0], self.end_pos[0]) + size[0], max(self.start_pos[1], self.end_pos[1]) + size[1])
+
+    def get_arrival_t(self) -> float:
+        """
+        :return: the time in ns at which the entity reaches end_pos, t0 if it stands still
+        """
+        dist = ((self.end_pos[0] - self.start_pos[0]) ** 2 + (self.end_pos[1] - self.start_pos[1]) ** 2) ** 0.5
+        if dist == 0:
+            return self.t0
+        return self.t0 + dist / (self.get_speed() / game_ticks_to_ns(1))
 
     def get_pos(self, t: int = None):
+        if t is not None and self.world_store is not None:
+            pos = self.world_store.get_cached_pos(self, t)
+            if pos is not None:
+                return pos
         t = t if t is not None else time.time_ns()
         dist = ((self.end_pos[0] - self.start_pos[0]) ** 2 + (self.end_pos[1] - self.start_pos[1]) ** 2) ** 0.5
         if dist == 0:
@@ -211,15 +369,49 @@ class Effect(Cooldown):
     type: str
 
 
+PERSISTED_FIELDS = ('start_pos', 'health', 'items', 'effects')  # the fields of a player's backups
+# the attributes of a player which change a persisted field when they're set, the position is the one it settles at
+PERSISTED_ATTRIBUTES = {'end_pos': 'start_pos', 'health': 'health', 'items': 'items', 'effects': 'effects'}
+
+
 @dataclass
 class Player(Entity):
     username: str
     items: Dict[str, str]  # ids are numbers converted to strings, e.g "123"
     effects: List[Effect]
     cooldowns: Dict[str, Cooldown]  # action to duration (ns)
+    # the persisted fields changed since the last backup, everything until the first one, see BackupTracker
+    dirty: Set[str] = field(default_factory=lambda: set(PERSISTED_FIELDS), init=False, repr=False, compare=False)
+
+    def __setattr__(self, name, value):
+        # items and effects are changed in place, their changes are marked by mark_dirty
+        if name in PERSISTED_ATTRIBUTES and 'dirty' in self.__dict__:
+            self.dirty.add(PERSISTED_ATTRIBUTES[name])
+        super().__setattr__(name, value)
+
+    def mark_dirty(self, *fields: str):
+        self.dirty.update(fields)
+
+    def backup(self, fields: Iterable[str], t: int = None) -> dict:
+        """
+        :param fields: some of PERSISTED_FIELDS
+        :return: the id, the username and the given fields of the player
+        """
+        record = {'id': self.id, 'username': self.username}
+        for name in fields:
+            if name == 'start_pos':
+                record[name] = list(self.end_pos)
+            elif name == 'health':
+                record[name] = self.health
+            elif name == 'items':
+                record[name] = dict(self.items)
+            elif name == 'effects':
+                record[name] = [serializer.to_dict(effect, t) for effect in self.effects]
+        return record
 
     def use_item(self, item_id: str):
         item_type = self.items.pop(item_id)
+        self.mark_dirty('items')
         if item_type == 'heal_pot':
             if self.health < 80:
                 self.health += 20
@@ -227,11 +419,13 @@ class Player(Entity):
                 self.health = 100
         else:
             self.effects.append(Effect(type=item_type, t0=time.time_ns(), duration=game_ticks_to_ns(1000)))
+            self.mark_dirty('effects')
 
     def check_effects(self):
         for effect in self.effects[:]:
             if effect.is_over():
                 self.effects.remove(effect)
+                self.mark_dirty('effects')
 
     def get_damage(self):
         self.check_effects()
@@ -256,8 +450,14 @@ class Projectile(MovingObject):
     attacker_id: int
 
     def get_pos(self, t: int = None):
+        if t is not None and self.world_store is not None:
+            pos = self.world_store.get_cached_pos(self, t)
+            if pos is not None:
+                return pos
         t = t if t is not None else time.time_ns()
         dist = (self.target[0] ** 2 + self.target[1] ** 2) ** 0.5
+        if dist == 0:
+            return self.start_pos
         norm_speed = self.get_speed() / game_ticks_to_ns(1)
         total_time = dist / norm_speed
         p = (t - self.t0) / total_time
@@ -272,6 +472,32 @@ class Projectile(MovingObject):
     def get_size(self):
         return PROJECTILE_SIZE
 
+    def get_expiry_t(self) -> int:
+        """
+        The time (ns) at which the projectile has either flown PROJECTILE_RANGE or left the map
+        """
+        length = (self.target[0] ** 2 + self.target[1] ** 2) ** 0.5
+        if length == 0:
+            return self.t0
+        norm_speed = self.get_speed() / game_ticks_to_ns(1)
+        distance = settings.PROJECTILE_RANGE
+        for axis in range(2):
+            direction = self.target[axis] / length
+            if direction > 0:
+                distance = min(distance, (settings.MAP_SIZE[axis] - self.start_pos[axis]) / direction)
+            elif direction < 0:
+                distance = min(distance, -self.start_pos[axis] / direction)
+        return self.t0 + round(max(distance, 0) / norm_speed)
+
+    def get_path(self, step: int = CHUNK_SIZE) -> List[Tuple[int, int]]:
+        """
+        Positions along the whole flight of the projectile, at most step pixels apart
+        """
+        t_end = self.get_expiry_t()
+        flown = self.get_speed() / game_ticks_to_ns(1) * (t_end - self.t0)
+        samples = max(1, math.ceil(flown / step))
+        return [self.get_pos(self.t0 + (t_end - self.t0) * i // samples) for i in range(samples + 1)]
+
 
 @dataclass
 class Mob(Entity):
@@ -287,16 +513,6 @@ class Mob(Entity):
         return 20
 
 
-def generate_id(max_n=100000):
-    id_ = random.randint(1, max_n)
-    while id_ in generate_id.ids:
-        id_ = random.randint(1, max_n)
-    return id_
-
-
-generate_id.ids = set()
-
-
 def random_drop_pos(pos):
     return pos[0] + random.randint(-50, 50), pos[1] + random.randint(-100, 100)
 
@@ -304,7 +520,13 @@ def random_drop_pos(pos):
 class Server:
     def __init__(self, sock: socket.socket):
         self.socket = sock
+        self.io = BatchSocket(sock)  # receives the clients' datagrams in batches
+        self.commands = CommandQueue()  # decoded by the receive thread, handled by the tick
         self.clients = set()
+        self.client_players: Dict[Address, int] = {}  # client address to its player id
+        self.client_protocols: Dict[Hashable, str] = {}  # client key to its wire protocol, JSON if missing
+        self.interest = InterestManager()  # the chunks every client gets updates from
+        self.replicator = SnapshotReplicator()
 
         self.players: Dict[int, Player] = {}
         self.mobs: Dict[int, Mob] = {}
@@ -314,11 +536,22 @@ class Server:
         self.dropped: Dict[str, Dropped] = {}
         self.updates = []
         self.attacking_entities: List[int] = []  # attacking entity ids
+        self.spatial_hash = SpatialHash(indexed_classes=(Player,))  # players, mobs and dropped items
+        self.last_collisions_t: Optional[int] = None
+        self.tick_t: Optional[int] = None  # when the current tick started
+        self.projectile_expiry = TimingWheel(current_tick=self.ns_to_wheel_tick(time.time_ns()))
+        # (mob id, MOB_MOVE or MOB_ATTACK) timers, enough slots for most moves to be due within one turn
+        self.mob_timers = TimingWheel(slots=256, current_tick=self.ns_to_wheel_tick(time.time_ns()))
+        # players, mobs and projectiles, their positions are computed once per tick
+        self.world_store = WorldStore(game_ticks_to_ns(1)) if settings.ENABLE_WORLD_STORE else None
+        self.shards = None  # a shard.ShardPool finding the collisions of the entities in worker processes
 
         map_folder = 'maps'
         self.map = TiledMap(path.join(map_folder, 'map_new.tmx'))
         for wall in self.map.get_objects(apply_func=lambda x: x):
             self.walls.append(Wall(size=wall[1], pos=wall[0]))
+        # walls never move, so their index is built once instead of every tick
+        self.wall_index = StaticIndex(self.walls)
 
         logging.debug(f'server listening at: {self.socket.getsockname()}')
 
@@ -329,7 +562,92 @@ class Server:
                                random.randint(0, settings.MAP_SIZE[1] - 1)),
                     end_pos=None,
                     health=100, t0=0, type=random.choice(['dragon', 'demon']))
-            self.mobs[m.id] = m
+            self.add_entity(m)
+
+    def add_entity(self, entity: Entity):
+        entities = self.players if isinstance(entity, Player) else self.mobs
+        if entity.id in entities:
+            self.remove_entity(entities[entity.id])
+        entities[entity.id] = entity
+        entity.spatial_hash = self.spatial_hash
+        self.spatial_hash.insert(entity)
+        if self.world_store is not None:
+            entity.world_store = self.world_store
+            self.world_store.add(entity, variable_speed=isinstance(entity, Player))
+        if isinstance(entity, Mob):
+            self.schedule_mob(entity.id, MOB_MOVE, random.uniform(0, settings.MOB_MOVE_INTERVAL))
+
+    def remove_entity(self, entity: Entity):
+        entities = self.players if isinstance(entity, Player) else self.mobs
+        if entities.get(entity.id) is entity:
+            del entities[entity.id]
+        self.spatial_hash.remove(entity)
+        entity.spatial_hash = None
+        if self.world_store is not None:
+            self.world_store.remove(entity)
+            entity.world_store = None
+        if isinstance(entity, Mob):
+            self.mob_timers.cancel((entity.id, MOB_MOVE))
+            self.mob_timers.cancel((entity.id, MOB_ATTACK))
+
+    def entity_moved(self, entity: Entity):
+        """
+        Re-index an entity whose movement fields were changed without Entity.move
+        """
+        self.spatial_hash.update(entity)
+        if self.world_store is not None:
+            self.world_store.sync(entity)
+
+    @staticmethod
+    def ns_to_wheel_tick(t: int) -> int:
+        return int(t // (settings.UPDATE_TICK * 10 ** 9))
+
+    def add_projectile(self, projectile: Projectile):
+        self.projectiles[projectile.id] = projectile
+        self.projectile_expiry.schedule(projectile.id, self.ns_to_wheel_tick(projectile.get_expiry_t()) + 1)
+        if self.world_store is not None:
+            projectile.world_store = self.world_store
+            self.world_store.add(projectile, kind=PROJECTILE)
+
+    def remove_projectile(self, projectile_id: int):
+        projectile = self.projectiles.pop(projectile_id)
+        self.projectile_expiry.cancel(projectile_id)
+        release_id(projectile_id)
+        if self.world_store is not None:
+            self.world_store.remove(projectile)
+            projectile.world_store = None
+
+    def expire_projectiles(self, t: int):
+        """
+        Remove the projectiles that flew their whole range or left the map, and let the clients know in one update
+        """
+        expired = self.projectile_expiry.advance(self.ns_to_wheel_tick(t))
+        for projectile_id in expired:
+            self.remove_projectile(projectile_id)
+        if expired:
+            self.updates.append({'cmd': 'projectiles_expired', 'ids': expired})
+
+    def evaluate_positions(self, t: int):
+        """
+        Compute the positions of every moving object at time t in one batch, get_pos(t) calls then read them
+        """
+        if self.world_store is not None and self.world_store.evaluated_t != t:
+            self.world_store.evaluate(t)
+
+    def begin_tick(self):
+        """
+        Start a tick, objects serialized at tick_t during it are converted once
+        """
+        self.tick_t = time.time_ns()
+        self.evaluate_positions(self.tick_t)
+        serializer.begin_tick(self.tick_t)
+
+    def add_dropped(self, dropped: Dropped):
+        self.dropped[dropped.item_id] = dropped
+        self.spatial_hash.insert(dropped)
+
+    def remove_dropped(self, item_id: str):
+        self.spatial_hash.remove(self.dropped.pop(item_id))
 
     def mob_move(self, mob: Mob):
         if mob.type == 'dragon':
@@ -337,9 +655,9 @@ class Server:
             mob.move(pos=(pos[0] + random.randint(-500, 500), pos[1] + random.randint(-500, 500)))
             self.updates.append({'cmd': 'move', 'pos': mob.end_pos, 'id': mob.id})
         elif mob.type == 'demon':
-            player = self.players[random.choice(self.players)]
-            player_pos = player.get_pos()
-            if dist(player_pos, mob.get_pos()) < 100:
+            player = self.spatial_hash.nearest(mob.get_pos(), 100, cls=Player)
+            if player is not None:
+                player_pos = player.get_pos()
                 mob.move(pos=player_pos)
                 self.updates.append({'cmd': 'move', 'pos': player_pos, 'id': mob.id})
 
@@ -349,45 +667,87 @@ class Server:
             target = player_pos[0] - mob_pos[0], player_pos[1] - mob_pos[1]
             proj = Projectile(id=None, start_pos=mob_pos, target=target, type='axe', attacker_id=mob.id,
                               t0=time.time_ns())
-            self.projectiles[proj.id] = proj
+            self.add_projectile(proj)
             self.updates.append({'cmd': 'projectile', 'projectile': proj, 'id': mob.id})
         elif mob.type == 'demon':
             self.updates.append({'cmd': 'attack', 'id': mob.id})
             self.attacking_entities.append(mob.id)
 
+    def current_wheel_tick(self) -> int:
+        return self.ns_to_wheel_tick(self.tick_t if self.tick_t is not None else time.time_ns())
+
+    def schedule_mob(self, mob_id: int, action: str, delay: float):
+        """
+        :param action: MOB_MOVE or MOB_ATTACK
+        :param delay: in seconds
+        """
+        ticks = max(1, round(delay / settings.UPDATE_TICK))
+        self.mob_timers.schedule((mob_id, action), self.current_wheel_tick() + ticks)
+
     def update_mobs(self):
-        for _ in range(math.ceil(0.01 * len(self.mobs))):
-            self.mob_move(random.choice(list(self.mobs.values())))
+        """
+        Run the mobs whose timers are due.
+        Every mob moves every MOB_MOVE_INTERVAL seconds on average. Mobs attack the nearest player every
+        MOB_ATTACK_INTERVAL seconds while one is within MOB_ATTACK_RADIUS, other mobs have no attack timer until a
+        player comes close (wake_mobs), so mobs away from players cost nothing but their moves.
+        """
         if self.players and not settings.PEACEFUL_MODE:
-            for _ in range(math.ceil(0.1 * len(self.mobs))):
-                m = random.choice(list(self.mobs.values()))
-                player = random.choice(list(self.players.values()))
-                if dist(player.get_pos(), m.get_pos()) < 500:
-                    self.mob_attack(mob=m, player=player)
+            self.wake_mobs()
+        for mob_id, action in self.mob_timers.advance(self.current_wheel_tick()):
+            mob = self.mobs.get(mob_id)
+            if mob is None:
+                continue
+            if action == MOB_MOVE:
+                self.mob_move(mob)
+                self.schedule_mob(mob_id, MOB_MOVE, settings.MOB_MOVE_INTERVAL * random.uniform(0.5, 1.5))
+                continue
+            if settings.PEACEFUL_MODE:
+                continue
+            player = self.spatial_hash.nearest(mob.get_pos(), settings.MOB_ATTACK_RADIUS, cls=Player)
+            if player is not None:
+                self.mob_attack(mob=mob, player=player)
+                self.schedule_mob(mob_id, MOB_ATTACK, settings.MOB_ATTACK_INTERVAL * random.uniform(0.5, 1.5))
+
+    def wake_mobs(self):
+        """
+        Give the mobs close to players an attack timer
+        """
+        for player in self.players.values():
+            for mob in self.spatial_hash.query_radius(player.get_pos(), settings.MOB_ATTACK_RADIUS, cls=Mob):
+                if (mob.id, MOB_ATTACK) not in self.mob_timers:
+                    self.schedule_mob(mob.id, MOB_ATTACK, random.uniform(0, settings.MOB_ATTACK_INTERVAL))
 
     def connect(self, data, address):
         player = default_player(data['username'])
         self.updates.append({'cmd': 'player_enters', 'player': player})
+        protocol = negotiate(data.get('protocols', [JSON]))
 
         data = {
             'cmd': 'init',
+            'protocol': protocol,
             'main_player': json_encode(player, items=True, todict=True),
             'players': list(self.players.values()),
             'mobs': list(self.mobs.values()),
             'projectiles': list(self.projectiles.values()),
             'dropped': list(self.dropped.values())
         }
-        send_all(self.socket, json_encode(data), address)
+        send_all(self.socket, json_encode(data, t=self.tick_t), address)
 
         self.clients.add(address)
-        self.players[player.id] = player
+        self.client_players[address] = player.id
+        self.client_protocols[address] = protocol
+        self.add_entity(player)
 
         logging.debug(f'new client connected: {address=}, {player=}')
 
     def disconnect(self, data, address):
         self.clients.remove(address)
+        self.client_players.pop(address, None)
+        self.client_protocols.pop(address, None)
+        self.interest.remove_viewer(address)
+        self.replicator.remove_client(address)
 
-        del self.players[data['id']]
+        self.remove_entity(self.players[data['id']])
         self.updates.append({'cmd': 'player_leaves', 'id': data['id']})
 
         logging.debug(f'client disconnected: {address=}, {data=}')
@@ -396,7 +756,7 @@ class Server:
         pos = entity.get_pos()
         if isinstance(entity, Player):
             if entity.id in self.players:
-                del self.players[entity.id]
+                self.remove_entity(entity)
                 drops = []
                 for item_id, item_type in entity.items.items():
                     drops.append(Dropped(
@@ -404,14 +764,15 @@ class Server:
                         pos=random_drop_pos(pos)))
         elif isinstance(entity, Mob):
             if entity.id in self.mobs:
-                del self.mobs[entity.id]
+                self.remove_entity(entity)
+                release_id(entity.id)
             drops = [Dropped(
                 item_id=str(generate_id()),
                 item_type=random.choice(['strength_pot', 'heal_pot', 'speed_pot', 'useless_card']),
                 pos=random_drop_pos(pos))
                 for _ in range(random.randint(2, 3))]
         for drop in drops:
-            self.dropped[drop.item_id] = drop
+            self.add_dropped(drop)
         logging.debug(f'entity died: {entity=}')
 
     def deal_damage(self, entity: Entity, damage: int):
@@ -419,44 +780,81 @@ class Server:
         if entity.health <= 0:
             self.handle_death(entity)
 
-    def get_collision_data(self, o1, o2):
+    def get_collision_data(self, o1, o2, t: int = None):
         if not isinstance(o1, Entity) and not isinstance(o2, Entity):
             return {}
         if not isinstance(o1, Entity):
-            return self.get_collision_data(o2, o1)
-
-        id2 = o2.id if isinstance(o2, (Entity, Projectile)) else None
-        result = {'id1': o1.id, 'id2': id2, 'aligned1': None, 'aligned2': None, 'damage1': 0, 'damage2': 0}
-
-        collision = dist(o1.get_pos(), o2.get_pos()) < 50
-
-        if isinstance(o2, Projectile):
-            if o2.attacker_id != o1.id and collision:
-                result['damage1'] = o2.get_damage()
-                return result
-            return {}
+            return self.get_collision_data(o2, o1, t)
+        t = t if t is not None else time.time_ns()
 
-        t = time.time_ns()
-        t2 = t + game_ticks_to_ns(10)
-        pos_after1, pos_after2 = o1.get_pos(t2), o2.get_pos(t2)
-        aligned1, aligned2 = collision_align(pos_before1=o1.get_pos(t), pos_before2=o2.get_pos(t),
-                                             pos_after1=pos_after1,
-                                             pos_after2=pos_after2, size1=o1.get_size(), size2=o2.get_size())
-        if tuple(aligned1) != tuple(pos_after1):
-            result['aligned1'] = aligned1
-        if tuple(aligned2) != tuple(pos_after2):
-            result['aligned2'] = aligned2
-
-        if isinstance(o1, Entity) and isinstance(o2, Entity) and collision:
+        id2 = o2.id if isinstance(o2, Entity) else None
+        damage1 = damage2 = 0
+        if isinstance(o2, Entity):
             if o1.id in self.attacking_entities:
-                result['damage2'] = o1.get_damage()
+                damage2 = o1.get_damage()
             if o2.id in self.attacking_entities:
-                result['damage1'] = o2.get_damage()
+                damage1 = o2.get_damage()
 
-        if result['aligned1'] is not None or result['aligned2'] is not None or result['damage1'] > 0 or \
-                result['damage2'] > 0:
-            return result
-        return {}
+        t2 = t + game_ticks_to_ns(10)
+        outcome = collision_outcome(o1.get_pos(t), o1.get_pos(t2), o1.get_size(), o2.get_pos(t), o2.get_pos(t2),
+                                    o2.get_size(), damage1, damage2)
+        if outcome is None:
+            return {}
+        aligned1, aligned2, damage1, damage2 = outcome
+        return {'id1': o1.id, 'id2': id2, 'aligned1': aligned1, 'aligned2': aligned2, 'damage1': damage1,
+                'damage2': damage2}
+
+    def get_projectile_collision(self, projectile: Projectile, t_start: int, t: int) -> dict:
+        """
+        Find the first entity or wall that a projectile hit between t_start and t.
+        The test is swept over the whole interval, so a projectile can't pass through anything between two ticks
+        however long they are.
+        :return: collision data, id1 is None when a wall stopped the projectile, an empty dict if nothing was hit
+        """
+        t = min(t, projectile.get_expiry_t())
+        t_start = min(max(t_start, projectile.t0), t)
+        before, after, size = projectile.get_pos(t_start), projectile.get_pos(t), projectile.get_size()
+        bounds = (min(before[0], after[0]), min(before[1], after[1]),
+                  max(before[0], after[0]) + size[0], max(before[1], after[1]) + size[1])
+
+        first_toi, first_hit = None, None
+        for wall in self.wall_index.query_aabb(bounds):
+            toi = time_of_impact(before, after, size, wall.get_pos(), wall.get_pos(), wall.get_size())
+            if toi is not None and (first_toi is None or toi < first_toi):
+                first_toi, first_hit = toi, wall
+        for entity in self.spatial_hash.candidates(bounds).values():
+            if not isinstance(entity, Entity) or entity.id == projectile.attacker_id:
+                continue
+            toi = self.entity_time_of_impact(projectile, entity, t_start, t)
+            if toi is not None and (first_toi is None or toi < first_toi):
+                first_toi, first_hit = toi, entity
+
+        if first_hit is None:
+            return {}
+        result = {'id1': None, 'id2': projectile.id, 'aligned1': None, 'aligned2': None, 'damage1': 0, 'damage2': 0}
+        if isinstance(first_hit, Entity):
+            result['id1'] = first_hit.id
+            result['damage1'] = projectile.get_damage()
+        return result
+
+    @staticmethod
+    def entity_time_of_impact(projectile: Projectile, entity: Entity, t_start: int, t: int) -> Optional[float]:
+        """
+        Swept test of a projectile against an entity along the entity's recorded movement: it stands at start_pos until
+        t0 (its path before its last move isn't kept), moves to end_pos, and stands there once it arrives. The interval
+        is split where the entity starts and stops moving, so both move linearly during every part.
+        :return: the part of the interval (between 0 and 1) after which they first overlap, None if they don't
+        """
+        size, entity_size = projectile.get_size(), entity.get_size()
+        breaks = sorted({t_start, t} | {min(max(b, t_start), t) for b in (entity.t0, entity.get_arrival_t())})
+        parts = list(zip(breaks, breaks[1:])) or [(t_start, t)]
+        for start, end in parts:
+            toi = time_of_impact(projectile.get_pos(start), projectile.get_pos(end), size,
+                                 entity.get_pos(max(start, entity.t0)), entity.get_pos(max(end, entity.t0)),
+                                 entity_size)
+            if toi is not None:
+                return (start + toi * (end - start) - t_start) / (t - t_start) if t > t_start else 0.0
+        return None
 
     def handle_collision(self, collision_data):
         id1, id2 = collision_data['id1'], collision_data['id2']
@@ -476,38 +874,73 @@ class Server:
 
         if o1 is not None and collision_data['aligned1'] is not None:
             o1.end_pos = collision_data['aligned1']
+            self.entity_moved(o1)
         if o2 is not None and collision_data['aligned2'] is not None:
             o2.end_pos = collision_data['aligned2']
+            self.entity_moved(o2)
 
         if o1 is not None and isinstance(o1, Entity):
             self.deal_damage(o1, collision_data['damage1'])
         if o2 is not None and isinstance(o2, Entity):
             self.deal_damage(o2, collision_data['damage2'])
         elif o2 is not None and isinstance(o2, Projectile):
-            del self.projectiles[o2.id]
+            self.remove_projectile(o2.id)
+
+    def entity_collisions(self, t: int) -> Iterator[dict]:
+        """
+        The collisions of the entities with each other and with walls, found lazily so every one is found after the
+        previous ones were handled, unless they're found by the shards
+        """
+        if self.shards is not None and self.world_store is not None:
+            attackers = [self.players.get(entity_id) or self.mobs.get(entity_id)
+                         for entity_id in set(self.attacking_entities)]
+            collisions = self.shards.collide(self.world_store, t, t + game_ticks_to_ns(10), filter(None, attackers))
+            for o1, o2, aligned1, aligned2, damage1, damage2 in collisions:
+                yield {'id1': o1.id, 'id2': o2.id if o2 is not None else None, 'aligned1': aligned1,
+                       'aligned2': aligned2, 'damage1': damage1, 'damage2': damage2}
+            return
+        entities: List[Entity] = list(self.players.values()) + list(self.mobs.values())
+
+        # entities against entities, from the spatial hash
+        pairs = self.spatial_hash.pairs(settings.COLLISION_RADIUS, t, cls=Entity)
+        # entities against walls
+        near_walls = self.wall_index.query_many([entity.get_pos(t) for entity in entities], settings.COLLISION_RADIUS)
+        for entity, walls in zip(entities, near_walls):
+            pairs += [(entity, wall) for wall in walls]
+
+        for o1, o2 in pairs:
+            collision_data = self.get_collision_data(o1, o2, t)
+            if collision_data:
+                yield collision_data
 
     def collisions_handler(self):
         t = time.time_ns()
-        hitboxes: List[Hitbox] = list(self.players.values()) + list(self.mobs.values()) + list(
-            self.projectiles.values()) + self.walls
-
-        positions = [hitbox.get_pos(t) for hitbox in hitboxes]
-        kd_tree = KDTree(positions)
-        collisions = kd_tree.query_pairs(100)
+        t_start = self.last_collisions_t if self.last_collisions_t is not None else t
+        self.last_collisions_t = t
+        self.evaluate_positions(t)
 
         collisions_data = []
-        for col in collisions:
-            o1, o2 = hitboxes[col[0]], hitboxes[col[1]]
-            collision_data = self.get_collision_data(o1, o2)
+        for collision_data in self.entity_collisions(t):
+            # with snapshots the aligned positions and damage reach the clients as entity state
+            if not settings.ENABLE_SNAPSHOTS:
+                collisions_data.append(collision_data)
+            self.handle_collision(collision_data)
+        # projectiles against entities and walls, over the whole interval since the last tick
+        for projectile in list(self.projectiles.values()):
+            collision_data = self.get_projectile_collision(projectile, t_start, t)
             if collision_data:
                 collisions_data.append(collision_data)
                 self.handle_collision(collision_data)
         self.attacking_entities = []
         if collisions_data:
             self.updates.append({'cmd': 'collisions', 'collisions_data': collisions_data})
+        self.expire_projectiles(t)
 
     def handle_update(self, data, address):
         cmd = data['cmd']
+        if cmd == 'ack':
+            self.replicator.ack(address, data['seq'])
+            return
         player = self.players[data['id']]
         t = time.time_ns()
         if cmd == 'move':
@@ -517,7 +950,7 @@ class Server:
                 return
             proj = Projectile(**data['projectile'], start_pos=player.get_pos(t), t0=t, id=None)
             player.reset_cooldown('projectile')
-            self.projectiles[proj.id] = proj
+            self.add_projectile(proj)
             data['projectile'] = proj  # add id field
         elif cmd == 'attack':
             self.attacking_entities.append(player.id)
@@ -528,15 +961,17 @@ class Server:
         elif cmd == 'item_dropped':
             if dist(data['pos'], player.get_pos(t)) < 250:
                 item_type = player.items.pop(data['item_id'])
+                player.mark_dirty('items')
                 dropped = Dropped(item_type=item_type, item_id=data['item_id'], pos=random_drop_pos(data['pos']))
-                self.dropped[dropped.item_id] = dropped
+                self.add_dropped(dropped)
                 data = {'cmd': cmd, 'item_type': dropped.item_type, 'item_id': dropped.item_id, 'pos': dropped.pos}
 
         elif cmd == 'item_picked':
             dropped = self.dropped[data['item_id']]
             if dist(dropped.pos, player.get_pos(t)) < 100 and len(player.items) < settings.INVENTORY_SIZE:
-                del self.dropped[data['item_id']]
+                self.remove_dropped(data['item_id'])
                 player.items[dropped.item_id] = dropped.item_type
+                player.mark_dirty('items')
                 del data['id']
             else:
                 raise Exception('bad client, cannot pickup item')
@@ -552,7 +987,7 @@ class Server:
                     # CIRCLE OF AXES:
                     axe = Projectile(id=None, start_pos=player.get_pos(t), type="axe", attacker_id=player.id, t0=t,
                                      target=tuple(vect))
-                    self.projectiles[axe.id] = axe
+                    self.add_projectile(axe)
                     projectile_ids.append(axe.id)
                     vect = vect.rotate(45)
                 data['extra']['projectile_ids'] = projectile_ids
@@ -579,37 +1014,189 @@ class Server:
 
                 item_id = str(generate_id())
                 player.items[item_id] = 'heal_pot'
+                player.mark_dirty('items')
             player.reset_cooldown('skill')
         self.updates.append(data)
 
     def receive_packets(self):
         while True:
             try:
-                msg, address = self.socket.recvfrom(settings.HEADER_SIZE)
-                data = json.loads(decrypt_packet(msg).decode())
-                logging.debug(f'received data: {data=}')
-
-                if data["cmd"] == "connect":
-                    if address not in self.clients:
-                        self.connect(data=data, address=address)
-                elif data["cmd"] == "disconnect":
-                    self.disconnect(data=data, address=address)
-                else:
-                    self.handle_update(data=data, address=address)
+                datagrams = self.io.receive()
+            except ConnectionResetError:
+                continue
+            except OSError:
+                logging.exception("can't receive")
+                continue
+            for msg, address in datagrams:
+                try:
+                    self.handle_datagram(msg, address)
+                except Exception:
+                    logging.exception('exception while handling request')
+
+    def handle_datagram(self, msg: bytes, address):
+        """
+        Decode a datagram on the receive thread, its command is handled by the next tick
+        """
+        data = self.decode_datagram(msg, address)
+        if data is not None:
+            self.commands.push((data, address))
+
+    def decode_datagram(self, msg: bytes, address) -> Optional[dict]:
+        data = protocol_decode(decrypt_packet(msg))
+        logging.debug(f'received data: {data=}')
+        return data
+
+    def apply_commands(self):
+        """
+        Handle the commands received since the last tick, in the order they arrived
+        """
+        for data, address in self.commands.drain():
+            try:
+                self.handle_command(data, address)
             except Exception:
                 logging.exception('exception while handling request')
+            # an earlier command of the tick may have converted the player this one changed
+            player = self.players.get(data.get('id'))
+            if player is not None:
+                serializer.forget(player)
+
+    def handle_command(self, data: dict, address):
+        if data["cmd"] == "connect":
+            if address not in self.clients:
+                self.connect(data=data, address=address)
+        elif data["cmd"] == "disconnect":
+            self.disconnect(data=data, address=address)
+        else:
+            self.handle_update(data=data, address=address)
 
     def send_updates(self):
         if settings.ENABLE_SHADOWS:
+            t = time.time_ns()
+            self.evaluate_positions(t)
             self.updates.append({
                 'cmd': 'shadows',
-                'entities': [{'id': entity.id, 'pos': entity.get_pos()} for entity in list(self.players.values()) +
+                'entities': [{'id': entity.id, 'pos': entity.get_pos(t)} for entity in list(self.players.values()) +
                              list(self.mobs.values())]
             })
-        data = json_encode({'cmd': 'update', 'updates': self.updates})
-        self.updates.clear()
-        for client in self.clients:
-            send_all(self.socket, data, client)
+        updates, self.updates = self.updates, []
+        viewers = self.get_viewers()
+        for clients, updates in self.route_updates(updates, viewers):
+            message = {'cmd': 'update', 'updates': updates}
+            encoded = {}  # the same updates are encoded once per protocol
+            for client in clients:
+                protocol = self.client_protocols.get(client, JSON)
+                if protocol not in encoded:
+                    encoded[protocol] = wire_encode(message, protocol, t=self.tick_t)
+                self.send_to_client(client, encoded[protocol])
+        self.send_snapshots(viewers)
+
+    def get_viewers(self) -> Dict[Hashable, int]:
+        """
+        :return: a key for every client (what send_to_client takes) to its player id
+        """
+        return self.client_players
+
+    def send_to_client(self, key: Hashable, data: bytes):
+        send_all(self.socket, data, key)
+
+    def send_message(self, key: Hashable, message: dict):
+        self.send_to_client(key, wire_encode(message, self.client_protocols.get(key, JSON)))
+
+    def get_update_positions(self, update: dict, t: int) -> Optional[List[Tuple[int, int]]]:
+        """
+        Find where an update happens, for area of interest filtering
+        :param update: the update
+        :param t: time in ns
+        :return: a list of positions, None if every client should get the update
+        """
+        if update['cmd'] in GLOBAL_UPDATES:
+            return None
+        positions = []
+        for key in ['id', 'id1', 'id2']:
+            object_id = update.get(key)
+            for objects in [self.players, self.mobs, self.projectiles]:
+                if object_id in objects:
+                    positions.append(objects[object_id].get_pos(t))
+                    break
+        if 'pos' in update:
+            positions.append(update['pos'])
+        if update['cmd'] == 'projectile':
+            positions += update['projectile'].get_path()
+        return positions or None
+
+    def get_area_data(self, chunks: Collection[Tuple[int, int]], t: int) -> dict:
+        """
+        The players, mobs and dropped items inside the given chunks, in the format of get_data
+        """
+        found = self.spatial_hash.query_chunks(chunks, t)
+        return {
+            'cmd': 'get_data',
+            'players': [o for o in found if isinstance(o, Player)],
+            'mobs': [o for o in found if isinstance(o, Mob)],
+            'dropped': [o for o in found if isinstance(o, Dropped)]
+        }
+
+    def get_snapshot(self, key: Hashable, t: int) -> Snapshot:
+        """
+        The state of the entities a client sees, its area of interest or the whole section
+        """
+        if settings.ENABLE_AOI and key in self.interest.viewer_chunks:
+            entities = self.spatial_hash.query_chunks(self.interest.get_viewer_area(key), t, cls=Entity)
+        else:
+            entities = list(self.players.values()) + list(self.mobs.values())
+        snapshot = {}
+        for entity in entities:
+            record = {'start_pos': list(entity.get_pos(t)), 'end_pos': list(entity.end_pos), 'health': entity.health}
+            if isinstance(entity, Mob):
+                record.update(kind='mob', type=entity.type)
+            else:
+                record.update(kind='player', username=entity.username)
+            snapshot[entity.id] = record
+        return snapshot
+
+    def send_snapshots(self, viewers: Dict[Hashable, int]):
+        """
+        Send every client the delta between what it sees now and the last snapshot it acknowledged
+        """
+        if not settings.ENABLE_SNAPSHOTS:
+            return
+        t = time.time_ns()
+        self.evaluate_positions(t)
+        for key in viewers:
+            self.send_message(key, self.replicator.make_delta(key, self.get_snapshot(key, t)))
+
+    def route_updates(self, updates: list, viewers: Dict[Hashable, int]) -> List[Tuple[list, list]]:
+        """
+        Decide which clients get which updates.
+        Every client gets the updates happening within AOI_RADIUS chunks of its player. A client whose area moved
+        is sent the data of the chunks it started watching, since it missed their updates until now.
+        :param updates: the updates of this tick
+        :param viewers: a key for every client (what send_to_client takes) to its player id
+        :return: a list of (client keys, updates) groups
+        """
+        if settings.ENABLE_SNAPSHOTS:
+            updates = [update for update in updates if update['cmd'] not in REPLICATED_UPDATES]
+        if not settings.ENABLE_AOI:
+            return [(list(viewers), updates)]
+        t = time.time_ns()
+        self.evaluate_positions(t)
+        for key, player_id in viewers.items():
+            if player_id not in self.players:
+                continue
+            is_new = key not in self.interest.viewer_chunks
+            entered, _ = self.interest.update_viewer(key, self.players[player_id].get_pos(t))
+            # new clients got everything in init
+            if entered and not is_new:
+                self.send_message(key, self.get_area_data(entered, t))
+
+        split = []
+        for update in updates:
+            if update['cmd'] == 'collisions':
+                # every collision happens in its own place
+                split += [{'cmd': 'collisions', 'collisions_data': [data]} for data in update['collisions_data']]
+            else:
+                split.append(update)
+        return self.interest.route(split, [self.get_update_positions(update, t) for update in split], viewers)
 
 
 def main():
@@ -619,17 +1206,25 @@ def main():
 
     server = Server(sock=sock)
     server.generate_mobs(settings.MOB_COUNT)
+
+    def tick():
+        server.begin_tick()
+        server.apply_commands()
+        server.update_mobs()
+        server.collisions_handler()
+        server.send_updates()
+
+    scheduler = TickScheduler(period=settings.UPDATE_TICK, tick=tick, policy=settings.TICK_POLICY,
+                              max_catch_up=settings.TICK_MAX_CATCH_UP, log_interval=settings.TICK_STATS_INTERVAL)
+    if use_asyncio(settings.RUNTIME):
+        async_runtime.run(sock, server.handle_datagram, scheduler, chat=AsyncChatServer())
+        return
     receive_thread = threading.Thread(target=server.receive_packets)
     receive_thread.start()
     # INITIALIZE CHAT SERVER:
     server_chat = ChatServer()
     threading.Thread(target=server_chat.start).start()
-
-    while True:
-        time.sleep(settings.UPDATE_TICK)
-        server.update_mobs()
-        server.collisions_handler()
-        server.send_updates()
+    scheduler.run()
 
 
 if __name__ == '__main__':
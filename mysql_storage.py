@@ -0,0 +1,182 @@
+"""
+The MySQL backend of DBAPI, see storage. The server's credentials come from MYSQL_USER, MYSQL_PASSWORD and MYSQL_PORT.
+"""
+import logging
+from typing import Any, Callable, List, Optional, Tuple
+
+from mysql.connector import Error, InterfaceError, OperationalError, connect
+from mysql.connector.pooling import MySQLConnectionPool
+
+from settings import DATABASE_NAME, DB_POOL_SIZE
+from storage import PLAYER_COLUMNS, SCHEMA_VERSION, Account, Storage
+
+USERS_TABLE = 'CREATE TABLE IF NOT EXISTS {}(username VARCHAR(256) PRIMARY KEY, hash CHAR(64) NOT NULL, ' \
+              'salt CHAR(64) NOT NULL)'
+PLAYERS_TABLE = 'CREATE TABLE IF NOT EXISTS {}(username VARCHAR(256) PRIMARY KEY, id BIGINT NOT NULL, ' \
+                'pos_x INT NOT NULL, pos_y INT NOT NULL, health INT NOT NULL, items MEDIUMTEXT NOT NULL, ' \
+                'effects TEXT NOT NULL)'
+
+
+def upsert_player(table: str) -> str:
+    """
+    :return: a single statement storing a player whether it was stored before or not, executemany sends a batch of
+    them as a single statement too
+    """
+    return (f'INSERT INTO {table}({", ".join(PLAYER_COLUMNS)}) '
+            f'VALUES ({", ".join(f"%({column})s" for column in PLAYER_COLUMNS)}) '
+            f'ON DUPLICATE KEY UPDATE {", ".join(f"{column} = VALUES({column})" for column in PLAYER_COLUMNS[1:])}')
+
+
+UPSERT_PLAYER = upsert_player('players')
+SELECT_PLAYER = f'SELECT {", ".join(PLAYER_COLUMNS[1:])} FROM players WHERE username = %(username)s'
+
+
+def schema_version(cursor) -> int:
+    """
+    :return: the version of the schema of the current database, 0 if it's empty
+    """
+    cursor.execute('CREATE TABLE IF NOT EXISTS schema_version(version INT NOT NULL)')
+    cursor.execute('SELECT version FROM schema_version')
+    row = cursor.fetchone()
+    if row is not None:
+        return row[0]
+    # the first schema had no version
+    cursor.execute("SHOW TABLES LIKE 'players'")
+    return 1 if cursor.fetchone() is not None else 0
+
+
+def migrate_to_v2(connection, cursor):
+    """
+    Primary keys on the usernames, instead of scanning the tables, and the player's JSON split into columns.
+    The first account of a username is kept, and one of the rows of its player
+    """
+    cursor.execute(USERS_TABLE.format('users_v2'))
+    cursor.execute('INSERT IGNORE INTO users_v2(username, hash, salt) SELECT username, hash, salt FROM users')
+    cursor.execute(PLAYERS_TABLE.format('players_v2'))
+    # split by the server, the players table may not fit in memory
+    cursor.execute(
+        "INSERT INTO players_v2(username, id, pos_x, pos_y, health, items, effects) "
+        "SELECT username, CAST(JSON_EXTRACT(player, '$.id') AS SIGNED), "
+        "CAST(JSON_EXTRACT(player, '$.start_pos[0]') AS SIGNED), "
+        "CAST(JSON_EXTRACT(player, '$.start_pos[1]') AS SIGNED), "
+        "CAST(JSON_EXTRACT(player, '$.health') AS SIGNED), COALESCE(JSON_EXTRACT(player, '$.items'), '{}'), '[]' "
+        "FROM players "
+        f"ON DUPLICATE KEY UPDATE {', '.join(f'{column} = VALUES({column})' for column in PLAYER_COLUMNS[1:])}")
+    connection.commit()
+    cursor.execute('RENAME TABLE users TO users_v1, users_v2 TO users, players TO players_v1, players_v2 TO players')
+    cursor.execute('DROP TABLE users_v1, players_v1')
+
+
+MIGRATIONS = {2: migrate_to_v2}  # version to the function migrating the previous version to it
+
+
+class MySQLStorage(Storage):
+    """
+    Every query runs on a connection of the pool, and the pool reconnects the connections the server dropped.
+    """
+
+    def __init__(self, user, password, port, pool_size: int = DB_POOL_SIZE, database: str = DATABASE_NAME):
+        self.create_db(user=user, password=password, port=port, database=database)
+        self.pool = MySQLConnectionPool(
+            pool_size=pool_size,
+            pool_reset_session=False,  # no session state is set, a reset would be a round trip per query
+            host='localhost',
+            user=user,
+            password=password,
+            port=port,
+            database=database,
+        )
+
+    @staticmethod
+    def create_db(user, password, port, database: str = DATABASE_NAME):
+        """
+        Create the database, or migrate its tables to SCHEMA_VERSION
+        """
+        connection = connect(host='localhost', user=user, password=password, port=port)
+        try:
+            cursor = connection.cursor(buffered=True)
+            cursor.execute('CREATE DATABASE IF NOT EXISTS %s' % database)
+            cursor.execute('USE %s' % database)
+            version = schema_version(cursor)
+            if version == 0:
+                cursor.execute(USERS_TABLE.format('users'))
+                cursor.execute(PLAYERS_TABLE.format('players'))
+            for version in range(version + 1, SCHEMA_VERSION + 1):
+                logging.info(f'migrating the database: {version=}')
+                MIGRATIONS[version](connection, cursor)
+            cursor.execute('DELETE FROM schema_version')
+            cursor.execute('INSERT INTO schema_version(version) VALUES (%s)', (SCHEMA_VERSION,))
+            connection.commit()
+            cursor.close()
+        finally:
+            connection.close()
+
+    def run(self, query: Callable[[Any], Any], default=None):
+        """
+        Run queries in a transaction on a connection of the pool, once more on another connection if the connection
+        was lost in between
+        :param query: called with a cursor
+        :return: what query returned, default if it failed
+        """
+        for attempt in range(2):
+            connection = None
+            try:
+                connection = self.pool.get_connection()
+                cursor = connection.cursor(buffered=True)
+                try:
+                    result = query(cursor)
+                    connection.commit()
+                    return result
+                finally:
+                    cursor.close()
+            except (InterfaceError, OperationalError):
+                if attempt == 0:
+                    logging.warning('db connection lost, retrying', exc_info=True)
+                    continue
+                logging.exception('db exception')
+            except Error:
+                logging.exception('db exception')
+                if connection is not None and connection.is_connected():
+                    connection.rollback()
+                break
+            finally:
+                if connection is not None:
+                    connection.close()  # back to the pool
+        return default
+
+    def get_account(self, username: str) -> Optional[Tuple[str, str]]:
+        def query(cursor):
+            cursor.execute('SELECT hash, salt FROM users WHERE username = %(username)s', {'username': username})
+            return cursor.fetchone()
+
+        return self.run(query)
+
+    def add_accounts(self, accounts: List[Account]) -> int:
+        def query(cursor):
+            cursor.executemany('INSERT IGNORE INTO users(username, hash, salt) VALUES (%s, %s, %s)', accounts)
+            return cursor.rowcount
+
+        return self.run(query, default=0)
+
+    def remove_account(self, username: str):
+        self.run(lambda cursor: cursor.execute('DELETE FROM users WHERE username = %(username)s',
+                                               {'username': username}))
+
+    def get_player(self, username: str) -> Optional[dict]:
+        def query(cursor):
+            cursor.execute(SELECT_PLAYER, {'username': username})
+            return cursor.fetchone()
+
+        row = self.run(query)
+        return None if row is None else dict(zip(PLAYER_COLUMNS[1:], row))
+
+    def write_players(self, rows: List[dict]) -> bool:
+        def query(cursor):
+            cursor.executemany(UPSERT_PLAYER, rows)
+            return True
+
+        return self.run(query, default=False)
+
+    def delete_player(self, username: str):
+        self.run(lambda cursor: cursor.execute('DELETE FROM players WHERE username = %(username)s',
+                                               {'username': username}))
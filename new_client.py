@@ -1,4 +1,6 @@
 import logging
+import os
+import time
 from typing import Optional
 from client import *
 
@@ -9,24 +11,27 @@ class NewClient(Client):
         self.lb_address = lb_address
 
     def send_connect(self, username, password, action):
-        data = {'cmd': 'connect', 'username': username, 'password': password, 'action': action}
+        # the load balancer drops a login which isn't fresh or which it saw already
+        data = {'cmd': 'connect', 'username': username, 'password': password, 'action': action,
+                'protocols': PROTOCOLS, 'time': time.time(), 'nonce': os.urandom(16).hex()}
         data = self.serialized_public_key + self.fernet.encrypt(json.dumps(data).encode())
         self.sock.sendto(data, self.lb_address)
 
     def get_data(self, data):
         try:
             assert data['cmd'] == 'get_data'
-            # add new sprites
-            ids = [o.id for o in self.sprite_groups['entity'].sprites()] + \
-                  [o.item_id for o in self.sprite_groups['dropped'].sprites()]
-            for player_data in data['players']:
-                if player_data['id'] not in ids:
-                    self.create_player(player_data)
-            for mob_data in data['mobs']:
-                if mob_data['id'] not in ids:
-                    self.create_mob(mob_data)
+            # add new sprites, move the known ones to where the server says they are going
+            known = {o.id: o for o in self.sprite_groups['entity'].sprites()}
+            ids = list(known) + [o.item_id for o in self.sprite_groups['dropped'].sprites()]
+            for entities_data, create in [(data['players'], self.create_player), (data['mobs'], self.create_mob)]:
+                for entity_data in entities_data:
+                    entity = known.get(entity_data['id'])
+                    if entity is None:
+                        create(entity_data)
+                    elif entity is not self.main_player:
+                        entity.move(*entity_data['end_pos'], send_update=False)
             for dropped_data in data['dropped']:
-                if dropped_data not in ids:
+                if dropped_data['item_id'] not in ids:
                     self.create_dropped(dropped_data)
         except Exception:
             logging.exception(f'exception in get_data')
@@ -80,6 +85,8 @@ class NewClient(Client):
                                 self.handle_update(update)
                             except Exception:
                                 logging.exception('exception in update')
+                    elif cmd == 'snapshot':
+                        self.handle_snapshot(data)
                     elif cmd == 'get_data':
                         logging.debug(f'received data: {data=}')
                         self.get_data(data)
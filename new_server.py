@@ -1,50 +1,80 @@
 import struct
 import sys
 import threading
+from typing import Set
 
+import id_allocator
+from id_allocator import server_id_prefix
 from my_server import *
+from replication import BackupTracker
+from shard import ShardPool
 from settings import *
+from tick_scheduler import TickStats
+
+MOB_MOVE_ATTEMPTS = 10  # random targets a dragon tries before it stays where it is
 
 
 class NewServer(Server):
     def __init__(self, sock: socket.socket, lb_address, server_chunks: List[Tuple[int, int]],
-                 shared_chunks: List[Tuple[int, int]]):
+                 shared_chunks: List[Tuple[int, int]], server_idx: int = 0,
+                 server_addresses: Optional[List[Address]] = None):
         super(NewServer, self).__init__(sock=sock)
         self.lb_address = lb_address
+        self.server_idx = server_idx
+        # the servers replicate the updates of their shared chunks to each other, see forward_updates
+        self.server_addresses = [tuple(address) for address in (server_addresses or SERVER_ADDRESSES)]
+        self.peer_addresses = set(self.server_addresses) - {self.server_addresses[server_idx]}
+        self.peer_cipher = get_peer_cipher()
 
         self.id_to_fernet_address: Dict[int, Tuple[Fernet, Address]] = {}
 
         self.server_private_key = load_private_ecdh_key()
 
-        self.server_chunks = server_chunks
-        self.shared_chunks = shared_chunks
-        self.private_chunks = [chunk for chunk in self.server_chunks if chunk not in self.shared_chunks]
-
-        logging.debug(f'{self.private_chunks=}')
+        # changed by the load balancer when it rebalances the load, see apply_chunk_mapping
+        self.chunk_mapping = generate_chunk_mapping()
+        self.mapping_version = 0
+        self.set_chunks(server_chunks, shared_chunks)
 
         self.forwarded_updates = []
+        self.reassembler = Reassembler()
+        self.last_backup = time.monotonic()
+        self.backups = BackupTracker()
+        self.last_load_report = time.monotonic()
+        self.tick_stats: Optional[TickStats] = None  # the scheduler's, for the load reports
         with open("super_secret_do_not_touch.txt", 'rb') as secret_key:
             self.lb_fernet = Fernet(secret_key.read())
 
-    def recv_json(self) -> Tuple[dict, Any]:
-        while True:
-            try:
-                msg, address = self.socket.recvfrom(settings.HEADER_SIZE)
-                break
-            except ConnectionResetError:
-                pass
-        if address == self.lb_address:
-            data = self.lb_fernet.decrypt(msg, ttl=FERNET_TTL)
-            return json.loads(data), address
-        player_id = int(msg[:6])
-        if player_id in self.id_to_fernet_address:
-            fernet = self.id_to_fernet_address[player_id][0]
-            assert self.id_to_fernet_address[player_id][1] == address
-            data = fernet.decrypt(msg[6:], ttl=FERNET_TTL)
-            json_data = json.loads(data)
+    def set_chunks(self, server_chunks: List[Tuple[int, int]], shared_chunks: List[Tuple[int, int]]):
+        self.server_chunks = server_chunks
+        self.shared_chunks = shared_chunks
+        self.server_chunks_set = set(server_chunks)
+        self.shared_chunks_set = set(shared_chunks)
+        self.private_chunks = [chunk for chunk in self.server_chunks if chunk not in self.shared_chunks_set]
+        self.private_chunks_set = set(self.private_chunks)
+        logging.debug(f'{self.private_chunks=}')
+
+    def decode_datagram(self, msg: bytes, address) -> Optional[dict]:
+        """
+        :return: the message of the datagram, None if it's a fragment of a message which isn't complete yet
+        """
+        if address == self.lb_address or address in self.peer_addresses:
+            # the load balancer's and the other servers' messages are fragmented, clients send single datagrams
+            data = self.reassembler.add(msg, address)
+            if data is None:
+                return None
+            cipher = self.lb_fernet if address == self.lb_address else self.peer_cipher
+            return json.loads(cipher.decrypt(data, ttl=FERNET_TTL))
+        player_id, = ID_HEADER.unpack_from(msg)
+        # the tick may add and remove clients meanwhile, the dict is read once
+        client = self.id_to_fernet_address.get(player_id)
+        if client is not None:
+            fernet, client_address = client
+            assert client_address == address
+            data = fernet.decrypt(msg[ID_HEADER.size:], ttl=FERNET_TTL)
+            json_data = protocol_decode(data)
             if not json_data['id'] == player_id:
                 raise Exception('client tried to connect with a different id!')
-            return json_data, address
+            return json_data
         raise UnknownClientException()
 
     def generate_mobs(self, count):
@@ -56,20 +86,25 @@ class NewServer(Server):
                     start_pos=(pos_x, pos_y),
                     end_pos=None,
                     health=100, t0=0, type=random.choice(['dragon', 'demon']))
-            self.mobs[m.id] = m
+            self.add_entity(m)
 
     def mob_move(self, mob: Mob):
         if mob.type == 'dragon':
             pos = mob.get_pos()
-            new_pos = pos[0] + random.randint(-500, 500), pos[1] + random.randint(-500, 500)
-            while get_chunk(new_pos) not in self.private_chunks:
+            for _ in range(MOB_MOVE_ATTEMPTS):
                 new_pos = pos[0] + random.randint(-500, 500), pos[1] + random.randint(-500, 500)
+                if get_chunk(new_pos) in self.private_chunks_set:
+                    break
+            else:
+                return  # a mob the server just got from another one, its chunks may not be private yet
             mob.move(pos=new_pos)
             self.updates.append({'cmd': 'move', 'pos': mob.end_pos, 'id': mob.id})
         elif mob.type == 'demon' and self.players:
-            player = random.choice(list(self.players.values()))
+            player = self.spatial_hash.nearest(mob.get_pos(), DEMON_CHASE_RADIUS, cls=Player)
+            if player is None:
+                return
             player_pos = player.get_pos()
-            if get_chunk(player_pos) in self.private_chunks:
+            if get_chunk(player_pos) in self.private_chunks_set:
                 mob.move(pos=player_pos)
                 self.updates.append({'cmd': 'move', 'pos': player_pos, 'id': mob.id})
 
@@ -79,7 +114,7 @@ class NewServer(Server):
             target = player_pos[0] - mob_pos[0], player_pos[1] - mob_pos[1]
             proj = Projectile(id=None, start_pos=mob_pos, target=target, type='axe', attacker_id=mob.id,
                               t0=time.time_ns())
-            self.projectiles[proj.id] = proj
+            self.add_projectile(proj)
             self.updates.append({'cmd': 'projectile', 'projectile': proj, 'id': mob.id})
         elif mob.type == 'demon':
             self.updates.append({'cmd': 'attack', 'id': mob.id})
@@ -89,12 +124,13 @@ class NewServer(Server):
         self.remove_player(player_id=data['id'])
         self.remove_client(player_id=data['id'], send_remove_data=False)
 
-    def add_client(self, player, client_addr, client_public_key, init):
+    def add_client(self, player, client_addr, client_public_key, init, protocol=JSON):
         client_public_key = client_public_key.encode()
         client_addr = tuple(client_addr)
         if init:
             json_data = {
                 'cmd': 'init',
+                'protocol': protocol,
                 'main_player': json_encode(player, items=True, todict=True),
                 'players': list(self.players.values()),
                 'mobs': list(self.mobs.values()),
@@ -108,11 +144,12 @@ class NewServer(Server):
                 'mobs': list(self.mobs.values()),
                 'dropped': list(self.dropped.values())
             }
-        data = json_encode(json_data)
+        data = json_encode(json_data, t=self.tick_t)
         loaded_key = serialization.load_pem_public_key(client_public_key)
-        fernet = get_fernet(loaded_key, self.server_private_key)
+        fernet = get_cipher(loaded_key, self.server_private_key, server=True)
 
         self.id_to_fernet_address[player.id] = fernet, client_addr
+        self.client_protocols[player.id] = protocol
         self.clients.add(client_addr)
 
         send_all(self.socket, data, client_addr, fernet)
@@ -121,36 +158,30 @@ class NewServer(Server):
     def connect(self, data, address):
         player = player_from_dict(data['player'])
         # self.updates.append()
-        self.add_client(player, data['client'], data['client_key'], init=True)
-        self.players[player.id] = player
+        self.add_client(player, data['client'], data['client_key'], init=True, protocol=data.get('protocol', JSON))
+        self.add_entity(player)
         self.create_and_forward_update({'cmd': 'player_enters', 'player': player}, entity_id=player.id)
 
     def add_player(self, player_data):
         if player_data['id'] not in self.players:
             player = player_from_dict(player_data)
-            self.players[player.id] = player
+            self.add_entity(player)
 
     def remove_player(self, player_id):
         if player_id in self.players:
-            del self.players[player_id]
+            self.remove_entity(self.players[player_id])
 
-    def handle_lb_update(self, data, address):
+    def handle_shared_update(self, data, address):
         cmd = data['cmd']
         if cmd == 'player_enters':
             self.add_player(player_data=data['player'])
         elif cmd == 'player_leaves' or cmd == 'entity_died' and data['id'] in self.players:
-            fernet, client_address = self.id_to_fernet_address[data['id']]
-            updates = {
-                'cmd': 'update',
-                'updates': [data]
-            }
-            updates = json.dumps(updates).encode()
-            send_all(sock=self.socket, data=updates, address=client_address, fernet=fernet)
-
+            if data['id'] in self.id_to_fernet_address:
+                self.send_message(data['id'], {'cmd': 'update', 'updates': [data]})
             self.remove_player(player_id=data['id'])
             self.remove_client(player_id=data['id'], send_remove_data=False)
         elif cmd == 'entity_died' and data['id'] in self.mobs:
-            del self.mobs[data['id']]
+            self.remove_entity(self.mobs[data['id']])
         else:
             # handle update without forwarding to lb
             self.handle_update(data=data, address=address)
@@ -163,50 +194,68 @@ class NewServer(Server):
             if send_remove_data:
                 json_data = {
                     'cmd': 'remove_data',
-                    'entities': [entity.id for entity in list(self.players.values()) + list(self.mobs.values()) if
-                                 get_chunk(entity.get_pos()) in self.private_chunks]
+                    'entities': [entity.id for entity in
+                                 self.spatial_hash.query_chunks(self.private_chunks_set, cls=Entity)]
                 }
                 send_all(self.socket, json_encode(json_data), address, fernet)
             del self.id_to_fernet_address[player_id]
+            self.client_protocols.pop(player_id, None)
+            self.interest.remove_viewer(player_id)
+            self.replicator.remove_client(player_id)
             if address not in [addr for _, addr in self.id_to_fernet_address.values()] and address in self.clients:
                 self.clients.remove(address)
+            self.prune_players()
 
     def handle_lb_request(self, data, address):
         cmd = data['cmd']
         if cmd == "connect":
             self.connect(data=data, address=address)
         elif cmd == 'add_client':
-            self.add_client(self.players[data['id']], data['client'], data['client_key'], init=False)
+            self.add_client(self.players[data['id']], data['client'], data['client_key'], init=False,
+                            protocol=data.get('protocol', JSON))
         elif cmd == 'remove_client':
             self.remove_client(player_id=data['id'])
-        elif cmd == 'update':
-            # send updates to clients
-            for update in data['updates']:
-                self.handle_lb_update(data=update, address=address)
-
-    def receive_packets(self):
-        while True:
-            try:
-                data, address = self.recv_json()
-                logging.debug(f'received data: {data=}, {address=}')
-                if address == self.lb_address:
-                    self.handle_lb_request(data=data, address=address)
-                elif address in self.clients:
-                    # forward update to lb
-                    self.handle_or_forward_client_update(data=data, address=address)
-                else:
-                    logging.warning(
-                        f'address not in clients or lb: {address=}, {self.id_to_fernet_address=}, {self.lb_address=}, '
-                        f'{self.clients=}')
-            except Exception:
-                logging.exception('exception while handling request')
+        elif cmd == 'chunk_mapping':
+            self.apply_chunk_mapping(data['mapping'], data['version'])
+        elif cmd == 'adopt':
+            self.adopt(data)
+        elif cmd == 'backup_ack':
+            self.backups.ack(data['seq'])
+
+    def handle_command(self, data: dict, address):
+        logging.debug(f'received data: {data=}, {address=}')
+        if address == self.lb_address:
+            self.handle_lb_request(data=data, address=address)
+        elif address in self.peer_addresses:
+            self.handle_peer_request(data=data, address=address)
+        elif address in self.clients:
+            # forward update to lb
+            self.handle_or_forward_client_update(data=data, address=address)
+        else:
+            logging.warning(
+                f'address not in clients or lb: {address=}, {self.id_to_fernet_address=}, {self.lb_address=}, '
+                f'{self.clients=}')
+
+    def handle_peer_request(self, data, address):
+        """
+        The updates of the chunks this server shares with another one
+        """
+        if data['cmd'] != 'update' or self.server_addresses[data['from']] != address:
+            # a message of a server sent back by another one, or spoofed
+            logging.warning(f'unexpected server message: {data=}, {address=}')
+            return
+        for update in data['updates']:
+            self.handle_shared_update(data=update, address=address)
 
     def handle_or_forward_client_update(self, data, address):
         cmd = data['cmd']
         if cmd not in ['move', 'attack', 'projectile', 'disconnect', 'item_dropped', 'item_picked',
-                       'use_item', 'use_skill']:
+                       'use_item', 'use_skill', 'ack']:
             logging.warning(f'unknown client cmd: {data=}, {address=}')
             return
+        if cmd == 'ack':
+            self.replicator.ack(data['id'], data['seq'])
+            return
 
         player = self.players[data['id']]
         chunk = get_chunk(player.get_pos())
@@ -216,47 +265,71 @@ class NewServer(Server):
             data['player'] = json_encode(player, items=True, todict=True)
             self.forwarded_updates.append((data, chunk))
         # when cmd is move, send update whenever any one of start_pos, end_pos is in a shared chunk
-        elif chunk in self.shared_chunks or (cmd == 'move' and get_chunk(data['pos']) in self.shared_chunks):
+        elif chunk in self.shared_chunks_set or (cmd == 'move' and get_chunk(data['pos']) in self.shared_chunks_set):
             self.forwarded_updates.append((data, chunk))
         else:
             self.handle_update(data=data, address=address)
 
     def forward_updates(self):
-        if self.forwarded_updates:
-            logging.debug(f'{self.forwarded_updates=}')
-        updates = []
-        chunks = []
-        moving_players = []
+        """
+        Send the updates of the shared chunks to the servers around them, and apply them to this server.
+        The load balancer only hears of the players who change server or leave the game
+        """
+        if not self.forwarded_updates:
+            return
+        logging.debug(f'{self.forwarded_updates=}')
+        updates_by_server_idx: Dict[int, list] = {}
+        enters, leaves = {}, {}  # server idx: updates of the players moving around its section
         for update, chunk in self.forwarded_updates:
-            # whenever a player changes its section, send its data
-            if update['cmd'] == 'move':
+            servers = get_adj_server_idx(self.chunk_mapping, chunk)
+            cmd = update['cmd']
+            if cmd == 'move':
                 player = self.players[update['id']]
                 start_chunk, end_chunk = get_chunk(player.get_pos()), get_chunk(update['pos'])
+                new_server = self.chunk_mapping[end_chunk[0]][end_chunk[1]]
+                if new_server != self.server_idx:
+                    self.send_lb('change_server', {'id': player.id, 'to': new_server})
                 if start_chunk != end_chunk:
-                    moving_players.append({
-                        'start_chunk': start_chunk, 'end_chunk': end_chunk, 'player': player
-                    })
-            updates.append(update)
-            chunks.append(chunk)
-        if updates:
-            data = json_encode({'cmd': 'forward_updates', 'updates': updates, 'chunks': chunks,
-                               'moving_players': moving_players})
-            send_all(self.socket, data, self.lb_address, self.lb_fernet)
-            logging.debug(f'updates sent to lb: {updates=}, {chunks=}')
+                    adj_start = get_adj_server_idx(self.chunk_mapping, start_chunk)
+                    adj_end = get_adj_server_idx(self.chunk_mapping, end_chunk)
+                    for server_idx in adj_end - adj_start:
+                        enters.setdefault(server_idx, []).append({'cmd': 'player_enters', 'player': player})
+                    for server_idx in adj_start - adj_end:
+                        leaves.setdefault(server_idx, []).append({'cmd': 'player_leaves', 'id': player.id})
+                    servers = servers | adj_end
+            elif cmd == 'disconnect' or cmd == 'entity_died' and 'player' in update:
+                if cmd == 'disconnect':
+                    update['cmd'] = 'player_leaves'
+                player = update.pop('player')
+                self.send_lb('player_leaves', {'player': player})
+            for server_idx in servers:
+                updates_by_server_idx.setdefault(server_idx, []).append(update)
         self.forwarded_updates.clear()
 
-    def send_updates(self):
-        if settings.ENABLE_SHADOWS:
-            self.updates.append({
-                'cmd': 'shadows',
-                'entities': [{'id': entity.id, 'pos': entity.get_pos()} for entity in list(self.players.values()) +
-                             list(self.mobs.values())]
-            })
-        data = json_encode({'cmd': 'update', 'updates': self.updates})
-        self.updates.clear()
-        for player_id in self.id_to_fernet_address:
-            fernet, address = self.id_to_fernet_address[player_id]
-            send_all(self.socket, data, address, fernet)
+        local = []
+        for server_idx in updates_by_server_idx.keys() | enters.keys() | leaves.keys():
+            # a player enters before its move and leaves after it
+            updates = (enters.get(server_idx, []) + updates_by_server_idx.get(server_idx, []) +
+                       leaves.get(server_idx, []))
+            data = json_encode({'cmd': 'update', 'from': self.server_idx, 'updates': updates}, t=self.tick_t)
+            if server_idx == self.server_idx:
+                # applied like the other servers apply them, once all of them are encoded
+                local = json.loads(data)['updates']
+                continue
+            send_all(self.io, data, self.server_addresses[server_idx], self.peer_cipher)
+            logging.debug(f'updates sent to server: {server_idx=}, {updates=}')
+        for update in local:
+            self.handle_shared_update(data=update, address=None)
+
+    def send_lb(self, cmd: str, params: dict):
+        send_all(self.io, json_encode({'cmd': cmd, **params}), self.lb_address, self.lb_fernet)
+
+    def get_viewers(self) -> Dict[int, int]:
+        return {player_id: player_id for player_id in self.id_to_fernet_address}
+
+    def send_to_client(self, key: int, data: bytes):
+        fernet, address = self.id_to_fernet_address[key]
+        send_all(self.io, data, address, fernet)
 
     def create_and_forward_update(self, update, entity_id=None):
         entity = None
@@ -292,7 +365,7 @@ class NewServer(Server):
                 pos=random_drop_pos(pos))
                 for _ in range(random.randint(2, 3))]
         for drop in drops:
-            self.dropped[drop.item_id] = drop
+            self.add_dropped(drop)
         logging.debug(f'entity died: {entity=}')
 
         update = {'cmd': 'entity_died', 'id': entity.id, 'drops': drops}
@@ -301,15 +374,115 @@ class NewServer(Server):
 
         self.create_and_forward_update(update)
 
-    def backups_sender(self):
-        while True:
-            time.sleep(BACKUP_DELAY)
-            players = {player_id: player for player_id, player in self.players.items() if
-                       get_chunk(player.get_pos()) in self.server_chunks}
-            if players:
-                data = json_encode({'cmd': 'backups', 'players': players}, items=True)
-                send_all(self.socket, data, self.lb_address, self.lb_fernet)
-                # logging.info(f'backup sent to db: {data=}')
+    def send_backups(self):
+        """
+        Send the changes of the players of this server to the load balancer for the database, every BACKUP_DELAY
+        seconds. Called by the tick, like everything else which reads the game state
+        """
+        now = time.monotonic()
+        if now - self.last_backup < BACKUP_DELAY:
+            return
+        self.last_backup = now
+        t = self.tick_t
+        data = self.backups.make_backup((player for player in self.players.values() if
+                                         player.dirty and get_chunk(player.get_pos(t)) in self.server_chunks_set), t)
+        if data is not None:
+            send_all(self.io, json_encode(data), self.lb_address, self.lb_fernet)
+
+    def send_load(self):
+        """
+        Report how busy the ticks are and the load of every chunk to the load balancer, every LOAD_REPORT_INTERVAL
+        seconds, it moves chunks between the servers when their loads are skewed
+        """
+        now = time.monotonic()
+        if now - self.last_load_report < LOAD_REPORT_INTERVAL:
+            return
+        self.last_load_report = now
+        chunk_loads = self.spatial_hash.cell_counts()
+        for chunk, players in self.spatial_hash.cell_counts(cls=Player).items():
+            chunk_loads[chunk] += (PLAYER_LOAD - 1) * players
+        ticks = int(LOAD_REPORT_INTERVAL / UPDATE_TICK)
+        data = {
+            'cmd': 'load',
+            'version': self.mapping_version,
+            'tick_time': self.tick_stats.mean_duration(ticks) if self.tick_stats is not None else 0.0,
+            'players': len(self.players),
+            'mobs': len(self.mobs),
+            'chunks': [[i, j, load] for (i, j), load in chunk_loads.items() if (i, j) in self.server_chunks_set]
+        }
+        send_all(self.io, json_encode(data), self.lb_address, self.lb_fernet)
+
+    def apply_chunk_mapping(self, chunk_mapping: List[List[int]], version: int):
+        """
+        Take over the chunks the load balancer gave this server and hand over the ones it gave to other servers
+        """
+        if version <= self.mapping_version:
+            return
+        logging.info(f'chunk mapping changed: {version=}')
+        lost = self.server_chunks_set.difference(
+            (i, j) for i, column in enumerate(chunk_mapping) for j, server_idx in enumerate(column)
+            if server_idx == self.server_idx)
+        self.chunk_mapping = chunk_mapping
+        self.mapping_version = version
+        self.set_chunks(*section_chunks(chunk_mapping, self.server_idx))
+        if lost:
+            self.migrate_chunks(lost)
+        # the servers around the border changed, the ones now around a player learn about it
+        for player in list(self.players.values()):
+            chunk = get_chunk(player.get_pos())
+            if chunk in self.server_chunks_set and chunk in self.shared_chunks_set:
+                self.create_and_forward_update({'cmd': 'player_enters', 'player': player}, entity_id=player.id)
+        self.prune_players()
+
+    def migrate_chunks(self, chunks: Set[Tuple[int, int]]):
+        """
+        Send the mobs, dropped items and players of chunks given to other servers to the load balancer, which hands
+        them to their new servers and redirects the players' clients there
+        """
+        migrations = {}
+        for obj in self.spatial_hash.query_chunks(chunks, t=self.tick_t):
+            chunk = get_chunk(obj.get_pos(self.tick_t))
+            migration = migrations.setdefault(self.chunk_mapping[chunk[0]][chunk[1]],
+                                              {'mobs': [], 'dropped': [], 'players': []})
+            if isinstance(obj, Mob):
+                migration['mobs'].append(obj)
+                self.remove_entity(obj)
+            elif isinstance(obj, Dropped):
+                migration['dropped'].append(obj)
+                self.remove_dropped(obj.item_id)
+            elif isinstance(obj, Player) and obj.id in self.id_to_fernet_address:
+                # the player stays until its client is removed, its commands keep coming here until it's redirected
+                migration['players'].append(obj)
+        for server_idx, migration in migrations.items():
+            logging.info(f'migrating chunks: {server_idx=}, {len(migration["mobs"])=}, {len(migration["players"])=}')
+            data = json_encode({'cmd': 'migrate', 'to': server_idx, **migration}, items=True, cooldowns=True,
+                               effects=True, t=self.tick_t)
+            send_all(self.io, data, self.lb_address, self.lb_fernet)
+
+    def adopt(self, data):
+        """
+        Take over the mobs, dropped items and clients of chunks another server lost, sent by the load balancer
+        """
+        for mob_data in data['mobs']:
+            self.add_entity(mob_from_dict(mob_data))
+        for dropped_data in data['dropped']:
+            self.add_dropped(Dropped(**dropped_data))
+        for player_data in data['players']:
+            # fresher than a copy this server may have
+            self.add_entity(player_from_dict(player_data))
+        for client in data['clients']:
+            self.add_client(self.players[client['id']], client['client'], client['client_key'], init=False,
+                            protocol=client.get('protocol', JSON))
+
+    def prune_players(self):
+        """
+        Forget the players of other servers that aren't around this server's section anymore
+        """
+        for player_id, player in list(self.players.items()):
+            if player_id in self.id_to_fernet_address:
+                continue
+            if self.server_idx not in get_adj_server_idx(self.chunk_mapping, get_chunk(player.get_pos())):
+                self.remove_entity(player)
 
 
 def main():
@@ -320,37 +493,42 @@ def main():
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock.bind(settings.SERVER_ADDRESSES[server_idx])
 
-    chunk_mapping = generate_chunk_mapping()
-
-    shared_chunks = []
-    for i in range(CHUNKS_X):
-        for j in range(CHUNKS_Y):
-            adj = get_adj_server_idx(chunk_mapping, (i, j))
-            if server_idx in adj and len(adj) > 1:
-                shared_chunks.append((i, j))
-
-    server_chunks = [(i, j) for i in range(CHUNKS_X) for j in range(CHUNKS_Y) if chunk_mapping[i][j] == server_idx]
+    server_chunks, shared_chunks = section_chunks(generate_chunk_mapping(), server_idx)
     logging.debug(f'{CHUNKS_X=}, {CHUNKS_Y=}, {server_idx=}')
     logging.debug(f'{server_chunks=}')
     logging.debug(f'{shared_chunks=}')
-    logging.debug(f'{chunk_mapping=}')
     logging.debug(f'{len(shared_chunks)=}, {len(server_chunks)=}')
 
-    server = NewServer(sock=sock, lb_address=LB_ADDRESS, shared_chunks=shared_chunks, server_chunks=server_chunks)
+    id_allocator.use_prefix(server_id_prefix(server_idx))
+    server = NewServer(sock=sock, lb_address=LB_ADDRESS, shared_chunks=shared_chunks, server_chunks=server_chunks,
+                       server_idx=server_idx)
     server.generate_mobs(MOB_COUNT)
+    if SHARD_WORKERS:
+        server.shards = ShardPool(server_chunks, server.walls, SHARD_WORKERS)
 
-    receive_thread = threading.Thread(target=server.receive_packets)
-    receive_thread.start()
-
-    backups_thread = threading.Thread(target=server.backups_sender)
-    backups_thread.start()
-
-    while True:
-        time.sleep(settings.UPDATE_TICK)
+    def tick():
+        server.begin_tick()
+        server.apply_commands()
         server.collisions_handler()
         server.send_updates()
         server.update_mobs()
         server.forward_updates()
+        server.send_backups()
+        server.send_load()
+
+    scheduler = TickScheduler(period=settings.UPDATE_TICK, tick=tick, policy=settings.TICK_POLICY,
+                              max_catch_up=settings.TICK_MAX_CATCH_UP, log_interval=settings.TICK_STATS_INTERVAL)
+    server.tick_stats = scheduler.stats
+    try:
+        if use_asyncio(RUNTIME):
+            async_runtime.run(sock, server.handle_datagram, scheduler)
+            return
+        receive_thread = threading.Thread(target=server.receive_packets)
+        receive_thread.start()
+        scheduler.run()
+    finally:
+        if server.shards is not None:
+            server.shards.close()
 
 
 if __name__ == '__main__':
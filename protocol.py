@@ -0,0 +1,353 @@
+"""
+Binary encoding of the game messages.
+A binary message is a version byte followed by the message's cmd code and its fields, encoded by the cmd's schema.
+Fields are laid out in schema order after a mask of the fields present (and a mask of the ones which are None), so
+the same schema covers every variant of a message. Updates which don't fit their schema (or have none) are embedded
+as JSON, and messages which don't fit at all are sent as plain JSON. JSON always starts with '{', which is never a
+version byte, so decode tells the two apart.
+"""
+import json
+import struct
+from typing import Callable, Dict, List, Optional, Tuple
+
+JSON, BINARY = 'json', 'binary'
+PROTOCOLS = [BINARY, JSON]  # supported protocols, in order of preference
+PROTOCOL_VERSION = 2
+
+ITEM_TYPES = ['speed_pot', 'heal_pot', 'strength_pot', 'useless_card']
+MOB_TYPES = ['dragon', 'demon']
+PROJECTILE_TYPES = ['sword', 'arrow', 'axe']
+ENTITY_KINDS = ['player', 'mob']
+MAX_LAYOUTS = 64  # of a struct, the orders of the fields in the dicts it encoded, see struct_of
+
+
+class ProtocolError(Exception):
+    pass
+
+
+# errors raised when a value doesn't fit its schema
+ENCODE_ERRORS = (ProtocolError, struct.error, KeyError, TypeError, ValueError, OverflowError, AttributeError)
+
+
+def negotiate(protocols: List[str]) -> str:
+    """
+    Pick the protocol to use with a peer
+    :param protocols: the protocols supported by the peer, in its order of preference
+    """
+    for protocol in protocols:
+        if protocol in PROTOCOLS:
+            return protocol
+    return JSON
+
+
+# a codec is a pair of functions:
+# encode(out: bytearray, value, default) appends the value, default converts objects to dicts like json's default
+# decode(data: bytes, offset: int) -> (value, offset after the value)
+
+# the encode of a fixed-size codec to its struct format, and how a value becomes the format's arguments: None if the
+# value is the argument, SPREAD if its items are, else a function returning the argument
+SPREAD = '*'
+FIXED_SIZE: Dict[Callable, Tuple[str, Optional[Callable]]] = {}
+
+
+def scalar(fmt: str):
+    s = struct.Struct('<' + fmt)
+    size = s.size
+    if len(fmt) == 1:
+        def encode(out, value, default):
+            out += s.pack(value)
+
+        def decode(data, offset):
+            return s.unpack_from(data, offset)[0], offset + size
+    else:
+        def encode(out, value, default):
+            out += s.pack(*value)
+
+        def decode(data, offset):
+            return list(s.unpack_from(data, offset)), offset + size
+    FIXED_SIZE[encode] = fmt, None if len(fmt) == 1 else SPREAD
+    return encode, decode
+
+
+def enum(values: List[str]):
+    index = {value: i for i, value in enumerate(values)}
+
+    def encode(out, value, default):
+        out.append(index[value])
+
+    def decode(data, offset):
+        return values[data[offset]], offset + 1
+    FIXED_SIZE[encode] = 'B', index.__getitem__
+    return encode, decode
+
+
+def string():
+    length = struct.Struct('<H')
+
+    def encode(out, value, default):
+        data = value.encode()
+        out += length.pack(len(data))
+        out += data
+
+    def decode(data, offset):
+        n, = length.unpack_from(data, offset)
+        offset += 2
+        return bytes(data[offset:offset + n]).decode(), offset + n
+    return encode, decode
+
+
+def list_of(codec):
+    item_encode, item_decode = codec
+    length = struct.Struct('<H')
+
+    def encode(out, value, default):
+        out += length.pack(len(value))
+        for item in value:
+            item_encode(out, item, default)
+
+    def decode(data, offset):
+        n, = length.unpack_from(data, offset)
+        offset += 2
+        result = []
+        for _ in range(n):
+            item, offset = item_decode(data, offset)
+            result.append(item)
+        return result, offset
+    return encode, decode
+
+
+def tuple_of(*codecs):
+    def encode(out, value, default):
+        if len(value) != len(codecs):
+            raise ProtocolError(f'wrong tuple length: {value=}')
+        for (item_encode, _), item in zip(codecs, value):
+            item_encode(out, item, default)
+
+    def decode(data, offset):
+        result = []
+        for _, item_decode in codecs:
+            item, offset = item_decode(data, offset)
+            result.append(item)
+        return result, offset
+    return encode, decode
+
+
+def compile_layout(fields, names: tuple) -> Callable:
+    """
+    Compile how struct_of encodes the dicts with the given keys, in this order, and no None values. Like namedtuple's
+    methods, the function is generated from source: every run of fixed-size fields, in schema order, is packed by a
+    single struct call, between the calls encoding the fields of other codecs
+    :return: encode(out, values, default), values are the dict's values
+    """
+    present = sum(1 << bit for bit, (name, _) in enumerate(fields) if name in names)
+    namespace = {}
+    lines, fmt, args = [], '<HH', [str(present), '0']  # the first struct packs the masks, no field is None
+
+    def pack():
+        namespace[f'pack{len(lines)}'] = struct.Struct(fmt).pack
+        lines.append(f'out += pack{len(lines)}({", ".join(args)})')
+
+    for name, (field_encode, _) in fields:
+        if name not in names:
+            continue
+        i = names.index(name)
+        if field_encode in FIXED_SIZE:
+            field_fmt, convert = FIXED_SIZE[field_encode]
+            fmt += field_fmt
+            if convert is None:
+                args.append(f'v[{i}]')
+            elif convert is SPREAD:
+                args.append(f'{SPREAD}v[{i}]')
+            else:
+                namespace[f'convert{i}'] = convert
+                args.append(f'convert{i}(v[{i}])')
+        else:
+            if args:
+                pack()
+            namespace[f'encode{i}'] = field_encode
+            lines.append(f'encode{i}(out, v[{i}], default)')
+            fmt, args = '<', []
+    if args:
+        pack()
+    exec('def encode(out, v, default):\n' + ''.join(f'    {line}\n' for line in lines), namespace)
+    return namespace['encode']
+
+
+def struct_of(*fields, ignored: tuple = ()):
+    """
+    A dict with the given (name, codec) fields, any of them may be missing or None.
+    :param ignored: keys the dict may have which aren't encoded, like the cmd of a message
+    Dicts without None values are encoded by the layout compiled for their keys, the same keys in the same order every
+    time for the dicts of a kind, so a record costs a struct or two instead of a call and a pack per field
+    """
+    if len(fields) > 16:
+        raise ProtocolError('too many fields for a struct')
+    known = {name for name, _ in fields} | set(ignored)
+    masks = struct.Struct('<HH')  # present fields, None fields
+    encoders = [(1 << bit, name, codec[0]) for bit, (name, codec) in enumerate(fields)]
+    decoders = [(1 << bit, name, codec[1]) for bit, (name, codec) in enumerate(fields)]
+    layouts = {}  # the keys of a dict to its compiled layout
+
+    def encode_fields(out, value, default):
+        start = len(out)
+        out += b'\0\0\0\0'
+        present = none = 0
+        for bit, name, field_encode in encoders:
+            if name in value:
+                present |= bit
+                field = value[name]
+                if field is None:
+                    none |= bit
+                else:
+                    field_encode(out, field, default)
+        masks.pack_into(out, start, present, none)
+
+    def encode(out, value, default):
+        if not isinstance(value, dict):
+            if default is None:
+                raise ProtocolError(f'not a dict: {value=}')
+            value = default(value)
+        names = tuple(value)
+        layout = layouts.get(names)
+        if layout is None:
+            if not value.keys() <= known:
+                raise ProtocolError(f'fields without a schema: {value.keys() - known}')
+            if len(layouts) >= MAX_LAYOUTS:
+                encode_fields(out, value, default)
+                return
+            layout = layouts[names] = compile_layout(fields, names)
+        values = tuple(value.values())
+        if None in values:
+            encode_fields(out, value, default)
+        else:
+            layout(out, values, default)
+
+    def decode(data, offset):
+        present, none = masks.unpack_from(data, offset)
+        offset += 4
+        result = {}
+        for bit, name, field_decode in decoders:
+            if present & bit:
+                if none & bit:
+                    result[name] = None
+                else:
+                    result[name], offset = field_decode(data, offset)
+        return result, offset
+    return encode, decode
+
+
+ID = scalar('Q')
+U8 = scalar('B')
+U32 = scalar('I')
+HEALTH = scalar('h')
+POS = scalar('ii')
+VECTOR = scalar('ff')  # directions aren't whole pixels
+STRING = string()
+
+PROJECTILE = struct_of(('id', ID), ('start_pos', POS), ('target', VECTOR), ('type', enum(PROJECTILE_TYPES)),
+                       ('attacker_id', ID))
+COLLISION = struct_of(('id1', ID), ('id2', ID), ('aligned1', POS), ('aligned2', POS), ('damage1', HEALTH),
+                      ('damage2', HEALTH))
+DROPPED = struct_of(('item_id', STRING), ('item_type', enum(ITEM_TYPES)), ('pos', POS))
+SNAPSHOT_RECORD = struct_of(('start_pos', POS), ('end_pos', POS), ('health', HEALTH), ('kind', enum(ENTITY_KINDS)),
+                            ('type', enum(MOB_TYPES)), ('username', STRING))
+
+
+def message_codec():
+    """
+    A message with a cmd, encoded by its cmd's schema and embedded as JSON when it doesn't fit
+    """
+    json_length = struct.Struct('<I')
+
+    def encode(out, value, default):
+        schema = SCHEMAS.get(value['cmd'])
+        if schema is not None:
+            start = len(out)
+            try:
+                out.append(CMD_CODES[value['cmd']])
+                schema[0](out, value, default)
+                return
+            except ENCODE_ERRORS:
+                del out[start:]
+        data = json.dumps(value, default=default).encode()
+        out.append(0)
+        out += json_length.pack(len(data))
+        out += data
+
+    def decode(data, offset):
+        code = data[offset]
+        offset += 1
+        if code == 0:
+            n, = json_length.unpack_from(data, offset)
+            offset += 4
+            return json.loads(bytes(data[offset:offset + n])), offset + n
+        cmd = CMDS[code - 1]
+        message, offset = SCHEMAS[cmd][1](data, offset)
+        message['cmd'] = cmd
+        return message, offset
+    return encode, decode
+
+
+MESSAGE = message_codec()
+
+
+def message_schema(*fields):
+    """
+    The schema of a message, the message's cmd is encoded by its code
+    """
+    return struct_of(*fields, ignored=('cmd',))
+
+
+SCHEMAS = {
+    'move': message_schema(('id', ID), ('pos', POS)),
+    'attack': message_schema(('id', ID)),
+    'projectile': message_schema(('id', ID), ('projectile', PROJECTILE)),
+    'collisions': message_schema(('collisions_data', list_of(COLLISION))),
+    'projectiles_expired': message_schema(('ids', list_of(ID))),
+    'player_leaves': message_schema(('id', ID)),
+    'entity_died': message_schema(('id', ID), ('drops', list_of(DROPPED))),
+    'item_dropped': message_schema(('id', ID), ('item_id', STRING), ('item_type', enum(ITEM_TYPES)), ('pos', POS)),
+    'item_picked': message_schema(('id', ID), ('item_id', STRING)),
+    'use_item': message_schema(('id', ID), ('item_id', STRING), ('item_type', enum(ITEM_TYPES))),
+    'use_skill': message_schema(('id', ID), ('skill_id', U8), ('extra', struct_of(('projectile_ids', list_of(ID))))),
+    'disconnect': message_schema(('id', ID)),
+    'ack': message_schema(('id', ID), ('seq', U32)),
+    'update': message_schema(('updates', list_of(MESSAGE))),
+    'snapshot': message_schema(('seq', U32), ('baseline', U32), ('entities', list_of(tuple_of(ID, SNAPSHOT_RECORD))),
+                               ('removed', list_of(ID))),
+}
+CMDS = list(SCHEMAS)  # code 0 is an embedded JSON message
+CMD_CODES = {cmd: i + 1 for i, cmd in enumerate(CMDS)}
+
+
+def encode(message: dict, protocol: str = BINARY, default: Optional[Callable] = None) -> bytes:
+    """
+    Encode a message
+    :param message: a dict with a cmd
+    :param protocol: BINARY or JSON, binary messages without a schema are sent as JSON
+    :param default: converts objects which aren't dicts, like json's default
+    :return: the encoded message
+    """
+    if protocol == BINARY and message.get('cmd') in SCHEMAS:
+        out = bytearray([PROTOCOL_VERSION, CMD_CODES[message['cmd']]])
+        try:
+            SCHEMAS[message['cmd']][0](out, message, default)
+            return bytes(out)
+        except ENCODE_ERRORS:
+            pass
+    return json.dumps(message, default=default).encode()
+
+
+def decode(data: bytes) -> dict:
+    """
+    Decode a message encoded with either protocol
+    """
+    if data[:1] == b'{':
+        return json.loads(data)
+    if not data or data[0] != PROTOCOL_VERSION:
+        raise ProtocolError(f'unknown protocol version: {data[:1]=}')
+    try:
+        message, _ = MESSAGE[1](data, 1)
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise ProtocolError(f'malformed message: {e}')
+    return message
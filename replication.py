@@ -0,0 +1,160 @@
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Hashable, Iterable, Optional, Set, Tuple
+
+from settings import BACKUP_RESEND, REPLICATED_FIELDS, SNAPSHOT_HISTORY
+
+Snapshot = Dict[int, dict]  # entity id to its record
+
+
+def diff_snapshots(baseline: Snapshot, snapshot: Snapshot) -> Tuple[list, list]:
+    """
+    Field level difference between two snapshots
+    :return: ([id, fields] pairs, removed ids), the fields are the whole record for entities new to the baseline and
+             only the changed REPLICATED_FIELDS otherwise
+    """
+    changed = []
+    for entity_id, record in snapshot.items():
+        old = baseline.get(entity_id)
+        if old is None:
+            changed.append([entity_id, record])
+        else:
+            fields = {key: record[key] for key in REPLICATED_FIELDS if record[key] != old[key]}
+            if fields:
+                changed.append([entity_id, fields])
+    removed = [entity_id for entity_id in baseline if entity_id not in snapshot]
+    return changed, removed
+
+
+def apply_delta(baseline: Snapshot, delta: dict) -> Snapshot:
+    """
+    Rebuild a snapshot from its baseline and a delta made by diff_snapshots, the baseline isn't changed
+    """
+    snapshot = dict(baseline)
+    for entity_id in delta['removed']:
+        snapshot.pop(entity_id, None)
+    for entity_id, fields in delta['entities']:
+        snapshot[entity_id] = {**snapshot.get(entity_id, {}), **fields}
+    return snapshot
+
+
+@dataclass
+class ClientReplication:
+    seq: int = 0  # of the last snapshot sent
+    acked: Optional[int] = None  # the latest snapshot the client acknowledged
+    sent: Dict[int, Snapshot] = field(default_factory=dict)  # seq to snapshot, the ones which may still be acked
+
+
+class SnapshotReplicator:
+    """
+    Server side of snapshot replication.
+    Every client is sent deltas against the last snapshot it acknowledged, so a lost packet costs nothing but a
+    bigger next delta, there is no need to resync the client. When nothing was acknowledged (or the acknowledged
+    snapshot is too old) the delta is against an empty baseline, i.e. the full snapshot.
+    """
+
+    def __init__(self, history: int = SNAPSHOT_HISTORY):
+        self.history = history
+        self.clients: Dict[Hashable, ClientReplication] = {}
+
+    def make_delta(self, key: Hashable, snapshot: Snapshot) -> dict:
+        """
+        Record the snapshot sent to a client
+        :param key: the client
+        :param snapshot: what the client should see now
+        :return: the snapshot message to send
+        """
+        client = self.clients.setdefault(key, ClientReplication())
+        client.seq += 1
+        client.sent[client.seq] = snapshot
+        if len(client.sent) > self.history:
+            oldest = min(client.sent)
+            del client.sent[oldest]
+            if client.acked == oldest:
+                client.acked = None
+
+        baseline = client.sent.get(client.acked, {}) if client.acked is not None else {}
+        changed, removed = diff_snapshots(baseline, snapshot)
+        return {'cmd': 'snapshot', 'seq': client.seq, 'baseline': client.acked if baseline else None,
+                'entities': changed, 'removed': removed}
+
+    def ack(self, key: Hashable, seq: int):
+        client = self.clients.get(key)
+        if client is None or seq not in client.sent or (client.acked is not None and seq <= client.acked):
+            return
+        client.acked = seq
+        for old in [s for s in client.sent if s < seq]:
+            del client.sent[old]
+
+    def remove_client(self, key: Hashable):
+        self.clients.pop(key, None)
+
+
+class SnapshotReceiver:
+    """
+    Client side of snapshot replication, keeps the snapshots the server may still use as baselines
+    """
+
+    def __init__(self):
+        self.snapshots: Dict[int, Snapshot] = {}
+        self.latest: Optional[int] = None
+
+    def receive(self, message: dict) -> Optional[Tuple[Snapshot, Snapshot]]:
+        """
+        Rebuild the snapshot of a message
+        :return: (the previous snapshot, the new one), None if the message is late or its baseline is unknown
+        """
+        seq, baseline = message['seq'], message['baseline']
+        if self.latest is not None and seq <= self.latest:
+            return None
+        if baseline is not None and baseline not in self.snapshots:
+            return None
+        snapshot = apply_delta(self.snapshots[baseline] if baseline is not None else {}, message)
+        previous = self.snapshots.get(self.latest, {})
+        self.snapshots[seq] = snapshot
+        self.latest = seq
+        # the server only moves its baseline forward, older snapshots will never be used again
+        oldest = baseline if baseline is not None else seq
+        for old in [s for s in self.snapshots if s < oldest]:
+            del self.snapshots[old]
+        return previous, snapshot
+
+
+class BackupTracker:
+    """
+    Server side of the players' backups to the database, through the load balancer.
+    A backup carries the persisted fields of the players that changed since they were backed up (Player.dirty), so
+    idle players cost nothing. The load balancer acknowledges every backup, the fields of a backup which isn't
+    acknowledged within resend_after seconds are dirty again and go with the next one.
+    """
+
+    def __init__(self, resend_after: float = BACKUP_RESEND):
+        self.resend_after = resend_after
+        self.seq = 0
+        self.sent: Dict[int, Tuple[float, list]] = {}  # seq to (when it was sent, its (player, fields) pairs)
+
+    def make_backup(self, players: Iterable, t: int = None) -> Optional[dict]:
+        """
+        :param players: the players the server backs up
+        :return: the backups message, None if nothing changed
+        """
+        now = time.monotonic()
+        for seq in [seq for seq, (sent_at, _) in self.sent.items() if now - sent_at > self.resend_after]:
+            for player, fields in self.sent.pop(seq)[1]:
+                player.dirty |= fields
+
+        records, sent = [], []
+        for player in players:
+            fields: Set[str] = player.dirty
+            if fields:
+                player.dirty = set()
+                records.append(player.backup(fields, t))
+                sent.append((player, fields))
+        if not records:
+            return None
+        self.seq += 1
+        self.sent[self.seq] = now, sent
+        return {'cmd': 'backups', 'seq': self.seq, 'players': records}
+
+    def ack(self, seq: int):
+        self.sent.pop(seq, None)
@@ -1,3 +1,4 @@
+import asyncio
 import socket
 import threading
 from settings import *
@@ -79,6 +80,51 @@ class ChatServer:
                 pass
 
 
+class AsyncChatServer(ChatServer):
+    """
+    ChatServer on asyncio streams, every client is a task of the event loop instead of a thread
+    """
+
+    async def start(self):
+        server = await asyncio.start_server(self.handle_client, *SERVER_ADDRESS_TCP)
+        async with server:
+            await server.serve_forever()
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        writer.write("Connected successfully".encode())
+        client_port = writer.get_extra_info('peername')[1]
+        name = None
+        try:
+            name = await reader.read(HEADER_SIZE)
+            # DECRYPT WITH START SEED
+            seed = ascii_seed(chat_start_seed) ^ client_port  # BARAK GONEN XOR'd WITH PORT
+            seed %= 1000
+            name = decrypt_data(name, client_port, seed, start=True)
+            self.clients.append(writer)
+            self.names.append(name)
+
+            while True:
+                message = await reader.read(HEADER_SIZE)
+                if not message:
+                    break
+                # CHANGE SEED:
+                seed += (client_port + ascii_seed(chat_start_seed))
+                seed %= 1000
+                data = decrypt_data(message, client_port, seed)
+                self.broadcast("{}: {}".format(name, data))
+        except Exception:
+            logging.exception(f'exception while handling chat client: {name, client_port}')
+        if writer in self.clients:
+            index = self.clients.index(writer)
+            del self.clients[index]
+            del self.names[index]
+        writer.close()
+
+    def broadcast(self, message):
+        for writer in self.clients:
+            writer.write(message.encode())
+
+
 def main():
     server1 = ChatServer()
     server1.start()
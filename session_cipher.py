@@ -0,0 +1,131 @@
+import itertools
+import os
+import struct
+import threading
+import time
+from typing import Dict, Hashable
+
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import InvalidToken
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+
+from settings import FERNET_TTL, REPLAY_WINDOW
+
+PREFIX_SIZE = 4
+NONCE_SIZE = 12
+TIMESTAMP_SIZE = 8
+HEADER_SIZE = NONCE_SIZE + TIMESTAMP_SIZE
+TAG_SIZE = 16
+COUNTER = struct.Struct('>Q')
+TIMESTAMP = struct.Struct('>Q')  # ms since the epoch
+MAX_CLOCK_SKEW = 60  # seconds a packet's time may be ahead of the receiver's clock, like Fernet
+
+
+class ReplayWindow:
+    """
+    Sliding window of the counters seen from one sender, like IPsec's anti-replay window.
+    A counter is accepted once, and only if it is newer than the highest counter seen minus the window size.
+    """
+
+    def __init__(self, size: int = REPLAY_WINDOW):
+        self.size = size
+        self.highest = -1
+        self.seen = 0  # bit i is set if highest - i was seen
+
+    def check(self, counter: int) -> bool:
+        if counter > self.highest:
+            return True
+        offset = self.highest - counter
+        return offset < self.size and not self.seen >> offset & 1
+
+    def update(self, counter: int):
+        if counter > self.highest:
+            self.seen = (self.seen << (counter - self.highest) | 1) & ((1 << self.size) - 1)
+            self.highest = counter
+        else:
+            self.seen |= 1 << (self.highest - counter)
+
+
+class NonceCache:
+    """
+    Replay protection of the first message of a session, whose cipher is new and has no replay window yet.
+    The message carries its time and a random nonce inside the ciphertext, it's accepted if its time is within ttl of
+    now and its nonce wasn't seen, the nonces are kept until their messages are stale.
+    """
+
+    def __init__(self, ttl: float = FERNET_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()  # the logins are checked by several threads
+        self.expiries: Dict[Hashable, float] = {}  # nonce to when its message is stale, in the order they were seen
+
+    def check(self, nonce: Hashable, timestamp) -> bool:
+        """
+        :param timestamp: the time.time() at which the message was sent
+        :return: whether the message is fresh and wasn't seen before, it is remembered if it is
+        """
+        now = time.time()
+        if not isinstance(timestamp, (int, float)) or abs(now - timestamp) > self.ttl:
+            return False
+        with self.lock:
+            while self.expiries:
+                seen = next(iter(self.expiries))
+                if self.expiries[seen] > now:
+                    break
+                del self.expiries[seen]
+            if nonce in self.expiries:
+                return False
+            self.expiries[nonce] = timestamp + self.ttl
+            return True
+
+
+class SessionCipher:
+    """
+    ChaCha20-Poly1305 session cipher for the game channel, a drop in replacement for Fernet (encrypt / decrypt).
+    Every side of a session has its own key, derived from the ECDH shared secret, so the two directions never share
+    nonces. The nonce is a random prefix chosen by every cipher instance (several servers encrypt with the same key)
+    followed by a message counter, it is sent in the clear in front of the ciphertext. Replays are rejected with a
+    window per sender prefix. Every server derives the same keys for a client and a server adopting a client starts
+    with no windows, so the packets also carry the time they were sent, authenticated, and decrypt rejects the packets
+    older than its ttl like Fernet.
+    Packet: prefix (4) | counter (8) | time (8) | ciphertext | tag (16)
+    """
+
+    def __init__(self, send_key: bytes, receive_key: bytes, window_size: int = REPLAY_WINDOW):
+        self.send_aead = ChaCha20Poly1305(send_key)
+        self.receive_aead = ChaCha20Poly1305(receive_key)
+        self.prefix = os.urandom(PREFIX_SIZE)
+        self.counter = itertools.count()  # next() is atomic, the cipher is shared between threads
+        self.window_size = window_size
+        self.windows: Dict[bytes, ReplayWindow] = {}  # sender prefix to its window
+
+    def encrypt(self, data: bytes) -> bytes:
+        nonce = self.prefix + COUNTER.pack(next(self.counter))
+        header = nonce + TIMESTAMP.pack(time.time_ns() // 1000000)
+        return header + self.send_aead.encrypt(nonce, data, header)
+
+    def decrypt(self, token: bytes, ttl: int = None) -> bytes:
+        """
+        :param token: a packet made by the other side's encrypt
+        :param ttl: seconds after which a packet is rejected, None to accept any age, see NonceCache for the first
+        message of a session
+        :raise InvalidToken: if the packet is incomplete, forged, replayed or expired, like Fernet
+        """
+        if len(token) < HEADER_SIZE + TAG_SIZE:
+            raise InvalidToken
+        nonce, prefix, header = token[:NONCE_SIZE], token[:PREFIX_SIZE], token[:HEADER_SIZE]
+        counter, = COUNTER.unpack_from(token, PREFIX_SIZE)
+        sent, = TIMESTAMP.unpack_from(token, NONCE_SIZE)
+        age = time.time_ns() // 1000000 - sent
+        if ttl is not None and age > ttl * 1000 or age < -MAX_CLOCK_SKEW * 1000:
+            raise InvalidToken
+        window = self.windows.get(prefix)
+        if window is not None and not window.check(counter):
+            raise InvalidToken
+        try:
+            data = self.receive_aead.decrypt(nonce, token[HEADER_SIZE:], header)
+        except InvalidTag:
+            raise InvalidToken
+        if window is None:
+            window = self.windows[prefix] = ReplayWindow(self.window_size)
+        window.update(counter)
+        return data
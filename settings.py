@@ -1,4 +1,5 @@
 import logging
+import os
 
 import pytmx
 
@@ -18,8 +19,37 @@ USERS_FILE = r'data\Users.txt'
 PLAYERS_FILE = r'data\Players.txt'
 
 UPDATE_TICK = 0.1
+TICK_POLICY = 'skip'  # 'skip' or 'catch_up', what to do with ticks missed because of an overrun
+TICK_MAX_CATCH_UP = 5
+TICK_STATS_INTERVAL = 600  # log tick stats every that many ticks, 0 to disable
+MAX_QUEUED_COMMANDS = 10000  # received commands waiting for the tick, more are dropped
+RUNTIME = os.environ.get('GAME_RUNTIME', 'threads')  # 'threads' or 'asyncio', how the servers and the load balancer run
+# worker processes finding the collisions of a section server, 0 to find them in the server's process
+SHARD_WORKERS = int(os.environ.get('GAME_SHARD_WORKERS', 0))
+AUTH_WORKERS = 4  # threads of the load balancer running logins, each with its own database connection
+AUTH_HASH_PROCESSES = os.cpu_count() or 1  # processes hashing the passwords of the logins
+AUTH_MAX_PENDING = 256  # logins waiting for a worker, the load balancer turns down more
+AUTH_MAX_PER_HOST = 4  # logins of a single ip address waiting for a worker
+AUTH_MAX_WAIT = 2  # seconds a login waits for a worker before it's turned down, like FERNET_TTL
+DB_BACKEND = os.environ.get('GAME_DB_BACKEND', 'mysql')  # 'mysql' or 'sqlite', see storage
+SQLITE_PATH = os.environ.get('GAME_SQLITE_PATH', 'dragonraja.db')  # the database file of the sqlite backend
+SQLITE_BUSY_TIMEOUT = 5  # seconds an sqlite write waits for another connection's write
+DB_POOL_SIZE = AUTH_WORKERS + 2  # database connections, the auth workers', the write-behind worker's and the loop's
+DB_FLUSH_INTERVAL = 1  # seconds between the writes of the queued player backups
+DB_MAX_BATCH = 1000  # player backups written by a single transaction
+DB_CLOSE_ATTEMPTS = 3  # failed writes of the queued player backups on shutdown before they're given up
+DB_STATS_INTERVAL = 60  # log the write-behind stats every that many flushes, 0 to disable
 
 HEADER_SIZE = 1024
+MTU = 1400  # biggest datagram sent, fragments included
+MAX_FRAGMENTS = 4096  # of a single message
+REASSEMBLY_TIMEOUT = 2  # seconds to wait for the missing fragments of a message
+MAX_PENDING_MESSAGES = 16  # incomplete messages kept per peer
+MAX_PENDING_BYTES = 8 * 1024 * 1024  # memory of the incomplete messages kept per peer
+IO_BATCH_SIZE = 64  # datagrams received per wakeup
+IO_ADDRESS_CACHE = 4096  # the converted addresses a socket keeps, the least recently used are dropped
+SOCKET_RECV_BUFFER = 4 * 1024 * 1024  # asked for, the kernel caps it (net.core.rmem_max on linux)
+SOCKET_SEND_BUFFER = 4 * 1024 * 1024
 ENCODING = 'utf-8'
 
 TILESIZE = 64
@@ -30,10 +60,34 @@ BGCOLOR = "#71ddee"
 BLACK, RED = "#000000", "#FF0000"
 
 CHUNK_SIZE = 500
+COLLISION_RADIUS = 100
+DEMON_CHASE_RADIUS = 1000
 LB_ADDRESS = ('127.0.0.1', 13579)
 MULTIPLE_SERVERS = True
 ENABLE_SHADOWS = False
+ENABLE_WORLD_STORE = True
+ENABLE_AOI = True  # only send clients the updates happening around them
+AOI_RADIUS = 2  # in chunks, around the chunk a client is in
+ENABLE_SNAPSHOTS = True  # replicate entity state with acknowledged deltas instead of move updates
+SNAPSHOT_HISTORY = 64  # unacknowledged snapshots kept per client
+REPLICATED_FIELDS = ['end_pos', 'health']  # the fields of a snapshot record sent when they change
+REPLICATED_UPDATES = ['move']  # updates made redundant by snapshots
+# updates every client gets regardless of where they happen, they add or remove objects
+GLOBAL_UPDATES = ['player_enters', 'player_leaves', 'entity_died', 'item_picked', 'projectiles_expired', 'shadows']
 MOB_COUNT = 100
+ID_PREFIX_BITS = 15  # the high bits of an entity id, the process which allocated it, 63 bits in total to fit signed ints
+ID_SEQUENCE_BITS = 48
+PLAYER_ID_PREFIX = 0  # the load balancer's, section server i allocates with PLAYER_ID_PREFIX + 1 + i
+ID_RECYCLE_DELAY = 30  # seconds before a released entity id is allocated again
+LOAD_REPORT_INTERVAL = 5  # seconds between the load reports of the section servers to the load balancer
+PLAYER_LOAD = 10  # how many mobs a player loads a server as much as, for the reported chunk loads
+REBALANCE_INTERVAL = 30  # seconds between two changes of the chunk mapping
+REBALANCE_THRESHOLD = 1.5  # the chunk mapping changes when the busiest server is that many times above the mean
+REBALANCE_MIN_LOAD = 0.5  # and busy for that part of the tick period at least
+REBALANCE_MAX_CHUNKS = 32  # chunks with entities moved by a single change, empty ones cost nothing to move
+MOB_MOVE_INTERVAL = 10  # seconds between the moves of a mob, on average
+MOB_ATTACK_INTERVAL = 1  # seconds between the attacks of a mob, on average, while a player is close enough
+MOB_ATTACK_RADIUS = 500  # mobs attack players this close, and mobs without players this close don't think about it
 
 MAP_COEFFICIENT = 4
 tm = pytmx.TiledMap("./maps/map_new.tmx")
@@ -53,6 +107,7 @@ INVENTORY_SIZE = 10
 PLAYER_SIZE = [50, 30]
 MOB_SIZE = [50, 30]
 PROJECTILE_SIZE = [40, 40]
+PROJECTILE_RANGE = 3000  # pixels a projectile flies before it's removed
 chat_start_seed = "Barak_Gonen"
 
 COOLDOWN_DURATIONS = {
@@ -61,5 +116,8 @@ COOLDOWN_DURATIONS = {
 }
 
 BACKUP_DELAY = 1
+BACKUP_RESEND = 5  # seconds before the changes of a backup the load balancer didn't acknowledge are sent again
 
 FERNET_TTL = 2
+GAME_CIPHER = 'chacha20poly1305'  # cipher of the client channels, 'chacha20poly1305' or 'fernet'
+REPLAY_WINDOW = 256  # how many recent packets of every sender are tracked for replays
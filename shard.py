@@ -0,0 +1,196 @@
+"""
+Collision detection of a section server split across worker processes.
+The section's chunks are split into bands of chunk columns, one per worker. Every tick the server writes the
+positions, sizes and damage of its entities into a shared memory table, every worker finds the collisions of the
+entities in its band, reading the entities of the neighbouring bands within COLLISION_RADIUS of its borders from the
+same table, and sends back the few collisions it found. The server keeps its clients, its state and the load balancer
+protocol, and applies the collisions like it applies its own.
+"""
+import logging
+import math
+import multiprocessing
+from collections import Counter
+from multiprocessing import shared_memory
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from scipy.spatial import KDTree
+
+from my_server import Wall, collision_outcome
+from settings import CHUNK_SIZE, COLLISION_RADIUS, SHARD_WORKERS
+from spatial import StaticIndex
+from world_store import ENTITY, WorldStore
+
+# the columns of a row of the entity table
+POS, AFTER, SIZE, DAMAGE = slice(0, 2), slice(2, 4), slice(4, 6), 6
+ROW_SIZE = 7
+WALL = -1  # the second row of a collision with a wall
+# (row1, row2 or WALL, aligned1, aligned2, damage1, damage2), see collision_outcome
+Collision = Tuple[int, int, Optional[tuple], Optional[tuple], int, int]
+
+
+def split_bands(server_chunks: Sequence[Tuple[int, int]], workers: int) -> List[Tuple[float, float]]:
+    """
+    Split the chunks into bands of whole columns holding about as many chunks each
+    :return: (min_x, max_x) of every band in pixels, the first and last bands are unbounded so every entity is in one
+    """
+    columns = Counter(x for x, _ in server_chunks)
+    starts, seen = [], 0
+    for x in sorted(columns):
+        if len(starts) < workers and seen >= len(starts) * len(server_chunks) / workers:
+            starts.append(x * CHUNK_SIZE)
+        seen += columns[x]
+    bounds = [-math.inf] + starts[1:] + [math.inf]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def open_table(shm: shared_memory.SharedMemory, capacity: int) -> np.ndarray:
+    return np.ndarray((capacity, ROW_SIZE), dtype=np.int64, buffer=shm.buf)
+
+
+def find_collisions(table: np.ndarray, band: Tuple[float, float], radius: float,
+                    wall_index: StaticIndex) -> List[Collision]:
+    """
+    Find the collisions of the entities of a band, a pair of entities belongs to the band of the one further left
+    :param table: the rows of the tick's entities
+    """
+    min_x, max_x = band
+    x = table[:, 0]
+    near = np.flatnonzero((x >= min_x - radius) & (x < max_x + radius))
+    rows = table[near].tolist()
+    collisions = []
+    if len(near) >= 2:
+        for i, j in KDTree(table[near, POS]).query_pairs(radius):
+            row1, row2 = rows[i], rows[j]
+            if not min_x <= min(row1[0], row2[0]) < max_x:
+                continue
+            if near[i] > near[j]:
+                i, j, row1, row2 = j, i, row2, row1
+            outcome = collision_outcome(row1[POS], row1[AFTER], row1[SIZE], row2[POS], row2[AFTER], row2[SIZE],
+                                        row2[DAMAGE], row1[DAMAGE])
+            if outcome is not None:
+                collisions.append((int(near[i]), int(near[j])) + outcome)
+    own = [i for i, row in enumerate(rows) if min_x <= row[0] < max_x]
+    near_walls = wall_index.query_many([rows[i][POS] for i in own], radius)
+    for i, walls in zip(own, near_walls):
+        row = rows[i]
+        for wall in walls:
+            pos, size = wall.get_pos(), wall.get_size()
+            outcome = collision_outcome(row[POS], row[AFTER], row[SIZE], pos, pos, size)
+            if outcome is not None:
+                collisions.append((int(near[i]), WALL) + outcome)
+    return collisions
+
+
+def run_shard(connection, band: Tuple[float, float], radius: float, walls: List[Tuple[tuple, tuple]]):
+    """
+    The loop of a worker process, every message is a tick to run until None
+    """
+    wall_index = StaticIndex([Wall(pos=pos, size=size) for pos, size in walls])
+    shm, table = None, None
+    try:
+        while True:
+            message = connection.recv()
+            if message is None:
+                break
+            name, capacity, count = message
+            if shm is None or shm.name != name:
+                if shm is not None:
+                    table = None
+                    shm.close()
+                shm = shared_memory.SharedMemory(name=name)
+                table = open_table(shm, capacity)
+            connection.send(find_collisions(table[:count], band, radius, wall_index))
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        if shm is not None:
+            table = None
+            shm.close()
+
+
+class ShardPool:
+    """
+    The worker processes of a section server and their shared entity table
+    """
+
+    def __init__(self, server_chunks: Sequence[Tuple[int, int]], walls: Sequence[Wall], workers: int = SHARD_WORKERS,
+                 capacity: int = 1024):
+        self.bands = split_bands(server_chunks, workers)
+        self.capacity = capacity
+        self.shm = shared_memory.SharedMemory(create=True, size=capacity * ROW_SIZE * 8)
+        self.table = open_table(self.shm, capacity)
+        self.connections = []
+        self.processes = []
+        wall_boxes = [(tuple(wall.get_pos()), tuple(wall.get_size())) for wall in walls]
+        for band in self.bands:
+            connection, child_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=run_shard, args=(child_connection, band, COLLISION_RADIUS,
+                                                                      wall_boxes), daemon=True)
+            process.start()
+            child_connection.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+        logging.debug(f'collision shards started: {self.bands=}')
+
+    def __len__(self):
+        return len(self.processes)
+
+    def reserve(self, count: int) -> np.ndarray:
+        """
+        :return: the table with room for count rows, to be filled before collide
+        """
+        if count > self.capacity:
+            while self.capacity < count:
+                self.capacity *= 2
+            # the workers map the new table on their next tick, the old one lives until they unmap it
+            old = self.shm
+            self.shm = shared_memory.SharedMemory(create=True, size=self.capacity * ROW_SIZE * 8)
+            self.table = open_table(self.shm, self.capacity)
+            old.close()
+            old.unlink()
+        return self.table[:count]
+
+    def collide(self, world_store: WorldStore, t: int, t_after: int, attackers: Iterable) -> List[tuple]:
+        """
+        Find the collisions of the entities of a world store, the workers run in parallel
+        :param t_after: when the entities are aligned at, see collision_outcome
+        :param attackers: the attacking entities, they damage the entities they touch
+        :return: (entity, entity or None for walls, aligned1, aligned2, damage1, damage2) tuples
+        """
+        rows = np.flatnonzero(world_store.kind[:world_store.size] == ENTITY)
+        table = self.reserve(len(rows))
+        table[:, POS] = world_store.positions_at(t)[rows]
+        table[:, AFTER] = world_store.positions_at(t_after)[rows]
+        table[:, SIZE] = world_store.extent[rows]
+        table[:, DAMAGE] = 0
+        table_rows = {row: i for i, row in enumerate(rows.tolist())}
+        for attacker in attackers:
+            i = table_rows.get(world_store.rows.get(id(attacker)))
+            if i is not None:
+                table[i, DAMAGE] = attacker.get_damage()
+        del table
+
+        for connection in self.connections:
+            connection.send((self.shm.name, self.capacity, len(rows)))
+        collisions = []
+        for connection in self.connections:
+            collisions += connection.recv()
+        objects = world_store.objects
+        return [(objects[rows[i]], None if j == WALL else objects[rows[j]], *outcome)
+                for i, j, *outcome in collisions]
+
+    def close(self):
+        for connection in self.connections:
+            try:
+                connection.send(None)
+            except OSError:
+                pass
+            connection.close()
+        for process in self.processes:
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
+        self.table = None
+        self.shm.close()
+        self.shm.unlink()
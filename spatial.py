@@ -0,0 +1,255 @@
+from typing import Any, Collection, Dict, Iterable, List, Sequence, Tuple
+
+from scipy.spatial import KDTree
+
+from settings import CHUNK_SIZE
+from utils import dist, get_chunk
+
+Bounds = Tuple[int, int, int, int]  # min_x, min_y, max_x, max_y
+
+
+class StaticIndex:
+    """
+    A spatial index over hitboxes that never move (e.g. walls), built once when the map is loaded
+    """
+
+    def __init__(self, hitboxes: Iterable):
+        self.hitboxes = list(hitboxes)
+        self.tree = KDTree([hitbox.get_pos() for hitbox in self.hitboxes]) if self.hitboxes else None
+        # positions are top left corners, boxes are found by searching further by the biggest box's diagonal
+        self.max_diagonal = max([dist((0, 0), hitbox.get_size()) for hitbox in self.hitboxes], default=0)
+
+    def query_radius(self, pos: Tuple[int, int], radius: float) -> list:
+        """
+        Find the static hitboxes whose position is within a radius of a point
+        :param pos: the point to search around
+        :param radius: the search radius
+        :return: a list of hitboxes
+        """
+        if self.tree is None:
+            return []
+        return [self.hitboxes[i] for i in self.tree.query_ball_point(pos, radius)]
+
+    def query_aabb(self, bounds: Bounds) -> list:
+        """
+        Find the static hitboxes overlapping a box
+        :param bounds: (min_x, min_y, max_x, max_y)
+        :return: a list of hitboxes
+        """
+        min_x, min_y, max_x, max_y = bounds
+        center = (min_x + max_x) / 2, (min_y + max_y) / 2
+        radius = dist((min_x, min_y), center) + self.max_diagonal
+        result = []
+        for hitbox in self.query_radius(center, radius):
+            (x, y), (w, h) = hitbox.get_pos(), hitbox.get_size()
+            if x < max_x and x + w > min_x and y < max_y and y + h > min_y:
+                result.append(hitbox)
+        return result
+
+    def query_many(self, positions: Sequence[Tuple[int, int]], radius: float) -> List[list]:
+        """
+        Batched version of query_radius, one KDTree call for all the positions
+        :param positions: the points to search around
+        :param radius: the search radius
+        :return: a list of hitbox lists, one for every position
+        """
+        if self.tree is None or not positions:
+            return [[] for _ in positions]
+        return [[self.hitboxes[i] for i in idxs] for idxs in self.tree.query_ball_point(positions, radius)]
+
+
+def time_of_impact(pos_before1: Tuple[int, int], pos_after1: Tuple[int, int], size1: Tuple[int, int],
+                   pos_before2: Tuple[int, int], pos_after2: Tuple[int, int], size2: Tuple[int, int]):
+    """
+    Swept AABB test of two boxes moving linearly during an interval, positions are top left corners
+    :return: the part of the interval (between 0 and 1) after which the boxes first overlap, None if they don't
+    """
+    t_enter, t_exit = 0.0, 1.0
+    for axis in range(2):
+        # position of box 1 relative to box 2, the boxes overlap on this axis while -size1 < offset < size2
+        offset = pos_before1[axis] - pos_before2[axis]
+        velocity = (pos_after1[axis] - pos_after2[axis]) - offset
+        if velocity == 0:
+            if not -size1[axis] < offset < size2[axis]:
+                return None
+            continue
+        enter, exit_ = (-size1[axis] - offset) / velocity, (size2[axis] - offset) / velocity
+        if enter > exit_:
+            enter, exit_ = exit_, enter
+        t_enter, t_exit = max(t_enter, enter), min(t_exit, exit_)
+        if t_enter >= t_exit:
+            return None
+    return t_enter
+
+
+class SpatialHash:
+    """
+    A uniform grid keyed on chunks, kept up to date incrementally whenever a tracked object moves.
+    An object is stored in every cell that its bounds (see Entity.get_bounds) overlap, so it can be found at any
+    time during its movement without being re-inserted every tick.
+    """
+
+    def __init__(self, cell_size: int = CHUNK_SIZE, indexed_classes: Tuple[type, ...] = ()):
+        """
+        :param indexed_classes: classes whose instances are also kept in cells of their own, so queries for them
+                                don't go over the other objects (players among many mobs)
+        """
+        self.cell_size = cell_size
+        self.cells: Dict[Tuple[int, int], Dict[int, Any]] = {}
+        self.class_cells: Dict[type, Dict[Tuple[int, int], Dict[int, Any]]] = {cls: {} for cls in indexed_classes}
+        self.object_cells: Dict[int, List[Tuple[int, int]]] = {}
+        self.objects: Dict[int, Any] = {}
+        self._type_matches: Dict[Tuple[type, Any], bool] = {}  # isinstance cache, ABC checks are slow
+
+    def __len__(self):
+        return len(self.object_cells)
+
+    def __contains__(self, obj):
+        return id(obj) in self.object_cells
+
+    def matches(self, obj, cls) -> bool:
+        if cls is None:
+            return True
+        key = type(obj), cls
+        if key not in self._type_matches:
+            self._type_matches[key] = isinstance(obj, cls)
+        return self._type_matches[key]
+
+    def get_cells(self, bounds: Bounds) -> List[Tuple[int, int]]:
+        min_x, min_y, max_x, max_y = bounds
+        return [(i, j) for i in range(int(min_x) // self.cell_size, int(max_x) // self.cell_size + 1)
+                for j in range(int(min_y) // self.cell_size, int(max_y) // self.cell_size + 1)]
+
+    def insert(self, obj):
+        key = id(obj)
+        if key in self.object_cells:
+            self.remove(obj)
+        cells = self.get_cells(obj.get_bounds())
+        for cell in cells:
+            self.cells.setdefault(cell, {})[key] = obj
+        for cls, class_cells in self.class_cells.items():
+            if self.matches(obj, cls):
+                for cell in cells:
+                    class_cells.setdefault(cell, {})[key] = obj
+        self.object_cells[key] = cells
+        self.objects[key] = obj
+
+    def remove(self, obj):
+        key = id(obj)
+        cells = self.object_cells.pop(key, None)
+        if cells is None:
+            return
+        obj = self.objects.pop(key)
+        indexes = [self.cells] + [class_cells for cls, class_cells in self.class_cells.items() if self.matches(obj, cls)]
+        for all_cells in indexes:
+            for cell in cells:
+                bucket = all_cells[cell]
+                del bucket[key]
+                if not bucket:
+                    del all_cells[cell]
+
+    def update(self, obj):
+        """
+        Re-index an object after its bounds changed, does nothing for objects which aren't tracked
+        :param obj: the moved object
+        """
+        key = id(obj)
+        if key not in self.object_cells:
+            return
+        if self.get_cells(obj.get_bounds()) != self.object_cells[key]:
+            self.insert(obj)
+
+    def candidates(self, bounds: Bounds, cls=None) -> Dict[int, Any]:
+        """
+        Broadphase query, return every object stored in a cell overlapping the bounds
+        :param bounds: (min_x, min_y, max_x, max_y)
+        :param cls: if it's an indexed class, only its instances are returned, otherwise it's ignored
+        :return: a dict of the objects by their python id
+        """
+        cells = self.class_cells.get(cls, self.cells)
+        result = {}
+        for cell in self.get_cells(bounds):
+            bucket = cells.get(cell)
+            if bucket:
+                result.update(bucket)
+        return result
+
+    def query_aabb(self, bounds: Bounds, t: int = None, cls=None) -> list:
+        """
+        Find the objects whose position at time t is inside the bounds
+        :param bounds: (min_x, min_y, max_x, max_y)
+        :param t: time in ns, now if not given
+        :param cls: only return instances of this class (or tuple of classes)
+        :return: a list of objects
+        """
+        min_x, min_y, max_x, max_y = bounds
+        result = []
+        for obj in self.candidates(bounds, cls).values():
+            if not self.matches(obj, cls):
+                continue
+            pos = obj.get_pos(t)
+            if min_x <= pos[0] <= max_x and min_y <= pos[1] <= max_y:
+                result.append(obj)
+        return result
+
+    def query_radius(self, pos: Tuple[int, int], radius: float, t: int = None, cls=None) -> list:
+        """
+        Find the objects whose position at time t is within a radius of a point
+        :param pos: the point to search around
+        :param radius: the search radius
+        :param t: time in ns, now if not given
+        :param cls: only return instances of this class (or tuple of classes)
+        :return: a list of objects
+        """
+        return [obj for obj, _ in self._query_radius(pos, radius, t, cls)]
+
+    def nearest(self, pos: Tuple[int, int], radius: float, t: int = None, cls=None):
+        """
+        Find the closest object within a radius of a point
+        :return: the object, or None if there is no object in range
+        """
+        found = self._query_radius(pos, radius, t, cls)
+        return min(found, key=lambda x: x[1])[0] if found else None
+
+    def _query_radius(self, pos, radius, t, cls):
+        result = []
+        bounds = pos[0] - radius, pos[1] - radius, pos[0] + radius, pos[1] + radius
+        for obj in self.candidates(bounds, cls).values():
+            if not self.matches(obj, cls):
+                continue
+            d = dist(pos, obj.get_pos(t))
+            if d < radius:
+                result.append((obj, d))
+        return result
+
+    def cell_counts(self, cls=None) -> Dict[Tuple[int, int], int]:
+        """
+        How many objects every non-empty cell holds, objects overlapping several cells count in each of them
+        :param cls: an indexed class to count the instances of, otherwise every object is counted
+        """
+        return {cell: len(bucket) for cell, bucket in self.class_cells.get(cls, self.cells).items()}
+
+    def query_chunks(self, chunks: Collection[Tuple[int, int]], t: int = None, cls=None) -> list:
+        """
+        Find the objects whose position at time t is inside one of the given chunks (cells)
+        """
+        cells = self.class_cells.get(cls, self.cells)
+        found = {}
+        for chunk in chunks:
+            bucket = cells.get(chunk)
+            if bucket:
+                found.update(bucket)
+        return [obj for obj in found.values() if self.matches(obj, cls) and get_chunk(obj.get_pos(t)) in chunks]
+
+    def pairs(self, radius: float, t: int = None, cls=None) -> List[Tuple[Any, Any]]:
+        """
+        Find all the pairs of tracked objects whose positions at time t are closer than radius.
+        All-pairs search is a snapshot of the current positions anyway, so it runs scipy's KDTree (C) over the tracked
+        objects, which is several times faster than scanning the cells from python.
+        :return: a list of (o1, o2) tuples, every pair appears once
+        """
+        objects = [obj for obj in self.objects.values() if self.matches(obj, cls)]
+        if len(objects) < 2:
+            return []
+        kd_tree = KDTree([obj.get_pos(t) for obj in objects])
+        return [(objects[i], objects[j]) for i, j in kd_tree.query_pairs(radius)]
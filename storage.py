@@ -0,0 +1,189 @@
+"""
+Where DBAPI keeps the accounts and the players. A Storage runs the queries of a backend, DBAPI hashes the passwords,
+queues the players' backups and converts the players to rows. Selected by settings.DB_BACKEND: 'mysql', a MySQL server
+(see mysql_storage), or 'sqlite', a database file of the load balancer's process which needs no server.
+"""
+import logging
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from typing import Any, Callable, List, Optional, Tuple
+
+from settings import DB_BACKEND, SQLITE_BUSY_TIMEOUT, SQLITE_PATH
+
+MYSQL, SQLITE = 'mysql', 'sqlite'
+BACKENDS = [MYSQL, SQLITE]
+
+SCHEMA_VERSION = 2  # the layout of the tables, the MySQL backend migrates older databases
+# the fields changing all the time have their own columns, the items and the effects are JSON
+PLAYER_COLUMNS = ['username', 'id', 'pos_x', 'pos_y', 'health', 'items', 'effects']
+Account = Tuple[str, str, str]  # username, the hex of the password's hash, the hex of its salt
+
+
+class Storage(ABC):
+    """
+    The tables of the accounts and the players, safe to use from several threads. A player is a row of PLAYER_COLUMNS.
+    A failed query is logged and returns what an empty table would.
+    """
+
+    @abstractmethod
+    def get_account(self, username: str) -> Optional[Tuple[str, str]]:
+        """
+        :return: the hex of the password's hash and of its salt, None if there's no such account
+        """
+
+    @abstractmethod
+    def add_accounts(self, accounts: List[Account]) -> int:
+        """
+        Add accounts in a single transaction, the accounts whose usernames are taken are skipped
+        :return: how many were added
+        """
+
+    @abstractmethod
+    def remove_account(self, username: str):
+        pass
+
+    @abstractmethod
+    def get_player(self, username: str) -> Optional[dict]:
+        """
+        :return: the row of the player without the username
+        """
+
+    @abstractmethod
+    def write_players(self, rows: List[dict]) -> bool:
+        """
+        Insert or update a batch of players in a single transaction
+        :return: whether it was committed
+        """
+
+    @abstractmethod
+    def delete_player(self, username: str):
+        pass
+
+    def close(self):
+        pass
+
+
+def open_storage(backend: str = DB_BACKEND, **kwargs) -> Storage:
+    """
+    :param kwargs: for the backend's storage, the MySQL credentials come from MYSQL_USER, MYSQL_PASSWORD and MYSQL_PORT
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f'unknown database backend: {backend=}, expected one of {BACKENDS}')
+    if backend == SQLITE:
+        return SQLiteStorage(**kwargs)
+    from mysql_storage import MySQLStorage  # mysql-connector is needed by this backend only
+    return MySQLStorage(user=os.environ['MYSQL_USER'], password=os.environ['MYSQL_PASSWORD'],
+                        port=os.environ['MYSQL_PORT'], **kwargs)
+
+
+SQLITE_TABLES = [
+    'CREATE TABLE IF NOT EXISTS users(username TEXT PRIMARY KEY, hash TEXT NOT NULL, salt TEXT NOT NULL) WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS players(username TEXT PRIMARY KEY, id INTEGER NOT NULL, pos_x INTEGER NOT NULL, '
+    'pos_y INTEGER NOT NULL, health INTEGER NOT NULL, items TEXT NOT NULL, effects TEXT NOT NULL) WITHOUT ROWID',
+]
+SQLITE_UPSERT_PLAYER = (f'INSERT INTO players({", ".join(PLAYER_COLUMNS)}) '
+                        f'VALUES ({", ".join(f":{column}" for column in PLAYER_COLUMNS)}) '
+                        f'ON CONFLICT(username) DO UPDATE SET '
+                        f'{", ".join(f"{column} = excluded.{column}" for column in PLAYER_COLUMNS[1:])}')
+SQLITE_SELECT_PLAYER = f'SELECT {", ".join(PLAYER_COLUMNS[1:])} FROM players WHERE username = ?'
+
+
+class SQLiteStorage(Storage):
+    """
+    A database file. Every thread has its own connection, and in WAL mode the readers, the logins, don't wait for the
+    writer, the write-behind worker, and its commits don't wait for the disk, only the checkpoints do.
+    The queries are constant strings with parameters, so sqlite3's statement cache of a connection prepares every query
+    once per thread.
+    """
+
+    def __init__(self, path: str = SQLITE_PATH, busy_timeout: float = SQLITE_BUSY_TIMEOUT):
+        """
+        :param busy_timeout: seconds a write waits for another connection's write before it fails
+        """
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections: List[sqlite3.Connection] = []
+
+        connection = self.connection()
+        connection.execute('PRAGMA journal_mode = WAL')  # kept by the file
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            for table in SQLITE_TABLES:
+                connection.execute(table)
+            connection.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        logging.debug(f'sqlite storage is running: {path=}')
+
+    def connection(self) -> sqlite3.Connection:
+        """
+        :return: the connection of the current thread
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            # in autocommit mode, the batches begin their transactions, and closed by close, on another thread
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None,
+                                         check_same_thread=False)
+            # the database stays consistent in WAL mode, a power loss may lose the latest commits, the write-behind
+            # queue holds its backups a while anyway
+            connection.execute('PRAGMA synchronous = NORMAL')
+            self.local.connection = connection
+            with self.lock:
+                self.connections.append(connection)
+        return connection
+
+    def run(self, query: Callable[[sqlite3.Connection], Any], default=None, transaction: bool = False):
+        """
+        :param query: called with the connection of the current thread
+        :param transaction: run query in a transaction holding the write lock from its start
+        :return: what query returned, default if it failed
+        """
+        connection = self.connection()
+        try:
+            if not transaction:
+                return query(connection)
+            with connection:  # commits, or rolls back on an exception
+                connection.execute('BEGIN IMMEDIATE')
+                return query(connection)
+        except sqlite3.Error:
+            logging.exception('db exception')
+            return default
+
+    def get_account(self, username: str) -> Optional[Tuple[str, str]]:
+        return self.run(lambda connection: connection.execute(
+            'SELECT hash, salt FROM users WHERE username = ?', (username,)).fetchone())
+
+    def add_accounts(self, accounts: List[Account]) -> int:
+        def query(connection):
+            return connection.executemany('INSERT OR IGNORE INTO users(username, hash, salt) VALUES (?, ?, ?)',
+                                          accounts).rowcount
+
+        return self.run(query, default=0, transaction=True)
+
+    def remove_account(self, username: str):
+        self.run(lambda connection: connection.execute('DELETE FROM users WHERE username = ?', (username,)))
+
+    def get_player(self, username: str) -> Optional[dict]:
+        row = self.run(lambda connection: connection.execute(SQLITE_SELECT_PLAYER, (username,)).fetchone())
+        return None if row is None else dict(zip(PLAYER_COLUMNS[1:], row))
+
+    def write_players(self, rows: List[dict]) -> bool:
+        def query(connection):
+            connection.executemany(SQLITE_UPSERT_PLAYER, rows)
+            return True
+
+        return self.run(query, default=False, transaction=True)
+
+    def delete_player(self, username: str):
+        self.run(lambda connection: connection.execute('DELETE FROM players WHERE username = ?', (username,)))
+
+    def close(self):
+        """
+        Close the connections of all the threads, the last one checkpoints the WAL into the database file
+        """
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections.clear()
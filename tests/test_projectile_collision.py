@@ -0,0 +1,35 @@
+from my_server import Projectile, Server, default_player, game_ticks_to_ns
+
+TICK = game_ticks_to_ns(1)
+
+
+def turned_player():
+    """
+    A player which walked right to (1000, 1000) and turned up there halfway through a 60 game tick interval
+    """
+    player = default_player('turned')
+    player.start_pos, player.end_pos, player.t0 = (1000, 1000), (1000, 0), 30 * TICK
+    return player
+
+
+def horizontal_projectile(y: int):
+    return Projectile(id=None, start_pos=(900, y), target=(3000, 0), type='axe', attacker_id=0, t0=0)
+
+
+def test_entity_turning_mid_interval_is_not_extrapolated_backwards():
+    # extrapolating the upward move back to the interval's start puts the player at (1000, 1150), where it never was
+    toi = Server.entity_time_of_impact(horizontal_projectile(1120), turned_player(), 0, 60 * TICK)
+    assert toi is None
+
+
+def test_entity_turning_mid_interval_is_hit_where_it_stood():
+    toi = Server.entity_time_of_impact(horizontal_projectile(1000), turned_player(), 0, 60 * TICK)
+    assert toi is not None and toi < 0.5
+
+
+def test_entity_stopping_mid_interval_is_hit_where_it_stopped():
+    player = default_player('stopped')
+    player.start_pos, player.end_pos, player.t0 = (1000, 1300), (1000, 1000), 0  # arrives after 60 game ticks
+    projectile = Projectile(id=None, start_pos=(0, 1000), target=(3000, 0), type='axe', attacker_id=0, t0=0)
+    toi = Server.entity_time_of_impact(projectile, player, 0, 120 * TICK)
+    assert toi is not None and toi > 0.5
@@ -0,0 +1,36 @@
+import struct
+
+import protocol
+from protocol import decode, encode
+
+MOB = {'start_pos': [10, 20], 'end_pos': [30, 40], 'health': 100, 'kind': 'mob', 'type': 'dragon'}
+PLAYER = {'username': 'a', 'start_pos': [1, 2], 'end_pos': [1, 2], 'health': -5, 'kind': 'player'}
+
+
+def snapshot(*records):
+    return {'cmd': 'snapshot', 'seq': 7, 'baseline': None, 'entities': [[i, r] for i, r in enumerate(records)],
+            'removed': [3]}
+
+
+def test_records_of_every_layout_round_trip():
+    reordered = dict(reversed(list(MOB.items())))
+    missing = {'kind': 'mob', 'health': 1}
+    with_none = {**PLAYER, 'end_pos': None}
+    message = snapshot(MOB, PLAYER, reordered, missing, with_none, MOB)
+    assert decode(encode(message)) == message
+    assert decode(encode(message)) == decode(encode(message, protocol.JSON))
+
+
+def test_compiled_layout_packs_like_the_fields_one_by_one():
+    move = {'cmd': 'move', 'id': 2 ** 40, 'pos': [-1, 1]}
+    data = encode(move)
+    assert data == bytes([protocol.PROTOCOL_VERSION, protocol.CMD_CODES['move']]) + \
+        struct.pack('<HHQii', 0b11, 0, 2 ** 40, -1, 1)
+
+
+def test_layouts_past_the_limit_are_encoded_field_by_field(monkeypatch):
+    monkeypatch.setattr(protocol, 'MAX_LAYOUTS', 0)
+    codec = protocol.struct_of(('a', protocol.U8), ('b', protocol.STRING))
+    out = bytearray()
+    codec[0](out, {'b': 'x', 'a': 1}, None)
+    assert codec[1](bytes(out), 0) == ({'a': 1, 'b': 'x'}, len(out))
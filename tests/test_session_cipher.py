@@ -0,0 +1,52 @@
+import time
+
+import pytest
+from cryptography.fernet import InvalidToken
+from cryptography.hazmat.primitives.asymmetric import ec
+
+import session_cipher
+from settings import FERNET_TTL
+from utils import CURVE, get_cipher, load_private_ecdh_key, load_public_ecdh_key
+
+
+def handshake():
+    """
+    :return: the client's cipher and a function making the cipher of a server adopting the client, like add_client
+    """
+    client_key = ec.generate_private_key(CURVE)
+    client = get_cipher(load_public_ecdh_key(), client_key, server=False)
+    return client, lambda: get_cipher(client_key.public_key(), load_private_ecdh_key(), server=True)
+
+
+def later(monkeypatch, seconds: float):
+    now = time.time_ns()
+    monkeypatch.setattr(session_cipher.time, 'time_ns', lambda: now + int(seconds * 10 ** 9))
+
+
+def test_replay_is_rejected_by_the_same_server():
+    client, adopt = handshake()
+    server = adopt()
+    packet = client.encrypt(b'move')
+    assert server.decrypt(packet, ttl=FERNET_TTL) == b'move'
+    with pytest.raises(InvalidToken):
+        server.decrypt(packet, ttl=FERNET_TTL)
+
+
+def test_packet_captured_before_a_redirect_is_rejected_after_it(monkeypatch):
+    client, adopt = handshake()
+    captured = client.encrypt(b'move')
+    assert adopt().decrypt(captured, ttl=FERNET_TTL) == b'move'
+
+    later(monkeypatch, FERNET_TTL + 1)
+    next_server = adopt()  # redirected, its cipher has no replay windows
+    with pytest.raises(InvalidToken):
+        next_server.decrypt(captured, ttl=FERNET_TTL)
+    assert next_server.decrypt(client.encrypt(b'move'), ttl=FERNET_TTL) == b'move'
+
+
+def test_packet_time_is_authenticated():
+    client, adopt = handshake()
+    packet = bytearray(client.encrypt(b'move'))
+    packet[session_cipher.NONCE_SIZE + session_cipher.TIMESTAMP_SIZE - 1] ^= 1
+    with pytest.raises(InvalidToken):
+        adopt().decrypt(bytes(packet), ttl=FERNET_TTL)
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from typing import Callable
+
+CATCH_UP = 'catch_up'  # run missed ticks back to back until the schedule is met again
+SKIP = 'skip'  # drop missed ticks and continue from the next deadline
+
+
+class TickStats:
+    """
+    Per-tick timing accounting, all times in seconds
+    """
+
+    def __init__(self, period: float, history: int = 1000):
+        self.period = period
+        self.ticks = 0
+        self.overruns = 0  # ticks which took longer than the period
+        self.skipped = 0  # deadlines dropped because the loop was behind
+        self.durations = deque(maxlen=history)
+        self.lateness = deque(maxlen=history)  # how long after its deadline every tick started
+
+    def record(self, duration: float, lateness: float):
+        self.ticks += 1
+        self.durations.append(duration)
+        self.lateness.append(lateness)
+        if duration > self.period:
+            self.overruns += 1
+
+    def mean_duration(self, last: int = None) -> float:
+        """
+        :param last: only average that many of the latest ticks
+        """
+        durations = list(self.durations)[-last:] if last else self.durations
+        return sum(durations) / len(durations) if durations else 0.0
+
+    def summary(self) -> dict:
+        if not self.durations:
+            return {'ticks': 0}
+        durations = sorted(self.durations)
+        mean = sum(durations) / len(durations)
+        return {
+            'ticks': self.ticks,
+            'overruns': self.overruns,
+            'skipped': self.skipped,
+            'mean_duration': mean,
+            'p99_duration': durations[min(len(durations) - 1, math.ceil(0.99 * len(durations)) - 1)],
+            'max_duration': durations[-1],
+            'max_lateness': max(self.lateness),
+            'headroom': 1 - mean / self.period,
+        }
+
+
+class TickScheduler:
+    """
+    Run a tick function at a fixed period on a monotonic clock.
+    Deadlines are computed from the start time and not from the end of the previous tick, so the tick duration
+    doesn't add to the period. When a tick ends after the next deadline the policy decides whether the missed
+    ticks are run back to back (CATCH_UP, at most max_catch_up of them) or dropped (SKIP).
+    """
+
+    def __init__(self, period: float, tick: Callable[[], None], policy: str = SKIP, max_catch_up: int = 5,
+                 log_interval: int = 0, clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], None] = time.sleep):
+        if policy not in (CATCH_UP, SKIP):
+            raise ValueError(f'unknown tick policy: {policy=}')
+        self.period = period
+        self.tick = tick
+        self.policy = policy
+        self.max_catch_up = max_catch_up
+        self.log_interval = log_interval
+        self.clock = clock
+        self.sleep = sleep
+        self.stats = TickStats(period)
+        self.next_deadline = None
+
+    def run_once(self):
+        """
+        Wait for the next deadline and run one tick
+        """
+        delay = self.delay()
+        if delay > 0:
+            self.sleep(delay)
+        self.run_tick()
+
+    def delay(self) -> float:
+        """
+        :return: how long until the next deadline, <= 0 if it has passed
+        """
+        if self.next_deadline is None:
+            self.next_deadline = self.clock() + self.period
+        return self.next_deadline - self.clock()
+
+    def run_tick(self):
+        """
+        Run the tick of the current deadline and schedule the next one
+        """
+        start = self.clock()
+        try:
+            self.tick()
+        except Exception:
+            logging.exception('exception in tick')
+        end = self.clock()
+        self.stats.record(duration=end - start, lateness=max(0.0, start - self.next_deadline))
+        self.next_deadline += self.period
+
+        behind = end - self.next_deadline
+        if behind > 0:
+            missed = math.floor(behind / self.period)
+            if self.policy == SKIP:
+                dropped = missed + 1
+            else:
+                dropped = max(0, missed - self.max_catch_up)
+            self.next_deadline += dropped * self.period
+            self.stats.skipped += dropped
+
+        if self.log_interval and self.stats.ticks % self.log_interval == 0:
+            logging.info(f'tick stats: {self.stats.summary()}')
+
+    def run(self, ticks: int = None):
+        """
+        Run forever, or for a given number of ticks
+        """
+        i = 0
+        while ticks is None or i < ticks:
+            self.run_once()
+            i += 1
+
+    async def run_async(self, ticks: int = None):
+        """
+        Like run, as a task of an asyncio event loop, which handles other events until the deadlines
+        """
+        i = 0
+        while ticks is None or i < ticks:
+            # yields to the loop even when behind, so received datagrams are handled between ticks
+            await asyncio.sleep(max(0.0, self.delay()))
+            self.run_tick()
+            i += 1
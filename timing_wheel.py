@@ -0,0 +1,52 @@
+from typing import Any, Dict, Hashable, List
+
+
+class TimingWheel:
+    """
+    A hashed timing wheel: keys are scheduled to expire at a given tick and collected when the wheel advances.
+    Scheduling and canceling are O(1), advancing one tick only looks at one slot, so as long as most deadlines are
+    closer than the number of slots every key is looked at once.
+    """
+
+    def __init__(self, slots: int = 64, current_tick: int = 0):
+        self.slots: List[Dict[Hashable, int]] = [{} for _ in range(slots)]
+        self.deadlines: Dict[Hashable, int] = {}  # key to its expiry tick
+        self.current_tick = current_tick
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    def schedule(self, key: Hashable, tick: int):
+        """
+        Schedule a key to expire at a tick, deadlines in the past expire on the next advance
+        """
+        self.cancel(key)
+        tick = max(tick, self.current_tick + 1)
+        self.slots[tick % len(self.slots)][key] = tick
+        self.deadlines[key] = tick
+
+    def cancel(self, key: Hashable):
+        tick = self.deadlines.pop(key, None)
+        if tick is not None:
+            del self.slots[tick % len(self.slots)][key]
+
+    def advance(self, tick: int) -> List[Any]:
+        """
+        Move the wheel forward to a tick
+        :return: the keys whose deadline is at or before the tick
+        """
+        expired = []
+        # after a full turn every slot was visited, there is no need to go over them again
+        start = max(self.current_tick + 1, tick - len(self.slots) + 1)
+        for t in range(start, tick + 1):
+            slot = self.slots[t % len(self.slots)]
+            due = [key for key, deadline in slot.items() if deadline <= tick]
+            for key in due:
+                del slot[key]
+                del self.deadlines[key]
+            expired += due
+        self.current_tick = max(self.current_tick, tick)
+        return expired
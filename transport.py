@@ -0,0 +1,114 @@
+import itertools
+import logging
+import struct
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional
+
+from settings import MAX_FRAGMENTS, MAX_PENDING_BYTES, MAX_PENDING_MESSAGES, MTU, REASSEMBLY_TIMEOUT
+
+HEADER = struct.Struct('>IHH')  # message id, fragment index, fragment count
+FRAGMENT_SIZE = MTU - HEADER.size
+
+message_ids = itertools.count()  # shared by every sender of the process, next() is atomic
+
+
+def fragment(data: bytes) -> Iterator[bytes]:
+    """
+    Split a message into datagrams of at most MTU bytes, each with a header to reassemble it
+    """
+    message_id = next(message_ids) & 0xFFFFFFFF
+    count = max(1, -(-len(data) // FRAGMENT_SIZE))
+    if count > MAX_FRAGMENTS:
+        raise ValueError(f'message too big: {len(data)=}')
+    for i in range(count):
+        yield HEADER.pack(message_id, i, count) + data[i * FRAGMENT_SIZE:(i + 1) * FRAGMENT_SIZE]
+
+
+@dataclass
+class PendingMessage:
+    count: int
+    t0: float
+    fragments: List[Optional[bytes]] = field(init=False)
+    received: int = 0
+    size: int = 0
+
+    def __post_init__(self):
+        self.fragments = [None] * self.count
+
+
+class Reassembler:
+    """
+    Rebuilds the messages made by fragment.
+    Fragments are stored until all of their message arrived and joined once, a lost fragment only loses its own
+    message: incomplete messages are dropped after a timeout, or when a peer has too many of them pending.
+    """
+
+    def __init__(self, timeout: float = REASSEMBLY_TIMEOUT, max_pending: int = MAX_PENDING_MESSAGES,
+                 max_bytes: int = MAX_PENDING_BYTES, clock=time.monotonic):
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.pending: Dict[Any, Dict[int, PendingMessage]] = {}  # peer address to its messages by id
+        self.dropped = 0  # incomplete messages given up on
+        self.last_sweep = clock()
+
+    def add(self, datagram: bytes, address) -> Optional[bytes]:
+        """
+        :param datagram: a datagram made by fragment
+        :param address: the peer it came from
+        :return: the whole message if this was its last missing fragment, None otherwise
+        """
+        if len(datagram) < HEADER.size:
+            logging.warning(f'datagram too short: {address=}, {datagram=}')
+            return None
+        message_id, index, count = HEADER.unpack_from(datagram)
+        if not 0 < count <= MAX_FRAGMENTS or index >= count:
+            logging.warning(f'bad fragment header: {address=}, {message_id=}, {index=}, {count=}')
+            return None
+        payload = datagram[HEADER.size:]
+        if count == 1:
+            return payload
+
+        now = self.clock()
+        if now - self.last_sweep > self.timeout:
+            # peers which went silent don't call add for themselves
+            for peer in list(self.pending):
+                self.expire(peer, now)
+            self.last_sweep = now
+        messages = self.pending.setdefault(address, {})
+        message = messages.get(message_id)
+        if message is None or message.count != count:
+            message = messages[message_id] = PendingMessage(count=count, t0=now)
+        if message.fragments[index] is None:
+            message.fragments[index] = payload
+            message.received += 1
+            message.size += len(payload)
+
+        if message.received == message.count:
+            del messages[message_id]
+            if not messages:
+                del self.pending[address]
+            return b''.join(message.fragments)
+        self.enforce_limits(address)
+        return None
+
+    def expire(self, address, now: float):
+        messages = self.pending[address]
+        for message_id in [i for i, message in messages.items() if now - message.t0 > self.timeout]:
+            del messages[message_id]
+            self.dropped += 1
+        if not messages:
+            del self.pending[address]
+
+    def enforce_limits(self, address):
+        """
+        Drop the oldest incomplete messages of a peer until it's within the count and memory limits
+        """
+        messages = self.pending[address]
+        while len(messages) > self.max_pending or sum(m.size for m in messages.values()) > self.max_bytes:
+            oldest = min(messages, key=lambda i: messages[i].t0)
+            del messages[oldest]
+            self.dropped += 1
+            logging.warning(f'incomplete message dropped: {address=}, {oldest=}')
@@ -2,7 +2,7 @@ import base64
 import json
 import logging
 import socket
-from collections import defaultdict
+import struct
 from typing import Tuple, Collection, Any, Dict
 
 import cryptography.fernet
@@ -12,10 +12,14 @@ from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import ec
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 
+from protocol import ProtocolError, decode as protocol_decode
+from session_cipher import SessionCipher
+from transport import Reassembler, fragment
 from settings import *
 
 CURVE = ec.SECP384R1()
 Address = Tuple[str, int]
+ID_HEADER = struct.Struct('>Q')  # the player id clients put before their encrypted messages
 
 
 class UnknownClientException(Exception):
@@ -23,38 +27,32 @@ class UnknownClientException(Exception):
 
 
 def send_all(sock: socket.socket, data: bytes, address, fernet):
+    """
+    Encrypt a message and send it in MTU sized fragments, see transport.fragment
+    """
     try:
-        k = 0
-        data = fernet.encrypt(data)
-        while k * 1024 < len(data):
-            sock.sendto(data[1024 * k: 1024 * (k + 1)], address)
-            k += 1
+        for datagram in fragment(fernet.encrypt(data)):
+            sock.sendto(datagram, address)
     except Exception:
         logging.exception(f"can't send data: {address=}, {data=}")
 
 
 class JSONSocketWrapper:
-    def __init__(self, sock: socket.socket, fernet, max_iterations=10):
+    def __init__(self, sock: socket.socket, fernet):
         self.socket = sock
-        self.max_iterations = max_iterations
-        self.received: Dict[Any, list] = defaultdict(lambda: [0, b''])
+        self.reassembler = Reassembler()
         self.fernet = fernet
 
     def recv_from(self):
         while True:
-            msg, addr = self.socket.recvfrom(1024)
-            self.received[addr][1] += msg
-            self.received[addr][0] += 1
+            msg, addr = self.socket.recvfrom(MTU)
+            data = self.reassembler.add(msg, addr)
+            if data is None:
+                continue
             try:
-                data = self.fernet.decrypt(self.received[addr][1], ttl=FERNET_TTL)
-                json_data = json.loads(data.decode())
-                # logging.debug(f'received data: {k=}, {len(data)=}, {data=}')
-                del self.received[addr]
-                return json_data, addr
-            except (json.JSONDecodeError, cryptography.fernet.InvalidToken):
-                if self.received[0] == self.max_iterations:
-                    logging.warning(f'max iterations exceeded in recv_json')
-                    del self.received[addr]
+                return protocol_decode(self.fernet.decrypt(data, ttl=FERNET_TTL)), addr
+            except (json.JSONDecodeError, ProtocolError, cryptography.fernet.InvalidToken):
+                logging.warning(f'dropped an invalid message: {addr=}, {len(data)=}')
 
 
 def dist(pos1, pos2):
@@ -86,6 +84,21 @@ def get_adj_server_idx(chunk_mapping, chunk_idx: Tuple[int, int]) -> Collection:
     return servers
 
 
+def section_chunks(chunk_mapping, server_idx: int) -> Tuple[list, list]:
+    """
+    :return: the chunks of a server, and the chunks around the border of its section shared with other servers
+    """
+    server_chunks, shared_chunks = [], []
+    for i in range(CHUNKS_X):
+        for j in range(CHUNKS_Y):
+            if chunk_mapping[i][j] == server_idx:
+                server_chunks.append((i, j))
+            adj = get_adj_server_idx(chunk_mapping, (i, j))
+            if server_idx in adj and len(adj) > 1:
+                shared_chunks.append((i, j))
+    return server_chunks, shared_chunks
+
+
 def ascii_seed(seed):
     ascii_sum = 0
     for char in seed:
@@ -166,6 +179,48 @@ def get_fernet(public_key, private_key):
     return Fernet(derived_key)
 
 
+def get_session_cipher(public_key, private_key, server: bool) -> SessionCipher:
+    """
+    Derive a session cipher from the same handshake as get_fernet
+    :param server: whether this side is the server (or load balancer), the sides send with different keys
+    """
+    shared_key = private_key.exchange(ec.ECDH(), public_key)
+    derived_key = HKDF(
+        algorithm=hashes.SHA256(),
+        length=64,
+        salt=None,
+        info=b'session keys',
+    ).derive(shared_key)
+    client_key, server_key = derived_key[:32], derived_key[32:]
+    if server:
+        return SessionCipher(send_key=server_key, receive_key=client_key)
+    return SessionCipher(send_key=client_key, receive_key=server_key)
+
+
+def get_peer_cipher() -> SessionCipher:
+    """
+    The cipher of the links between section servers, derived from the secret they share with the load balancer.
+    Every server sends and receives with the same key, the random nonce prefix of every cipher keeps them apart
+    """
+    with open("super_secret_do_not_touch.txt", 'rb') as secret_key:
+        key = HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=None,
+            info=b'peer links',
+        ).derive(secret_key.read())
+    return SessionCipher(send_key=key, receive_key=key)
+
+
+def get_cipher(public_key, private_key, server: bool):
+    """
+    The cipher of the game channel with a client, selected by GAME_CIPHER
+    """
+    if GAME_CIPHER == 'fernet':
+        return get_fernet(public_key, private_key)
+    return get_session_cipher(public_key, private_key, server)
+
+
 def client():
     generate_ecdh_key()
     server_public_key = load_public_ecdh_key()
@@ -0,0 +1,140 @@
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+ENTITY, PROJECTILE = 0, 1
+
+
+class WorldStore:
+    """
+    Struct-of-arrays storage of the server's moving objects.
+    Rows mirror the objects' start_pos, end_pos (target vector for projectiles), t0, speed and size, so the positions
+    of every object for a tick are computed with one vectorized call. The objects stay the source of truth, they sync
+    their row whenever they move (see Entity.move) and their get_pos reads the evaluated tick before computing it alone.
+    """
+
+    def __init__(self, ns_per_game_tick: float, capacity: int = 1024):
+        self.ns_per_game_tick = ns_per_game_tick
+        self.size = 0
+        self.start = np.zeros((capacity, 2), dtype=np.float64)
+        self.end = np.zeros((capacity, 2), dtype=np.float64)
+        self.t0 = np.zeros(capacity, dtype=np.int64)
+        self.speed = np.zeros(capacity, dtype=np.float64)
+        self.extent = np.zeros((capacity, 2), dtype=np.float64)
+        self.kind = np.zeros(capacity, dtype=np.int8)
+
+        self.objects: List[Any] = []  # row to object
+        self.rows: Dict[int, int] = {}  # python id of an object to its row
+        self.variable_speed: Dict[int, Any] = {}  # objects whose speed depends on time (players with effects)
+
+        self.evaluated_t: Optional[int] = None
+        self.positions: List[Optional[list]] = []  # row to position at evaluated_t, None if it moved since
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, obj):
+        return id(obj) in self.rows
+
+    def _grow(self):
+        capacity = 2 * len(self.t0)
+        for name in ['start', 'end', 't0', 'speed', 'extent', 'kind']:
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def add(self, obj, kind: int = ENTITY, variable_speed: bool = False):
+        if id(obj) in self.rows:
+            self.sync(obj)
+            return
+        if self.size == len(self.t0):
+            self._grow()
+        row = self.size
+        self.size += 1
+        self.rows[id(obj)] = row
+        self.objects.append(obj)
+        self.kind[row] = kind
+        if variable_speed:
+            self.variable_speed[id(obj)] = obj
+        self.sync(obj)
+
+    def remove(self, obj):
+        row = self.rows.pop(id(obj), None)
+        if row is None:
+            return
+        self.variable_speed.pop(id(obj), None)
+        last = self.size - 1
+        if row != last:
+            # keep the rows dense, move the last row into the hole
+            moved = self.objects[last]
+            for column in [self.start, self.end, self.t0, self.speed, self.extent, self.kind]:
+                column[row] = column[last]
+            self.objects[row] = moved
+            self.rows[id(moved)] = row
+            if row < len(self.positions):
+                self.positions[row] = self.positions[last] if last < len(self.positions) else None
+        self.objects.pop()
+        del self.positions[last:]
+        self.size -= 1
+
+    def sync(self, obj):
+        """
+        Copy an object's movement fields into its row, called whenever they change
+        """
+        row = self.rows.get(id(obj))
+        if row is None:
+            return
+        self.start[row] = obj.start_pos
+        self.end[row] = obj.target if self.kind[row] == PROJECTILE else obj.end_pos
+        self.t0[row] = obj.t0
+        self.speed[row] = obj.get_speed()
+        self.extent[row] = obj.get_size()
+        if row < len(self.positions):
+            self.positions[row] = None
+
+    def evaluate(self, t: int) -> np.ndarray:
+        """
+        Compute the positions of all the objects at time t, the same way Entity.get_pos and Projectile.get_pos do
+        :param t: time in ns
+        :return: an int array of shape (len(self), 2), also cached for get_cached_pos
+        """
+        positions = self.positions_at(t)
+        self.evaluated_t = t
+        self.positions = positions.tolist()
+        return positions
+
+    def positions_at(self, t: int) -> np.ndarray:
+        """
+        evaluate without caching the positions
+        """
+        for key, obj in self.variable_speed.items():
+            self.speed[self.rows[key]] = obj.get_speed()
+
+        n = self.size
+        start, end, speed = self.start[:n], self.end[:n], self.speed[:n]
+        is_projectile = self.kind[:n] == PROJECTILE
+        # entities move from start to end, projectiles move along their target vector
+        delta = np.where(is_projectile[:, None], end, end - start)
+        length = np.power(delta[:, 0] ** 2 + delta[:, 1] ** 2, 0.5)
+        moving = length > 0
+        total_time = np.divide(length, speed / self.ns_per_game_tick, out=np.ones(n), where=moving)
+        p = (t - self.t0[:n]) / total_time
+        p = np.where(is_projectile, p, np.minimum(p, 1))[:, None]
+
+        positions = np.where(is_projectile[:, None], np.round(end * p + start), np.round(end * p + start * (1 - p)))
+        positions = np.where(moving[:, None], positions, start)
+        arrived = ~is_projectile & (p[:, 0] >= 1)
+        positions[arrived] = end[arrived]
+        return positions.astype(np.int64)
+
+    def get_cached_pos(self, obj, t: int) -> Optional[Tuple[int, int]]:
+        """
+        The position of an object from the last evaluate call, if it was evaluated at time t and hasn't moved since
+        """
+        if t != self.evaluated_t:
+            return None
+        row = self.rows.get(id(obj))
+        if row is None or row >= len(self.positions) or self.positions[row] is None:
+            return None
+        return tuple(self.positions[row])
@@ -0,0 +1,145 @@
+"""
+Write-behind persistence of the players. The backups the servers send every BACKUP_DELAY seconds are queued instead of
+written by the load balancer's loop, a backup replaces the older backup of the same player still waiting, and a
+worker thread writes what's waiting in batches of a single transaction every DB_FLUSH_INTERVAL seconds.
+"""
+import logging
+import threading
+import time
+from itertools import islice
+from typing import Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+from settings import DB_CLOSE_ATTEMPTS, DB_FLUSH_INTERVAL, DB_MAX_BATCH, DB_STATS_INTERVAL
+
+
+class WriteBehindQueue:
+    def __init__(self, write: Callable[[List[dict]], bool], flush_interval: float = DB_FLUSH_INTERVAL,
+                 max_batch: int = DB_MAX_BATCH, log_interval: int = DB_STATS_INTERVAL,
+                 close_attempts: int = DB_CLOSE_ATTEMPTS):
+        """
+        :param write: writes a batch of rows in a transaction, False if it failed and the rows are to be written again
+        :param log_interval: log the stats every that many flushes, 0 to disable
+        :param close_attempts: failed writes close allows before it gives up the rows still waiting
+        """
+        self.write = write
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.log_interval = log_interval
+        self.close_attempts = close_attempts
+
+        self.condition = threading.Condition()
+        self.pending: Dict[Hashable, dict] = {}  # key to its latest row waiting, the longest waiting first
+        self.queued_at: Dict[Hashable, float] = {}  # when the keys waiting were first queued, replacing a row keeps it
+        self.writing: Dict[Hashable, dict] = {}  # the rows of the batch being written
+        self.closed = False
+
+        self.queued = 0
+        self.coalesced = 0  # rows replaced by a newer row of the same key before they were written
+        self.written = 0
+        self.flushes = 0
+        self.failures = 0
+        self.max_depth = 0
+        self.flush_time = 0.0  # the total time of the flushes, in seconds
+        self.max_flush_time = 0.0
+        self.max_delay = 0.0  # the longest time from queueing a row to committing it
+
+        self.worker = threading.Thread(target=self.run, name='write-behind', daemon=True)
+        self.worker.start()
+
+    def put(self, rows: Iterable[Tuple[Hashable, dict]]):
+        """
+        Queue rows to be written, in O(1) per row
+        """
+        now = time.monotonic()
+        with self.condition:
+            for key, row in rows:
+                if key in self.pending:
+                    self.coalesced += 1
+                else:
+                    self.queued_at[key] = now
+                self.pending[key] = row
+                self.queued += 1
+            self.max_depth = max(self.max_depth, len(self.pending))
+            if len(self.pending) >= self.max_batch:
+                self.condition.notify()
+
+    def get(self, key: Hashable) -> Optional[dict]:
+        """
+        :return: the latest row of a key which may not be written yet, None if it's written
+        """
+        with self.condition:
+            row = self.pending.get(key)
+            return row if row is not None else self.writing.get(key)
+
+    def run(self):
+        written = True
+        while True:
+            with self.condition:
+                # a full batch is written right away, unless the database just failed
+                if (not written or len(self.pending) < self.max_batch) and not self.closed:
+                    self.condition.wait(self.flush_interval)
+                if self.closed:
+                    return
+            written = self.flush()
+
+    def flush(self) -> bool:
+        """
+        Write a batch of the longest waiting rows, called by the worker, and by close once it stopped
+        :return: whether the batch was written
+        """
+        with self.condition:
+            keys = list(islice(self.pending, self.max_batch))
+            if not keys:
+                return True
+            self.writing = {key: self.pending.pop(key) for key in keys}
+            queued_at = {key: self.queued_at.pop(key) for key in keys}
+        start = time.monotonic()
+        try:
+            written = self.write(list(self.writing.values()))
+        except Exception:
+            logging.exception('write-behind flush failed')
+            written = False
+        end = time.monotonic()
+
+        with self.condition:
+            self.flushes += 1
+            self.flush_time += end - start
+            self.max_flush_time = max(self.max_flush_time, end - start)
+            if written:
+                self.written += len(keys)
+                self.max_delay = max(self.max_delay, end - min(queued_at.values()))
+            else:
+                # written again with the next batch, unless a newer row of the key came meanwhile
+                self.failures += 1
+                for key, row in self.writing.items():
+                    if key not in self.pending:
+                        self.pending[key] = row
+                        self.queued_at[key] = queued_at[key]
+            self.writing = {}
+        if self.log_interval and self.flushes % self.log_interval == 0:
+            logging.info(f'write-behind stats: {self.stats()}')
+        return written
+
+    def stats(self) -> dict:
+        return {'depth': len(self.pending), 'max_depth': self.max_depth, 'queued': self.queued,
+                'coalesced': self.coalesced, 'written': self.written, 'flushes': self.flushes,
+                'failures': self.failures,
+                'mean_flush_ms': self.flush_time / self.flushes * 1000 if self.flushes else 0.0,
+                'max_flush_ms': self.max_flush_time * 1000, 'max_delay': self.max_delay}
+
+    def close(self):
+        """
+        Stop the worker and write everything still waiting, the rows which can't be written are logged and dropped
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.worker.join()
+        failures = 0
+        while self.pending and failures < self.close_attempts:
+            if not self.flush():
+                failures += 1
+                if failures < self.close_attempts:
+                    time.sleep(self.flush_interval)
+        if self.pending:
+            logging.error(f'write-behind closed with unwritten rows: {len(self.pending)}, keys={list(self.pending)}')